@@ -1,32 +1,122 @@
-from flask import Flask, render_template, Response, jsonify, request
+from flask import Flask, render_template, Response, jsonify, request, stream_with_context
 import io
 import cv2
 import time
-import threading
 import numpy as np
-from detector import MedicineDetector
+from detector import MedicineDetector, DetectionWorker
 from ocr_engine import OCREngine
+from frame_source import FrameGrabber, MJPEGBroadcaster, SceneGate
+from recognition import RollingRecognizer
+from jobs import JobQueue, JobQueueFull
+from inference import InferencePool, PoolBusy, RemoteDetector, RemoteOCREngine
 import database
-from thefuzz import process, fuzz
+import matcher
+import scan_pipeline
+import metrics
+import threading
 import json
+import logging
 import urllib.request
 import re
+import os
+import shutil
+import tempfile
 
 app = Flask(__name__)
+logger = logging.getLogger(__name__)
 database.init_db()
 
+# Imported by a spawned inference worker as __mp_main__ (python app.py):
+# define everything but start no camera, threads or pools.
+IS_CHILD_IMPORT = __name__ == '__mp_main__'
+
+# PRELOAD_MODELS: comma-separated yolo, easyocr, paddle (or "all"); empty keeps
+# lazy loading. PRELOAD_MODE: "background" loads and warms on a thread at boot,
+# "sync" does it before the app starts serving, "fork" only loads weights at
+# import (the gunicorn master, shared copy-on-write) and each worker runs the
+# warm-up inference after fork (see gunicorn.conf.py).
+PRELOAD_MODELS = [m.strip().lower() for m in os.environ.get('PRELOAD_MODELS', '').split(',') if m.strip()]
+if 'all' in PRELOAD_MODELS:
+    PRELOAD_MODELS = ['yolo', 'easyocr', 'paddle']
+PRELOAD_MODE = os.environ.get('PRELOAD_MODE', 'background').lower()
+
 # Initialize Models
-detector = MedicineDetector()
-ocr_engine = OCREngine()
+# INFERENCE_WORKERS > 0 runs YOLO/OCR in that many worker processes (see
+# inference.py) instead of on request threads; INFERENCE_QUEUE caps in-flight
+# jobs, beyond which scans get a 503.
+INFERENCE_WORKERS = int(os.environ.get('INFERENCE_WORKERS', 0))
+model_config = {
+    # DETECTOR_BACKEND: torch (default), onnx or openvino; see detector.py.
+    'detector_model': os.environ.get('DETECTOR_MODEL', 'yolov8n.pt'),
+    'detector_backend': os.environ.get('DETECTOR_BACKEND', 'torch').lower(),
+    'detect_cache_size': int(os.environ.get('DETECT_CACHE_SIZE', 8)),
+    'detect_cache_ttl': float(os.environ.get('DETECT_CACHE_TTL', 5)),
+    'ocr_cache_size': int(os.environ.get('OCR_CACHE_SIZE', 256)),
+    'ocr_cache_ttl': float(os.environ.get('OCR_CACHE_TTL', 30)),
+    # JSON overrides for ocr_engine.PREPROCESS_DEFAULTS, e.g. '{"denoise": "bilateral"}'.
+    'ocr_preprocess': json.loads(os.environ.get('OCR_PREPROCESS') or '{}'),
+    'preload': PRELOAD_MODELS,
+}
+inference_pool = None
+# A spawned worker re-imports this module; it builds its own models in
+# inference._worker_main and must not create a pool of its own.
+if INFERENCE_WORKERS > 0 and not IS_CHILD_IMPORT:
+    inference_pool = InferencePool(
+        workers=INFERENCE_WORKERS,
+        max_pending=int(os.environ.get('INFERENCE_QUEUE', 0)) or None,
+        config=model_config,
+    )
+    detector = RemoteDetector(inference_pool)
+    ocr_engine = RemoteOCREngine(inference_pool)
+else:
+    detector = MedicineDetector(
+        model_path=model_config['detector_model'],
+        backend=model_config['detector_backend'],
+        cache_size=model_config['detect_cache_size'],
+        cache_ttl=model_config['detect_cache_ttl'],
+    )
+    ocr_engine = OCREngine(
+        cache_size=model_config['ocr_cache_size'],
+        cache_ttl=model_config['ocr_cache_ttl'],
+        preprocess=model_config['ocr_preprocess'],
+    )
+
+def start_inference_pool():
+    # Workers warm their own models (PRELOAD_MODELS) as they start.
+    if inference_pool is not None and not inference_pool.started:
+        inference_pool.start()
+
+def preload_models(infer=True):
+    if inference_pool is not None:
+        return
+    if 'yolo' in PRELOAD_MODELS:
+        detector.warmup(infer=infer)
+    ocr_models = [m for m in ('easyocr', 'paddle') if m in PRELOAD_MODELS]
+    if ocr_models:
+        ocr_engine.warmup(ocr_models, infer=infer)
+
+def warm_models_async():
+    if PRELOAD_MODELS and inference_pool is None:
+        threading.Thread(target=preload_models, name='model-warmup', daemon=True).start()
+
+def model_status():
+    if inference_pool is not None:
+        return inference_pool.model_status()
+    return {'yolo': detector.status, **ocr_engine.status}
+
+if PRELOAD_MODELS and not IS_CHILD_IMPORT:
+    if PRELOAD_MODE == 'sync':
+        preload_models()
+    elif PRELOAD_MODE == 'fork':
+        preload_models(infer=False)
+    else:
+        warm_models_async()
 
 camera = None
-current_frame = None
-lock = threading.Lock()
-poll_thread = None
-poll_stop = None
+grabber = FrameGrabber()
 using_poll = False
 poll_url = None
-ANNOTATE_STREAM = False
+ANNOTATE_STREAM = os.environ.get('ANNOTATE_STREAM', '0').lower() in ('1', 'true', 'yes')
 CURRENT_RECEIPT_ID = None
 CURRENT_PRESCRIPTION = {}
 COMPANY_INFO = {
@@ -60,81 +150,40 @@ def _normalize_text(s):
 
 def parse_prescription_text(text):
     lines = [l.strip() for l in re.split(r'[\r\n]+', text or '') if l.strip()]
-    all_meds = database.get_all_medicines()
-    med_names = [m[1] for m in all_meds]
+    med_matcher = matcher.for_catalog(database.get_catalog())
     out = []
     for i, line in enumerate(lines):
         cleaned = _normalize_text(line)
         if len(cleaned) < 3:
             continue
-        best = process.extractOne(cleaned, med_names, scorer=fuzz.token_set_ratio)
-        matched_name = None
-        if best and best[1] >= 70:
-            matched_name = best[0]
-        else:
-            parts = cleaned.split()
-            best_score = 0
-            best_word = None
-            for w in parts:
-                if len(w) < 4:
-                    continue
-                res = process.extractOne(w, med_names, scorer=fuzz.ratio)
-                if res and res[1] > best_score:
-                    best_score = res[1]
-                    best_word = res[0]
-            if best_score >= 85:
-                matched_name = best_word
+        matched_name = med_matcher.match(cleaned)
         if not matched_name:
             continue
         out.append({'name': matched_name})
     return out
 
 def start_polling(url):
-    global poll_thread, poll_stop, using_poll, poll_url
-    stop_polling()
+    global using_poll, poll_url
     poll_url = url
-    poll_stop = threading.Event()
     using_poll = True
-    def run():
-        global current_frame
-        while not poll_stop.is_set():
-            try:
-                base = poll_url
-                ts = str(int(time.time() * 1000))
-                u = base + ('&' if '?' in base else '?') + 't=' + ts
-                req = urllib.request.Request(u, headers={'User-Agent': 'Mozilla/5.0', 'Cache-Control': 'no-cache'})
-                with urllib.request.urlopen(req, timeout=2) as resp:
-                    data = resp.read()
-                arr = np.frombuffer(data, dtype=np.uint8)
-                img = cv2.imdecode(arr, cv2.IMREAD_COLOR)
-                if img is not None:
-                    with lock:
-                        current_frame = img.copy()
-            except Exception:
-                time.sleep(0.2)
-                continue
-            time.sleep(0.05)
-    poll_thread = threading.Thread(target=run, daemon=True)
-    poll_thread.start()
+    grabber.set_poll(url)
 
 def stop_polling():
-    global poll_thread, poll_stop, using_poll
-    if poll_stop is not None:
-        try:
-            poll_stop.set()
-        except Exception:
-            pass
-    poll_stop = None
-    poll_thread = None
+    global using_poll
+    if using_poll:
+        grabber.set_capture(None)
     using_poll = False
 
 def set_camera_source(source):
+    ok = _open_camera_source(source)
+    if not using_poll:
+        grabber.set_capture(camera)
+    return ok
+
+def _open_camera_source(source):
     global camera
-    if camera is not None:
-        try:
-            camera.release()
-        except Exception:
-            pass
+    grabber.set_capture(None)
+    camera = None
     if not source or (isinstance(source, str) and source.startswith('local')):
         stop_polling()
         def open_local_camera():
@@ -281,33 +330,79 @@ def set_camera_source(source):
         camera = cv2.VideoCapture(source)
     return camera is not None and camera.isOpened() or using_poll
 
-set_camera_source('local')
+def start_capture():
+    set_camera_source('local')
+    grabber.start()
+    if ROLLING_RECOGNITION:
+        recognizer.start()
+
+def latest_frame(timeout=0):
+    """Newest captured frame (shared, read-only) or None.
+
+    With ``timeout`` set, waits that long for a first frame to arrive.
+    """
+    item = grabber.latest()
+    if item is None and timeout:
+        item = grabber.wait_newer(0, timeout)
+    return item[1] if item is not None else None
+
+# SCENE_GATE=1 (default) runs background detection/OCR only after the scene
+# changed by more than SCENE_CHANGE_THRESHOLD grey levels (mean, on a 64 px
+# thumbnail) and then moved less than SCENE_SETTLE_THRESHOLD for
+# SCENE_SETTLE_FRAMES frames; see frame_source.SceneGate.
+SCENE_GATE = os.environ.get('SCENE_GATE', '1').lower() in ('1', 'true', 'yes')
+
+def _scene_gate():
+    if not SCENE_GATE:
+        return None
+    return SceneGate(
+        change_threshold=float(os.environ.get('SCENE_CHANGE_THRESHOLD', 6.0)),
+        settle_threshold=float(os.environ.get('SCENE_SETTLE_THRESHOLD', 2.0)),
+        settle_frames=int(os.environ.get('SCENE_SETTLE_FRAMES', 2)),
+    )
+
+# YOLO runs on its own thread at DETECT_FPS; the stream overlays its latest boxes.
+detection_worker = DetectionWorker(detector, grabber, fps=float(os.environ.get('DETECT_FPS', 5)), gate=_scene_gate())
+
+def _annotate_stream(item):
+    if ANNOTATE_STREAM:
+        return detection_worker.overlay(item)
+    return item[1]
+
+# One JPEG encode per captured frame, shared by every /video_feed client.
+broadcaster = MJPEGBroadcaster(
+    grabber,
+    quality=int(os.environ.get('STREAM_JPEG_QUALITY', 80)),
+    max_width=int(os.environ.get('STREAM_MAX_WIDTH', 0)),
+    annotate=_annotate_stream,
+)
+
+# ROLLING_RECOGNITION=1 keeps detecting and OCR'ing the newest frames in the
+# background (ROLLING_FPS, last ROLLING_WINDOW frames fused); /scan and
+# /detect_strip use that result when it is at most ROLLING_MAX_AGE seconds old.
+ROLLING_RECOGNITION = os.environ.get('ROLLING_RECOGNITION', '0').lower() in ('1', 'true', 'yes')
+ROLLING_MAX_AGE = float(os.environ.get('ROLLING_MAX_AGE', 2.0))
+recognizer = RollingRecognizer(
+    detector, ocr_engine, grabber,
+    window=int(os.environ.get('ROLLING_WINDOW', 8)),
+    fps=float(os.environ.get('ROLLING_FPS', 3)),
+    gate=_scene_gate(),
+)
+
+def fused_recognitions():
+    """Stable multi-frame recognitions, or None when rolling mode has nothing fresh."""
+    if not ROLLING_RECOGNITION:
+        return None
+    return recognizer.result(max_age=ROLLING_MAX_AGE) or None
+
+# gunicorn.conf.py defers these to post_fork so the camera, capture thread and
+# inference processes belong to the web worker rather than the preloading master.
+if os.environ.get('DEFER_STARTUP', '0') != '1' and not IS_CHILD_IMPORT:
+    start_capture()
+    start_inference_pool()
 
 def gen_frames():
-    global current_frame
-    while True:
-        if using_poll:
-            frame = None
-            with lock:
-                if current_frame is not None:
-                    frame = current_frame.copy()
-            if frame is None:
-                time.sleep(0.05)
-                continue
-        else:
-            success, frame = (camera.read() if camera is not None else (False, None))
-            if not success:
-                time.sleep(0.2)
-                continue
-        annotated_frame = frame
-        if ANNOTATE_STREAM:
-            annotated_frame, _ = detector.detect(frame)
-
-        with lock:
-            current_frame = frame.copy()
-            
-        ret, buffer = cv2.imencode('.jpg', annotated_frame)
-        frame_bytes = buffer.tobytes()
+    for frame_bytes in broadcaster.frames():
         yield (b'--frame\r\n'
                b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
 
@@ -319,6 +414,66 @@ def index():
 def video_feed():
     return Response(gen_frames(), mimetype='multipart/x-mixed-replace; boundary=frame')
 
+@app.route('/stream_stats')
+def stream_stats():
+    latest = grabber.latest()
+    return jsonify({
+        'annotate': ANNOTATE_STREAM,
+        'frame_id': latest[0] if latest else None,
+        'detection': detection_worker.stats(),
+        'recognition': recognizer.stats(),
+    })
+
+@app.route('/scene_gate', methods=['GET', 'POST'])
+def scene_gate():
+    gates = {'detection': detection_worker.gate, 'recognition': recognizer.gate}
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or request.form
+        try:
+            for gate in gates.values():
+                if gate is None:
+                    continue
+                if 'change_threshold' in data:
+                    gate.change_threshold = float(data['change_threshold'])
+                if 'settle_threshold' in data:
+                    gate.settle_threshold = float(data['settle_threshold'])
+                if 'settle_frames' in data:
+                    gate.settle_frames = int(data['settle_frames'])
+        except (TypeError, ValueError) as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
+    return jsonify({name: gate.stats() if gate is not None else None for name, gate in gates.items()})
+
+@app.route('/ready')
+def ready():
+    status = model_status()
+    is_ready = all(status.get(m) == 'warm' for m in PRELOAD_MODELS)
+    body = {'ready': is_ready, 'preload': PRELOAD_MODELS, 'mode': PRELOAD_MODE, 'models': status}
+    return jsonify(body), (200 if is_ready else 503)
+
+@app.route('/cache_stats')
+def cache_stats():
+    if inference_pool is not None:
+        # Caches live in the worker processes.
+        return jsonify({'inference': inference_pool.stats()})
+    return jsonify({'detect': detector.cache.stats(), 'ocr': ocr_engine.cache.stats()})
+
+@app.route('/preprocess_stats')
+def preprocess_stats():
+    if inference_pool is not None:
+        return jsonify({'status': 'error', 'message': 'Preprocessing runs in the inference workers'}), 404
+    return jsonify({'config': ocr_engine.preprocess, 'stages': ocr_engine.preprocess_report()})
+
+@app.route('/metrics')
+def metrics_endpoint():
+    # Prometheus text format. With INFERENCE_WORKERS the detector/OCR
+    # histograms live in the worker processes; scan and DB timings are here.
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.errorhandler(PoolBusy)
+@app.errorhandler(JobQueueFull)
+def inference_busy(e):
+    return jsonify({'status': 'error', 'message': 'Inference queue is full, retry shortly'}), 503
+
 @app.route('/debug_cameras')
 def debug_cameras():
     out = []
@@ -399,6 +554,7 @@ def auto_local():
     except Exception:
         pass
     camera = cap
+    grabber.set_capture(cap)
     return jsonify({'status': 'success', 'index': found_idx})
 
 @app.route('/test_camera', methods=['POST'])
@@ -464,292 +620,28 @@ def test_camera():
 
 @app.route('/scan', methods=['POST'])
 def scan_and_bill():
-    global current_frame
-    if current_frame is None:
-        if using_poll and poll_url:
-            try:
-                base = poll_url
-                ts = str(int(time.time() * 1000))
-                u = base + ('&' if '?' in base else '?') + 't=' + ts
-                req = urllib.request.Request(u, headers={'User-Agent': 'Mozilla/5.0', 'Cache-Control': 'no-cache'})
-                with urllib.request.urlopen(req, timeout=2) as resp:
-                    data = resp.read()
-                arr = np.frombuffer(data, dtype=np.uint8)
-                img = cv2.imdecode(arr, cv2.IMREAD_COLOR)
-                if img is not None:
-                    with lock:
-                        current_frame = img.copy()
-            except Exception:
-                pass
-        else:
-            try:
-                if camera is not None:
-                    ok, frm = camera.read()
-                    if ok and frm is not None:
-                        with lock:
-                            current_frame = frm.copy()
-            except Exception:
-                pass
-        if current_frame is None:
-            return jsonify({'status': 'error', 'message': 'No frame captured'})
-    
-    with lock:
-        frame_to_process = current_frame.copy()
-        
-    mode = request.form.get('mode') or request.args.get('mode') or 'accurate'
+    frame_to_process = latest_frame(timeout=2.0)
+    if frame_to_process is None:
+        return jsonify({'status': 'error', 'message': 'No frame captured'})
+
+    # Client-supplied; anything but 'fast' is 'accurate' (it also labels metrics).
+    mode = scan_pipeline.normalize_mode(request.form.get('mode') or request.args.get('mode'))
     preview_flag = request.form.get('preview') or request.args.get('preview')
     preview = False
     if preview_flag:
         val = str(preview_flag).lower()
         preview = val in ['1', 'true', 'yes']
-    if mode == 'fast':
-        results = []
-        segments = ocr_engine.extract_segments_fast(frame_to_process)
-        matched_med = None
-        all_meds = database.get_all_medicines()
-        med_names = [med[1] for med in all_meds]
-        aggregated = {}
-        ignored_words = [
-            'tablet', 'capsule', 'mg', 'ml', 'exp', 'mfg', 'batch', 'price', 'rs', 'usp', 'ip', 'bp',
-            'pv', 'ltd', 'pharmaceuticals', 'india', 'store', 'cool', 'dry', 'place', 'dosage',
-            'keep', 'reach', 'children', 'composition', 'marketed', 'manufactured', 'net', 'content',
-            'transaction', 'expedience', 'offeric', 'warning', 'schedule', 'prescription',
-            'incl', 'taxes', 'all', 'b.no', 'date', 'regd', 'trade', 'mark', 'limited', 'pvt',
-            'medication', 'physician', 'directed', 'temperature', 'protect', 'light', 'moisture',
-            'not', 'for', 'use', 'only', 'sale', 'retail', 'wholesale', 'distributor', 'logistics',
-            'caution', 'practitioner', 'registered', 'medical', 'trihydrate', 'zyshield', 'zydus',
-            'german', 'remedies', 'division', 'industrial', 'estate', 'ahmedabad', 'gujarat'
-        ]
-        for detected_text in segments:
-            cleaned_text = detected_text.lower()
-            for word in ignored_words:
-                cleaned_text = cleaned_text.replace(word, ' ')
-            cleaned_text = ''.join(e for e in cleaned_text if e.isalnum() or e.isspace())
-            cleaned_text = " ".join(cleaned_text.split())
-            if len(cleaned_text) < 3:
-                continue
-            best_match, score = process.extractOne(cleaned_text, med_names, scorer=fuzz.token_set_ratio)
-            final_match = None
-            if score >= 70:
-                final_match = best_match
-            if final_match:
-                for med in all_meds:
-                    if med[1] == final_match:
-                        matched_med = med
-                        break
-            if not matched_med:
-                created = database.ensure_medicine(cleaned_text.title())
-                if created:
-                    matched_med = created
-            if matched_med:
-                med_id = matched_med[0]
-                name = matched_med[1]
-                price = matched_med[4]
-                stock = matched_med[5]
-                if stock > 0:
-                    entry = aggregated.get(name)
-                    if not entry:
-                        aggregated[name] = {'id': med_id, 'price': price, 'count': 1, 'stock': stock}
-                    else:
-                        entry['count'] += 1
-                else:
-                    results.append({'status': 'error','medicine': name,'message': 'Out of stock','debug_text': detected_text})
-        if not aggregated and not results:
-            return jsonify({'status': 'warning', 'message': 'No text detected'})
-        if preview:
-            preview_items = []
-            for name, entry in aggregated.items():
-                preview_items.append({'id': entry['id'], 'medicine': name, 'price': entry['price'], 'available': entry['stock'], 'suggested_qty': entry['count']})
-            return jsonify({'preview': True, 'matches': preview_items})
-        for name, entry in aggregated.items():
-            qty = entry['count']
-            unit_price = entry['price']
-            med_row = database.get_medicine_by_id(entry['id'])
-            discount = float(med_row[6] if med_row and len(med_row) > 6 else 0.0)
-            allocations = database.reduce_stock_fefo(entry['id'], qty)
-            total = 0.0
-            for a in allocations:
-                part_total = unit_price * a['qty'] * (1 - discount/100.0)
-                total += part_total
-                database.record_sale_extended(entry['id'], name, a['qty'], part_total, discount, a['mfg_date'], a['exp_date'], a.get('batch_id'))
-            results.append({'status': 'success','medicine': name,'qty': qty,'price': unit_price,'total': total,'message': 'Added to bill'})
-        return jsonify({'results': results})
-    
-    _, detections = detector.detect(frame_to_process)
-    
-    results = []
-    aggregated = {}
-    
-    if not detections:
-        pass
-
-    found_any_match = False
-
-    for det in detections:
-        crop = det['crop']
-        matched_med = None
-        all_meds = database.get_all_medicines()
-        med_names = [med[1] for med in all_meds]
-        ignored_words = [
-            'tablet', 'capsule', 'mg', 'ml', 'exp', 'mfg', 'batch', 'price', 'rs', 'usp', 'ip', 'bp',
-            'pv', 'ltd', 'pharmaceuticals', 'india', 'store', 'cool', 'dry', 'place', 'dosage',
-            'keep', 'reach', 'children', 'composition', 'marketed', 'manufactured', 'net', 'content',
-            'transaction', 'expedience', 'offeric', 'warning', 'schedule', 'prescription',
-            'incl', 'taxes', 'all', 'b.no', 'date', 'regd', 'trade', 'mark', 'limited', 'pvt',
-            'medication', 'physician', 'directed', 'temperature', 'protect', 'light', 'moisture',
-            'not', 'for', 'use', 'only', 'sale', 'retail', 'wholesale', 'distributor', 'logistics',
-            'caution', 'practitioner', 'registered', 'medical', 'trihydrate', 'zyshield', 'zydus',
-            'german', 'remedies', 'division', 'industrial', 'estate', 'ahmedabad', 'gujarat'
-        ]
-
-        segments = ocr_engine.extract_segments_fast(crop)
-        if not segments:
-            segments = ocr_engine.extract_segments_multiangle(crop)
-        for detected_text in segments:
-            cleaned_text = detected_text.lower()
-            for word in ignored_words:
-                cleaned_text = cleaned_text.replace(word, ' ')
-            cleaned_text = ''.join(e for e in cleaned_text if e.isalnum() or e.isspace())
-            cleaned_text = " ".join(cleaned_text.split())
-            if len(cleaned_text) < 3:
-                continue
-            if len(cleaned_text.split()) > 8:
-                continue
-            best_match, score = process.extractOne(cleaned_text, med_names, scorer=fuzz.token_set_ratio)
-            final_match = None
-            if score >= 70:
-                final_match = best_match
-            else:
-                words = cleaned_text.split()
-                best_word_score = 0
-                best_word_match = None
-                for word in words:
-                    if len(word) < 4:
-                        continue
-                    match, s = process.extractOne(word, med_names, scorer=fuzz.ratio)
-                    if s > best_word_score:
-                        best_word_score = s
-                        best_word_match = match
-                if best_word_score >= 85:
-                    final_match = best_word_match
-            if final_match:
-                for med in all_meds:
-                    if med[1] == final_match:
-                        matched_med = med
-                        break
-            if not matched_med:
-                created = database.ensure_medicine(cleaned_text.title())
-                if created:
-                    matched_med = created
-            if matched_med:
-                found_any_match = True
-                med_id = matched_med[0]
-                name = matched_med[1]
-                price = matched_med[4]
-                stock = matched_med[5]
-                if stock > 0:
-                    entry = aggregated.get(name)
-                    if not entry:
-                        aggregated[name] = {'id': med_id, 'price': price, 'count': 1, 'stock': stock}
-                    else:
-                        entry['count'] += 1
-                else:
-                    results.append({'status': 'error','medicine': name,'message': 'Out of stock','debug_text': detected_text})
-
-    if not aggregated and not results:
-        segments = ocr_engine.extract_segments_fast(frame_to_process)
-        if not segments:
-            segments = ocr_engine.extract_segments_multiangle(frame_to_process)
-        if not segments or len(segments) == 0:
-            full_text = ocr_engine.extract_text(frame_to_process)
-            if full_text and len(full_text.strip()) > 0:
-                segments = [full_text]
-            else:
-                return jsonify({'status': 'warning', 'message': 'No text detected'})
-        matched_med = None
-        all_meds = database.get_all_medicines()
-        med_names = [med[1] for med in all_meds]
-        ignored_words = [
-            'tablet', 'capsule', 'mg', 'ml', 'exp', 'mfg', 'batch', 'price', 'rs', 'usp', 'ip', 'bp',
-            'pv', 'ltd', 'pharmaceuticals', 'india', 'store', 'cool', 'dry', 'place', 'dosage',
-            'keep', 'reach', 'children', 'composition', 'marketed', 'manufactured', 'net', 'content',
-            'transaction', 'expedience', 'offeric', 'warning', 'schedule', 'prescription',
-            'incl', 'taxes', 'all', 'b.no', 'date', 'regd', 'trade', 'mark', 'limited', 'pvt',
-            'medication', 'physician', 'directed', 'temperature', 'protect', 'light', 'moisture',
-            'not', 'for', 'use', 'only', 'sale', 'retail', 'wholesale', 'distributor', 'logistics',
-            'caution', 'practitioner', 'registered', 'medical', 'trihydrate', 'zyshield', 'zydus',
-            'german', 'remedies', 'division', 'industrial', 'estate', 'ahmedabad', 'gujarat'
-        ]
-        for detected_text in segments:
-            cleaned_text = detected_text.lower()
-            for word in ignored_words:
-                cleaned_text = cleaned_text.replace(word, ' ')
-            cleaned_text = ''.join(e for e in cleaned_text if e.isalnum() or e.isspace())
-            cleaned_text = " ".join(cleaned_text.split())
-            if len(cleaned_text) < 3:
-                continue
-            if len(cleaned_text.split()) > 12:
-                continue
-            best_match, score = process.extractOne(cleaned_text, med_names, scorer=fuzz.token_set_ratio)
-            final_match = None
-            if score >= 70:
-                final_match = best_match
-            else:
-                words = cleaned_text.split()
-                best_word_score = 0
-                best_word_match = None
-                for word in words:
-                    if len(word) < 4:
-                        continue
-                    match, s = process.extractOne(word, med_names, scorer=fuzz.ratio)
-                    if s > best_word_score:
-                        best_word_score = s
-                        best_word_match = match
-                if best_word_score >= 85:
-                    final_match = best_word_match
-            if final_match:
-                for med in all_meds:
-                    if med[1] == final_match:
-                        matched_med = med
-                        break
-            if not matched_med:
-                created = database.ensure_medicine(cleaned_text.title())
-                if created:
-                    matched_med = created
-            if matched_med:
-                med_id = matched_med[0]
-                name = matched_med[1]
-                price = matched_med[4]
-                stock = matched_med[5]
-                if stock > 0:
-                    entry = aggregated.get(name)
-                    if not entry:
-                        aggregated[name] = {'id': med_id, 'price': price, 'count': 1, 'stock': stock}
-                    else:
-                        entry['count'] += 1
-                else:
-                    results.append({'status': 'error','medicine': name,'message': 'Out of stock','debug_text': detected_text})
-        if not aggregated and not results:
-            return jsonify({'status': 'warning', 'message': 'Medicine name not recognized from text.'})
-    if preview:
-        preview_items = []
-        for name, entry in aggregated.items():
-            preview_items.append({'id': entry['id'], 'medicine': name, 'price': entry['price'], 'available': entry['stock'], 'suggested_qty': entry['count']})
-        return jsonify({'preview': True, 'matches': preview_items})
-    for name, entry in aggregated.items():
-        qty = entry['count']
-        unit_price = entry['price']
-        med_row = database.get_medicine_by_id(entry['id'])
-        discount = float(med_row[6] if med_row and len(med_row) > 6 else 0.0)
-        allocations = database.reduce_stock_fefo(entry['id'], qty)
-        total = 0.0
-        for a in allocations:
-            part_total = unit_price * a['qty'] * (1 - discount/100.0)
-            total += part_total
-            database.record_sale_extended(entry['id'], name, a['qty'], part_total, discount, a['mfg_date'], a['exp_date'], a.get('batch_id'))
-        results.append({'status': 'success','medicine': name,'qty': qty,'price': unit_price,'total': total,'message': 'Added to bill'})
-    
-    return jsonify({'results': results})
+    # timings=1 adds per-stage milliseconds to the response.
+    want_timings = str(request.form.get('timings') or request.args.get('timings') or '').lower() in ['1', 'true', 'yes']
+    timings = {} if want_timings else None
+    fused = fused_recognitions() if mode != 'fast' else None
+    if fused:
+        payload = scan_pipeline.scan_fused(fused, preview=preview, timings=timings)
+    else:
+        payload = scan_pipeline.scan_frame(frame_to_process, detector, ocr_engine, mode=mode, preview=preview, timings=timings)
+    if want_timings:
+        payload['timings'] = {stage: round(ms, 2) for stage, ms in timings.items()}
+    return jsonify(payload)
 
 @app.route('/sales_data')
 def sales_data():
@@ -774,6 +666,7 @@ def bill_items():
         results = []
         if not items:
             return jsonify({'status': 'error', 'message': 'No items provided'})
+        catalog = database.get_catalog()
         for it in items:
             med_id = it.get('id')
             raw_qty = it.get('qty', 1)
@@ -785,11 +678,7 @@ def bill_items():
                 qty = 1
             med = None
             if med_id:
-                rows = database.get_all_medicines()
-                for r in rows:
-                    if r[0] == med_id:
-                        med = r
-                        break
+                med = catalog.by_id.get(med_id)
             if not med:
                 name = it.get('name')
                 if not name:
@@ -803,8 +692,7 @@ def bill_items():
             name = med[1]
             price = med[4]
             stock = med[5]
-            med_row = database.get_medicine_by_id(med_id)
-            discount = float(med_row[6] if med_row and len(med_row) > 6 else 0.0)
+            discount = float(med[6] if len(med) > 6 and med[6] is not None else 0.0)
             database.add_receipt_item(rid, med_id, name, qty, price, discount)
             line_total = price * qty * (1 - discount/100.0)
             results.append({'status': 'success', 'medicine': name, 'qty': qty, 'price': price, 'total': line_total})
@@ -838,15 +726,36 @@ def report():
         history.append({'id': r[0], 'number': r[1], 'customer': r[2], 'payment': r[4], 'total': r[5], 'printed': bool(r[6]), 'time': r[7]})
     return jsonify({'summary': out, 'batches': b, 'current_receipt': current, 'history': history})
 
+
+# Progress imports above this size spool to disk instead of memory.
+IMPORT_SPOOL_BYTES = int(os.environ.get('IMPORT_SPOOL_BYTES', str(8 * 1024 * 1024)))
+
+
 @app.route('/import_dataset', methods=['POST'])
 def import_dataset():
     f = request.files.get('file')
     if not f:
         return jsonify({'status': 'error', 'message': 'No file provided'}), 400
+    if (request.values.get('progress') or '').lower() in ('1', 'true', 'yes'):
+        # The upload is closed once this view returns, before the response
+        # body is generated; copy it to a spool the generator owns.
+        spool = tempfile.SpooledTemporaryFile(max_size=IMPORT_SPOOL_BYTES)
+        shutil.copyfileobj(f.stream, spool)
+        spool.seek(0)
+
+        def gen():
+            try:
+                for stats in database.iter_import_csv(spool):
+                    yield json.dumps({'status': 'progress', **stats}) + '\n'
+                yield json.dumps({'status': 'success', 'message': 'Dataset imported', **stats}) + '\n'
+            except Exception as e:
+                yield json.dumps({'status': 'error', 'message': str(e)}) + '\n'
+            finally:
+                spool.close()
+        return Response(stream_with_context(gen()), mimetype='application/x-ndjson')
     try:
-        content = f.read().decode('utf-8')
-        database.import_csv_text(content)
-        return jsonify({'status': 'success', 'message': 'Dataset imported'})
+        stats = database.import_csv_stream(f.stream)
+        return jsonify({'status': 'success', 'message': 'Dataset imported', **stats})
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 400
 
@@ -997,122 +906,211 @@ def print_receipt():
     except Exception as e:
         return jsonify({'status': 'error', 'message': f'Finalize failed: {str(e)}'}), 400
 
+# Uploaded prescription photos are shrunk to RX_MAX_SIDE px on ingest; phone
+# cameras produce 4000+ px images that OCR no better than 2000 px ones.
+# async=1 runs the scan on a background job (RX_JOB_WORKERS threads, at most
+# RX_MAX_JOBS queued or running) and returns a job id to poll or stream.
+RX_MAX_SIDE = int(os.environ.get('RX_MAX_SIDE', 2000))
+prescription_jobs = JobQueue(
+    workers=int(os.environ.get('RX_JOB_WORKERS', 2)),
+    max_pending=int(os.environ.get('RX_MAX_JOBS', 8)),
+    name='rx-job',
+)
+# Longest long-poll (GET .../jobs/<id>?wait=N) one request may hold open.
+RX_MAX_WAIT = 30.0
+
+def _decode_upload(data, max_side=RX_MAX_SIDE):
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if img is None or not max_side:
+        return img
+    h, w = img.shape[:2]
+    if max(h, w) > max_side:
+        scale = max_side / float(max(h, w))
+        img = cv2.resize(img, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+    return img
+
+def _process_prescription(img):
+    """OCR and match a prescription image; returns the JSON payload."""
+    segments = ocr_engine.extract_segments_robust(img)
+    logger.debug("Prescription scan: %d segments", len(segments))
+    
+    items = []
+    catalog = database.get_catalog()
+    med_matcher = matcher.for_catalog(catalog)
+    seen = set()
+
+    def match_and_add(text):
+        cleaned = _normalize_text(text)
+        if len(cleaned) < 3:
+            return False
+        
+        # Token set ratio match, then word-level fallback
+        name = med_matcher.match(cleaned)
+        
+        if name and name not in seen:
+            seen.add(name)
+            row = catalog.by_name.get(name)
+            if row:
+                items.append({
+                    'name': name,
+                    'manufacturer': row[2],
+                    'dosage': row[3],
+                    'price': row[4],
+                    'stock': row[5]
+                })
+                return True
+        return False
+
+    # Try segments first
+    if segments:
+        for seg in segments:
+            match_and_add(seg)
+
+    # If few matches, try full text OCR
+    if len(items) < 2:
+        logger.debug("Prescription scan: few matches, trying full-text OCR")
+        full_text = ocr_engine.extract_text(img)
+        if full_text:
+            # Split by lines or common delimiters
+            parts = re.split(r'[\r\n,]+', full_text)
+            for p in parts:
+                match_and_add(p)
+
+    if not items:
+        return {'status': 'warning', 'message': 'No medicines recognized in prescription', 'items': []}
+    pres_map = {}
+    for it in items:
+        pres_map[it['name']] = True
+    global CURRENT_PRESCRIPTION
+    CURRENT_PRESCRIPTION = pres_map
+    return {'status': 'success', 'items': items}
+
+def _prescription_job(data, frame):
+    img = _decode_upload(data) if data else None
+    if img is None:
+        img = frame
+    if img is None:
+        return {'status': 'error', 'message': 'No image to scan'}
+    return _process_prescription(img)
+
+def _job_view(job):
+    view = {'job_id': job['id'], 'status': job['status']}
+    if job['status'] == 'done':
+        view['result'] = job['result']
+    elif job['status'] == 'error':
+        view['message'] = job['error']
+    return view
+
 @app.route('/scan_prescription', methods=['POST'])
 def scan_prescription():
     try:
-        img = None
         file = request.files.get('image')
-        if file:
-            data = np.frombuffer(file.read(), dtype=np.uint8)
-            img = cv2.imdecode(data, cv2.IMREAD_COLOR)
+        data = file.read() if file else None
+        async_flag = str(request.form.get('async') or request.args.get('async') or '').lower() in ['1', 'true', 'yes']
+        if async_flag:
+            # Grab the camera frame now, as the user pressed scan.
+            frame = None if data else latest_frame()
+            if not data and frame is None:
+                return jsonify({'status': 'error', 'message': 'No image to scan'}), 400
+            job_id = prescription_jobs.submit(_prescription_job, data, frame)
+            return jsonify({
+                'status': 'queued',
+                'job_id': job_id,
+                'poll_url': f'/scan_prescription/jobs/{job_id}',
+                'events_url': f'/scan_prescription/jobs/{job_id}/events',
+            }), 202
+        img = _decode_upload(data) if data else None
         if img is None:
-            with lock:
-                if current_frame is not None:
-                    img = current_frame.copy()
+            img = latest_frame()
         if img is None:
             return jsonify({'status': 'error', 'message': 'No image to scan'}), 400
-        segments = ocr_engine.extract_segments_robust(img)
-        print(f"DEBUG: Prescription Scan - Found {len(segments)} segments")
-        
-        items = []
-        all_meds = database.get_all_medicines()
-        med_names = [m[1] for m in all_meds]
-        seen = set()
-
-        def match_and_add(text):
-            cleaned = _normalize_text(text)
-            if len(cleaned) < 3:
-                return False
-            
-            # 1. Token set ratio match
-            best = process.extractOne(cleaned, med_names, scorer=fuzz.token_set_ratio)
-            name = None
-            if best and best[1] >= 70:
-                name = best[0]
-            
-            # 2. Word-level fallback
-            if not name:
-                parts = cleaned.split()
-                best_score = 0
-                best_word = None
-                for w in parts:
-                    if len(w) < 4:
-                        continue
-                    res = process.extractOne(w, med_names, scorer=fuzz.ratio)
-                    if res and res[1] > best_score:
-                        best_score = res[1]
-                        best_word = res[0]
-                if best_score >= 85:
-                    name = best_word
-            
-            if name and name not in seen:
-                seen.add(name)
-                row = next((m for m in all_meds if m[1] == name), None)
-                if row:
-                    items.append({
-                        'name': name,
-                        'manufacturer': row[2],
-                        'dosage': row[3],
-                        'price': row[4],
-                        'stock': row[5]
-                    })
-                    return True
-            return False
-
-        # Try segments first
-        if segments:
-            for seg in segments:
-                match_and_add(seg)
-
-        # If few matches, try full text OCR
-        if len(items) < 2:
-            print("DEBUG: Low matches, trying full text OCR fallback")
-            full_text = ocr_engine.extract_text(img)
-            if full_text:
-                # Split by lines or common delimiters
-                parts = re.split(r'[\r\n,]+', full_text)
-                for p in parts:
-                    match_and_add(p)
-
-        if not items:
-            return jsonify({'status': 'warning', 'message': 'No medicines recognized in prescription', 'items': []})
-        pres_map = {}
-        for it in items:
-            pres_map[it['name']] = True
-        global CURRENT_PRESCRIPTION
-        CURRENT_PRESCRIPTION = pres_map
-        return jsonify({'status': 'success', 'items': items})
+        return jsonify(_process_prescription(img))
+    except (PoolBusy, JobQueueFull):
+        raise
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 400
 
+@app.route('/scan_prescription/jobs')
+def prescription_jobs_stats():
+    return jsonify(prescription_jobs.stats())
+
+@app.route('/scan_prescription/jobs/<job_id>')
+def prescription_job(job_id):
+    # wait=N long-polls up to N seconds (at most RX_MAX_WAIT) for the job to finish.
+    try:
+        wait = float(request.args.get('wait', 0) or 0)
+    except ValueError:
+        wait = None
+    if wait is None or not wait >= 0:
+        return jsonify({'status': 'error', 'message': 'wait must be a non-negative number of seconds'}), 400
+    wait = min(wait, RX_MAX_WAIT)
+    job = prescription_jobs.get(job_id)
+    if job is None:
+        return jsonify({'status': 'error', 'message': 'Unknown or expired job'}), 404
+    deadline = time.time() + wait
+    while job is not None and job['status'] in ('queued', 'running') and time.time() < deadline:
+        job = prescription_jobs.wait(job_id, job['status'], timeout=deadline - time.time())
+    if job is None:
+        return jsonify({'status': 'error', 'message': 'Unknown or expired job'}), 404
+    return jsonify(_job_view(job))
+
+@app.route('/scan_prescription/jobs/<job_id>/events')
+def prescription_job_events(job_id):
+    if prescription_jobs.get(job_id) is None:
+        return jsonify({'status': 'error', 'message': 'Unknown or expired job'}), 404
+
+    def gen():
+        status = None
+        while True:
+            job = prescription_jobs.wait(job_id, status, timeout=15.0)
+            if job is None:
+                yield 'event: error\ndata: {"status": "error", "message": "Unknown or expired job"}\n\n'
+                return
+            if job['status'] == status:
+                yield ': keep-alive\n\n'
+                continue
+            status = job['status']
+            yield f"data: {json.dumps(_job_view(job))}\n\n"
+            if status in ('done', 'error'):
+                return
+
+    return Response(stream_with_context(gen()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/detect_strip', methods=['GET'])
 def detect_strip():
     try:
-        frame = None
-        with lock:
-            if current_frame is not None:
-                frame = current_frame.copy()
+        catalog = database.get_catalog()
+        fused = fused_recognitions()
+        if fused:
+            out = []
+            for rec in fused:
+                row = catalog.by_name.get(rec['medicine'])
+                if row:
+                    out.append({'medicine': rec['medicine'], 'manufacturer': row[2], 'dosage': row[3], 'price': row[4], 'stock': row[5]})
+            if out:
+                return jsonify({'status': 'success', 'matches': out, 'source': 'rolling'})
+        frame = latest_frame()
         if frame is None:
             return jsonify({'status': 'error', 'message': 'No frame available'}), 400
         _, detections = detector.detect(frame)
-        all_meds = database.get_all_medicines()
-        med_names = [m[1] for m in all_meds]
+        med_matcher = matcher.for_catalog(catalog)
         out = []
-        for det in detections:
+        crop_segments = ocr_engine.extract_segments_batch([det['crop'] for det in detections])
+        for det, segs in zip(detections, crop_segments):
             crop = det['crop']
-            segs = ocr_engine.extract_segments_fast(crop) or ocr_engine.extract_segments_multiangle(crop)
+            segs = segs or ocr_engine.extract_segments_multiangle(crop, accept=scan_pipeline.catalog_accept(med_matcher))
             matched = None
             for t in segs:
                 cleaned = _normalize_text(t)
                 if len(cleaned) < 3:
                     continue
-                best = process.extractOne(cleaned, med_names, scorer=fuzz.token_set_ratio)
-                if best and best[1] >= 70:
-                    matched = best[0]
+                matched = med_matcher.match(cleaned, word_fallback=False)
+                if matched:
                     break
             if not matched:
                 continue
-            row = next((m for m in all_meds if m[1] == matched), None)
+            row = catalog.by_name.get(matched)
             if not row:
                 continue
             out.append({
@@ -1125,6 +1123,8 @@ def detect_strip():
         if not out:
             return jsonify({'status': 'warning', 'message': 'No strip recognized'})
         return jsonify({'status': 'success', 'matches': out})
+    except PoolBusy:
+        raise
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 400
 
@@ -1205,6 +1205,5 @@ def get_medicine_info():
 
 if __name__ == '__main__':
     # Use environment variable for port if available (for Render)
-    import os
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=False, use_reloader=False, threaded=True)
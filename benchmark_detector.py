@@ -0,0 +1,120 @@
+import os
+import json
+import time
+import argparse
+import threading
+
+import cv2
+import numpy as np
+
+from detector import MedicineDetector, BACKENDS
+
+
+def load_frames(images_dir, limit, width, height):
+    frames = []
+    if images_dir:
+        for fn in sorted(os.listdir(images_dir)):
+            if not fn.lower().endswith((".jpg", ".jpeg", ".png", ".bmp")):
+                continue
+            img = cv2.imread(os.path.join(images_dir, fn))
+            if img is not None:
+                frames.append(img)
+            if len(frames) >= limit:
+                break
+    if not frames:
+        # Synthetic camera-sized frames when no images are given.
+        rng = np.random.default_rng(0)
+        frames = [rng.integers(0, 255, (height, width, 3), dtype=np.uint8) for _ in range(min(limit, 8))]
+    return frames
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else 0.0
+
+
+def bench_backend(backend, model_path, frames, runs, warmup, threads):
+    # cache_size=0: every call must run the model.
+    detector = MedicineDetector(model_path=model_path, backend=backend, cache_size=0)
+    t0 = time.perf_counter()
+    detector.get_model()
+    load_s = time.perf_counter() - t0
+    for i in range(warmup):
+        detector.detect(frames[i % len(frames)])
+
+    latencies = []
+    detections = 0
+    start = time.perf_counter()
+    for i in range(runs):
+        t = time.perf_counter()
+        _, dets = detector.detect(frames[i % len(frames)])
+        latencies.append((time.perf_counter() - t) * 1000.0)
+        detections += len(dets)
+    seq_elapsed = time.perf_counter() - start
+
+    result = {
+        "backend": backend,
+        "load_s": round(load_s, 2),
+        "runs": runs,
+        "mean_ms": round(float(np.mean(latencies)), 2),
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p95_ms": round(percentile(latencies, 95), 2),
+        "fps": round(runs / seq_elapsed, 2),
+        "avg_detections": round(detections / runs, 2),
+    }
+
+    if threads > 1:
+        counter = {"n": 0}
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                with lock:
+                    if counter["n"] >= runs:
+                        return
+                    i = counter["n"]
+                    counter["n"] += 1
+                detector.detect(frames[i % len(frames)])
+
+        start = time.perf_counter()
+        pool = [threading.Thread(target=worker) for _ in range(threads)]
+        for t in pool:
+            t.start()
+        for t in pool:
+            t.join()
+        result[f"fps_{threads}_threads"] = round(runs / (time.perf_counter() - start), 2)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare MedicineDetector backends on CPU.")
+    parser.add_argument("--model", default="yolov8n.pt", help="Model (.pt, or .onnx for the onnx backend only).")
+    parser.add_argument("--backends", default=",".join(BACKENDS), help="Comma-separated backends to compare.")
+    parser.add_argument("--images", default=None, help="Folder of sample frames (default: synthetic 1280x720).")
+    parser.add_argument("--runs", type=int, default=50, help="Timed detections per backend.")
+    parser.add_argument("--warmup", type=int, default=5, help="Untimed detections before measuring.")
+    parser.add_argument("--threads", type=int, default=1, help="Also measure throughput with this many threads.")
+    parser.add_argument("--output", default=None, help="Optional JSON file for the results.")
+    args = parser.parse_args()
+
+    frames = load_frames(args.images, max(args.runs, 1), 1280, 720)
+    results = []
+    for backend in [b.strip() for b in args.backends.split(",") if b.strip()]:
+        try:
+            res = bench_backend(backend, args.model, frames, args.runs, args.warmup, args.threads)
+        except Exception as e:
+            res = {"backend": backend, "error": str(e)}
+        results.append(res)
+        print(json.dumps(res))
+
+    ok = [r for r in results if "error" not in r]
+    if ok:
+        print(f"\n{'backend':<10} {'load s':>7} {'mean ms':>8} {'p50 ms':>7} {'p95 ms':>7} {'fps':>7}")
+        for r in ok:
+            print(f"{r['backend']:<10} {r['load_s']:>7} {r['mean_ms']:>8} {r['p50_ms']:>7} {r['p95_ms']:>7} {r['fps']:>7}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+
+import numpy as np
+
+import database
+import scan_pipeline
+from detector import MedicineDetector
+from ocr_engine import OCREngine
+from benchmark_detector import load_frames, percentile
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is KiB on Linux, bytes on macOS.
+    return round(rss / (1024.0 * 1024.0) if sys.platform == "darwin" else rss / 1024.0, 1)
+
+
+def git_commit():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        return out.stdout.strip() or None
+    except Exception:
+        return None
+
+
+def use_scratch_db(workdir):
+    # Billing reduces stock; run against a copy so the real database is untouched.
+    scratch = os.path.join(workdir, "bench.db")
+    if os.path.exists(database.DB_NAME):
+        shutil.copyfile(database.DB_NAME, scratch)
+    database.DB_NAME = scratch
+    database.init_db()
+    return scratch
+
+
+def summarize(values):
+    return {
+        "p50": round(percentile(values, 50), 2),
+        "p95": round(percentile(values, 95), 2),
+        "p99": round(percentile(values, 99), 2),
+        "mean": round(float(np.mean(values)), 2) if values else 0.0,
+    }
+
+
+def scan_once(frame, detector, ocr_engine, mode, preview):
+    timings = {}
+    t = time.perf_counter()
+    payload = scan_pipeline.scan_frame(frame, detector, ocr_engine, mode=mode, preview=preview, timings=timings)
+    timings["total"] = (time.perf_counter() - t) * 1000.0
+    return timings, payload
+
+
+def bench_mode(mode, detector, ocr_engine, frames, runs, warmup, concurrency, preview):
+    for i in range(warmup):
+        scan_once(frames[i % len(frames)], detector, ocr_engine, mode, preview)
+
+    per_stage = {stage: [] for stage in scan_pipeline.STAGES + ("total",)}
+    outcomes = {}
+    start = time.perf_counter()
+    for i in range(runs):
+        timings, payload = scan_once(frames[i % len(frames)], detector, ocr_engine, mode, preview)
+        for stage in per_stage:
+            per_stage[stage].append(timings.get(stage, 0.0))
+        kind = payload.get("status") or ("preview" if payload.get("preview") else "billed")
+        outcomes[kind] = outcomes.get(kind, 0) + 1
+    seq_elapsed = time.perf_counter() - start
+
+    result = {
+        "mode": mode,
+        "runs": runs,
+        "latency_ms": {stage: summarize(values) for stage, values in per_stage.items()},
+        "throughput": {"1": round(runs / seq_elapsed, 2)},
+        "outcomes": outcomes,
+    }
+
+    for threads in concurrency:
+        if threads <= 1:
+            continue
+        counter = {"n": 0}
+        lock = threading.Lock()
+        totals = []
+
+        def worker():
+            while True:
+                with lock:
+                    if counter["n"] >= runs:
+                        return
+                    i = counter["n"]
+                    counter["n"] += 1
+                timings, _ = scan_once(frames[i % len(frames)], detector, ocr_engine, mode, preview)
+                with lock:
+                    totals.append(timings["total"])
+
+        start = time.perf_counter()
+        pool = [threading.Thread(target=worker) for _ in range(threads)]
+        for t in pool:
+            t.start()
+        for t in pool:
+            t.join()
+        result["throughput"][str(threads)] = round(runs / (time.perf_counter() - start), 2)
+        result.setdefault("latency_ms_concurrent", {})[str(threads)] = summarize(totals)
+    return result
+
+
+def compare(results, baseline_path, tolerance):
+    """Print p95 total latency against a previous results file; return regressions."""
+    with open(baseline_path) as f:
+        baseline = {r["mode"]: r for r in json.load(f).get("modes", [])}
+    regressions = []
+    for r in results:
+        base = baseline.get(r["mode"])
+        if not base:
+            continue
+        old = base["latency_ms"]["total"]["p95"]
+        new = r["latency_ms"]["total"]["p95"]
+        change = (new - old) / old if old else 0.0
+        print(f"{r['mode']:<9} p95 total {old:>9.2f} -> {new:>9.2f} ms ({change:+.1%})")
+        if change > tolerance:
+            regressions.append(r["mode"])
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded strip images through the /scan pipeline.")
+    parser.add_argument("--images", default=None, help="Folder of recorded frames (default: synthetic 1280x720).")
+    parser.add_argument("--modes", default="fast,accurate", help="Comma-separated scan modes.")
+    parser.add_argument("--runs", type=int, default=30, help="Timed scans per mode.")
+    parser.add_argument("--warmup", type=int, default=3, help="Untimed scans before measuring.")
+    parser.add_argument("--concurrency", default="1,2,4", help="Comma-separated thread counts for throughput.")
+    parser.add_argument("--model", default="yolov8n.pt", help="YOLO model path.")
+    parser.add_argument("--backend", default="torch", help="Detector backend (torch, onnx, openvino).")
+    parser.add_argument("--cache", action="store_true", help="Keep the detection/OCR result caches on.")
+    parser.add_argument("--preview", action="store_true", help="Skip billing (no stock updates).")
+    parser.add_argument("--output", default=None, help="JSON file for the results.")
+    parser.add_argument("--baseline", default=None, help="Earlier --output file to compare against.")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Allowed p95 slowdown vs the baseline.")
+    args = parser.parse_args()
+
+    frames = load_frames(args.images, max(args.runs, 1), 1280, 720)
+    workdir = tempfile.mkdtemp(prefix="scan-bench-")
+    try:
+        use_scratch_db(workdir)
+        # Caches off by default so every scan runs the models.
+        detector = MedicineDetector(model_path=args.model, backend=args.backend, cache_size=8 if args.cache else 0)
+        ocr_engine = OCREngine(cache_size=256 if args.cache else 0)
+
+        concurrency = [int(c) for c in args.concurrency.split(",") if c.strip()]
+        results = []
+        for mode in [m.strip() for m in args.modes.split(",") if m.strip()]:
+            res = bench_mode(mode, detector, ocr_engine, frames, args.runs, args.warmup, concurrency, args.preview)
+            results.append(res)
+            print(json.dumps(res))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"\n{'mode':<9} {'stage':<7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for r in results:
+        for stage, s in r["latency_ms"].items():
+            print(f"{r['mode']:<9} {stage:<7} {s['p50']:>9} {s['p95']:>9} {s['p99']:>9}")
+        print(f"{r['mode']:<9} throughput (scans/s by threads): {r['throughput']}")
+    rss = peak_rss_mb()
+    print(f"peak RSS: {rss} MB")
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "images": args.images,
+        "frames": len(frames),
+        "backend": args.backend,
+        "cache": args.cache,
+        "preview": args.preview,
+        "peak_rss_mb": rss,
+        "modes": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.tolerance)
+        if regressions:
+            print(f"p95 regression beyond {args.tolerance:.0%} in: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,110 @@
 import sqlite3
 import datetime
 import csv
+import codecs
+import io
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import metrics
 
 DB_NAME = "smart_pharmacy.db"
+BUSY_TIMEOUT_MS = 5000
+STATEMENT_CACHE_SIZE = 256
+# How often a cached catalog re-reads catalog_meta to notice writes made by
+# other processes (e.g. sibling gunicorn workers).
+CATALOG_RECHECK_SECONDS = 2.0
+# Transactions touching more medicines than this reload the catalog instead
+# of patching it row by row.
+CATALOG_PATCH_LIMIT = 500
 
-def init_db():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    
+_local = threading.local()
+
+def _open_connection():
+    conn = sqlite3.connect(
+        DB_NAME,
+        timeout=BUSY_TIMEOUT_MS / 1000.0,
+        cached_statements=STATEMENT_CACHE_SIZE,
+    )
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    return conn
+
+def get_connection():
+    """Return this thread's connection, opening it on first use.
+
+    Connections are kept per thread (sqlite3 objects must not cross threads)
+    and per process, so a forked gunicorn worker never reuses a handle it
+    inherited from the master.
+    """
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and (_local.pid != os.getpid() or _local.db_name != DB_NAME):
+        if _local.pid == os.getpid():
+            conn.close()
+        conn = None
+    if conn is None:
+        conn = _open_connection()
+        _local.conn = conn
+        _local.pid = os.getpid()
+        _local.db_name = DB_NAME
+        _local.depth = 0
+        _local.on_commit = []
+        _local.catalog_pending = None
+    return conn
+
+@contextmanager
+def connection(immediate=False):
+    """Yield the thread's pooled connection inside a transaction.
+
+    Nested uses join the outermost block, which commits on success and rolls
+    back on error. ``immediate=True`` takes the write lock at the start
+    (BEGIN IMMEDIATE) for read-then-write sequences like stock allocation.
+    """
+    conn = get_connection()
+    outermost = _local.depth == 0
+    if outermost and immediate and not conn.in_transaction:
+        conn.execute("BEGIN IMMEDIATE")
+    _local.depth += 1
+    try:
+        yield conn
+    except BaseException:
+        _local.depth -= 1
+        if outermost:
+            conn.rollback()
+            _local.on_commit = []
+            _local.catalog_pending = None
+        raise
+    _local.depth -= 1
+    if outermost:
+        conn.commit()
+        _local.catalog_pending = None
+        callbacks, _local.on_commit = _local.on_commit, []
+        for fn in callbacks:
+            fn()
+
+def _after_commit(fn):
+    # Must be called inside connection(); runs once the outermost block commits.
+    _local.on_commit.append(fn)
+
+def close_connection():
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and _local.pid == os.getpid():
+        conn.close()
+    _local.conn = None
+
+# Bump SCHEMA_VERSION and append to MIGRATIONS for every schema or data change;
+# init_db runs each pending migration once and records the version it reached.
+SCHEMA_VERSION = 5
+
+# Batch allocation order: earliest expiry first, undated batches last. FEFO
+# queries must use this exact expression to be served by idx_batches_fefo.
+FEFO_ORDER = "CASE WHEN exp_date IS NULL THEN 1 ELSE 0 END, exp_date, id"
+
+def _migrate_base_schema(cursor):
+    # Also brings databases created before schema_version existed up to date.
     # Create Medicines Table
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS medicines (
@@ -27,7 +124,7 @@ def init_db():
         cursor.execute("ALTER TABLE medicines ADD COLUMN mfg_date TEXT")
     if 'exp_date' not in mcols:
         cursor.execute("ALTER TABLE medicines ADD COLUMN exp_date TEXT")
-    
+
     # Create Sales Table
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS sales (
@@ -101,7 +198,30 @@ def init_db():
             FOREIGN KEY (receipt_id) REFERENCES receipts (id)
         )
     ''')
-    
+    cursor.execute("CREATE TABLE IF NOT EXISTS catalog_meta (id INTEGER PRIMARY KEY CHECK (id = 1), version INTEGER NOT NULL)")
+    cursor.execute("INSERT OR IGNORE INTO catalog_meta (id, version) VALUES (1, 0)")
+    _ensure_unique_medicine_names(cursor)
+
+def _ensure_unique_medicine_names(cursor):
+    # The ON CONFLICT(name) upsert used for bulk imports needs a unique index
+    # on name. Older databases may hold duplicate names: merge each group into
+    # its lowest id first, moving batches, sales and receipt lines over and
+    # summing the stock.
+    cursor.execute("SELECT name, MIN(id), SUM(stock) FROM medicines GROUP BY name HAVING COUNT(*) > 1")
+    groups = cursor.fetchall()
+    for name, keep_id, stock in groups:
+        cursor.execute("SELECT id FROM medicines WHERE name = ? AND id != ?", (name, keep_id))
+        dup_ids = [r[0] for r in cursor.fetchall()]
+        placeholders = ",".join("?" * len(dup_ids))
+        for table in ('batches', 'sales', 'receipt_items'):
+            cursor.execute(f"UPDATE {table} SET medicine_id = ? WHERE medicine_id IN ({placeholders})", [keep_id] + dup_ids)
+        cursor.execute(f"DELETE FROM medicines WHERE id IN ({placeholders})", dup_ids)
+        cursor.execute("UPDATE medicines SET stock = ? WHERE id = ?", (stock, keep_id))
+    if groups:
+        print(f"Database updated. Merged {len(groups)} duplicated medicine names.")
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_medicines_name ON medicines(name)")
+
+def _migrate_seed_catalog(cursor):
     # Comprehensive List of Medicines for Detection
     seed_data = [
         # Pain & Fever
@@ -115,7 +235,7 @@ def init_db():
         ("Meftal Spas", "Blue Cross", "500mg", 4.5, 600),
         ("Zerodol-P", "Ipca", "100mg", 5.0, 400),
         ("Disprin", "Reckitt", "325mg", 1.0, 1000),
-        
+    
         # Antibiotics
         ("Azithromycin", "Cipla", "500mg", 25.0, 500),
         ("Augmentin", "GSK", "625mg", 22.0, 300),
@@ -125,7 +245,7 @@ def init_db():
         ("Oflox", "Cipla", "200mg", 7.5, 400),
         ("Taxim-O", "Alkem", "200mg", 12.0, 200),
         ("Moxikind-CV", "Mankind", "625mg", 15.0, 300),
-        
+    
         # Gastric / Acidity
         ("Digene", "Abbott", "Tablet", 1.5, 1000),
         ("Gelusil", "Pfizer", "Tablet", 1.2, 800),
@@ -135,7 +255,7 @@ def init_db():
         ("Pantocid", "Sun Pharma", "40mg", 9.0, 500),
         ("Eno", "GSK", "5g", 8.0, 2000),
         ("Pudin Hara", "Dabur", "Pearls", 2.0, 1500),
-        
+    
         # Cold, Cough & Allergy
         ("Vicks VapoRub", "P&G", "50g", 150.0, 100),
         ("Vicks Action 500", "P&G", "Tablet", 4.0, 500),
@@ -149,7 +269,7 @@ def init_db():
         ("Montair-LC", "Cipla", "Tablet", 12.0, 400),
         ("Otrivin", "GSK", "Nasal Spray", 60.0, 150),
         ("Honitus", "Dabur", "100ml", 90.0, 200),
-        
+    
         # Vitamins & Supplements
         ("Becosules", "Pfizer", "Capsule", 3.0, 1200),
         ("Limcee", "Abbott", "500mg", 2.0, 1500),
@@ -159,7 +279,7 @@ def init_db():
         ("Revital H", "Sun Pharma", "Capsule", 10.0, 500),
         ("Zincovit", "Apex", "Tablet", 5.0, 700),
         ("Gemful", "Tridoss", "Calcitriol+Calcium Carbonate+Zinc Soft Gelatin Capsules", 15.0, 400),
-        
+    
         # Chronic (Diabetes, BP, etc.)
         ("Glycomet", "USV", "500mg", 4.0, 1000),
         ("Telma 40", "Glenmark", "40mg", 8.0, 800),
@@ -173,7 +293,7 @@ def init_db():
         ("Dettol", "Reckitt", "Liquid", 60.0, 500),
         ("Savlon", "ITC", "Liquid", 55.0, 400),
         ("Soframycin", "Sanofi", "Cream", 45.0, 300),
-        
+    
         # Additional common prescription medicines
         ("Combiflam", "Sanofi", "Tablet", 3.0, 1000),
         ("Saridon", "Bayer", "Tablet", 2.5, 1200),
@@ -185,7 +305,7 @@ def init_db():
         ("Speman", "Himalaya", "Tablet", 4.0, 500),
         ("Confido", "Himalaya", "Tablet", 4.5, 600),
         ("Tentex Forte", "Himalaya", "Tablet", 6.0, 400),
-        
+    
         # User Requested Additions
         ("Azicip 500", "Cipla", "500mg", 15.0, 600), # Azithromycin
         ("Azicip 250", "Cipla", "250mg", 9.0, 600),
@@ -193,7 +313,7 @@ def init_db():
         ("Rabucare", "Generic", "Tablet", 10.0, 500),   # Adding corrected spelling just in case
         ("Amoxil 250", "Zydus", "250mg", 6.0, 800),    # From user image
         ("Amoxycillin", "Generic", "250mg", 4.0, 1000), # Generic fallback
-        
+    
         # Additional strip brands
         ("Amoxil 500", "Zydus", "500mg", 8.0, 800),
         ("Augmentin 625", "GSK", "625mg", 24.0, 400),
@@ -211,7 +331,7 @@ def init_db():
         ("Nexpro 40", "Torrent", "40mg", 10.0, 500),
         ("Rabeprazole 20", "Generic", "20mg", 7.0, 700),
         ("Omeprazole 20", "Generic", "20mg", 6.0, 900),
-        
+    
         # Labels from user image
         ("AB PHYLLINE", "Generic", "Capsule", 15.0, 500, 10.0),
         ("AB PHYLLINE SR 200", "Generic", "Tablet", 18.0, 400, 10.0),
@@ -614,406 +734,728 @@ def init_db():
             augmented.append(med)
     seed_data = augmented
 
-    count_added = 0
+    cursor.execute("SELECT name FROM medicines")
+    seen = {row[0] for row in cursor.fetchall()}
+    new_rows = []
     for med in seed_data:
-        cursor.execute("SELECT id, stock FROM medicines WHERE name = ?", (med[0],))
-        existing = cursor.fetchone()
-        if not existing:
-            if len(med) >= 6:
-                if len(med) >= 8:
-                    cursor.execute('''
-                        INSERT INTO medicines (name, manufacturer, dosage, price, stock, discount, mfg_date, exp_date)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                    ''', (med[0], med[1], med[2], med[3], med[4], med[5], med[6], med[7]))
-                    cursor.execute("SELECT id, stock FROM medicines WHERE name = ?", (med[0],))
-                    mid, stk = cursor.fetchone()
-                    cursor.execute("INSERT INTO batches (medicine_id, stock, mfg_date, exp_date, batch_code) VALUES (?, ?, ?, ?, ?)", (mid, stk, med[6], med[7], None))
-                else:
-                    cursor.execute('''
-                        INSERT INTO medicines (name, manufacturer, dosage, price, stock, discount)
-                        VALUES (?, ?, ?, ?, ?, ?)
-                    ''', med)
-            else:
-                cursor.execute('''
-                    INSERT INTO medicines (name, manufacturer, dosage, price, stock)
-                    VALUES (?, ?, ?, ?, ?)
-                ''', med)
-            count_added += 1
-            print(f"Added new medicine: {med[0]}")
-        else:
-            if len(med) >= 6:
-                cursor.execute("UPDATE medicines SET discount = ? WHERE name = ?", (med[5], med[0]))
-            if len(med) >= 8:
-                cursor.execute("UPDATE medicines SET mfg_date = ?, exp_date = ? WHERE name = ?", (med[6], med[7], med[0]))
-                mid, stk = existing
-                cursor.execute("SELECT id FROM batches WHERE medicine_id = ?", (mid,))
-                b = cursor.fetchone()
-                if b:
-                    cursor.execute("UPDATE batches SET mfg_date = ?, exp_date = ? WHERE id = ?", (med[6], med[7], b[0]))
-                else:
-                    cursor.execute("INSERT INTO batches (medicine_id, stock, mfg_date, exp_date) VALUES (?, ?, ?, ?)", (mid, stk, med[6], med[7]))
-    
-    if count_added > 0:
-        print(f"Database updated. Added {count_added} new medicines.")
-    else:
-        print("Database already up to date.")
-    
-    # Ensure Volini has explicit batch dates and discount
-    cursor.execute("SELECT id, stock FROM medicines WHERE name = ?", ("Volini",))
-    vrow = cursor.fetchone()
-    if vrow:
-        mid, stk = vrow
-        cursor.execute("UPDATE medicines SET discount = ? WHERE id = ?", (10.0, mid))
-        cursor.execute("SELECT id FROM batches WHERE medicine_id = ?", (mid,))
-        b = cursor.fetchone()
-        today = datetime.date.today()
-        mfg = (today - datetime.timedelta(days=180)).isoformat()
-        exp = (today + datetime.timedelta(days=720)).isoformat()
-        if b:
-            cursor.execute("UPDATE batches SET mfg_date = ?, exp_date = ? WHERE id = ?", (mfg, exp, b[0]))
-        else:
-            cursor.execute("INSERT INTO batches (medicine_id, stock, mfg_date, exp_date, batch_code) VALUES (?, ?, ?, ?, ?)", (mid, stk, mfg, exp, None))
+        if med[0] not in seen:
+            seen.add(med[0])
+            new_rows.append(med)
+    cursor.executemany('''
+        INSERT INTO medicines (name, manufacturer, dosage, price, stock, discount, mfg_date, exp_date)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', new_rows)
+    cursor.execute('''
+        INSERT INTO batches (medicine_id, stock, mfg_date, exp_date, batch_code)
+        SELECT m.id, m.stock, m.mfg_date, m.exp_date, NULL FROM medicines m
+        WHERE NOT EXISTS (SELECT 1 FROM batches b WHERE b.medicine_id = m.id)
+    ''')
+    if new_rows:
+        print(f"Database updated. Added {len(new_rows)} new medicines.")
 
-    conn.commit()
-    
+def _migrate_normalize_catalog(cursor):
     # Normalize all medicines with uniform discount and dates similar to Dolo 650
     uniform_discount = 10.0
     uniform_mfg = "2024-01-01"
     uniform_exp = "2026-01-01"
-    cursor.execute("SELECT id, stock FROM medicines")
-    for mid, stk in cursor.fetchall():
-        cursor.execute("UPDATE medicines SET discount = ?, mfg_date = ?, exp_date = ? WHERE id = ?", (uniform_discount, uniform_mfg, uniform_exp, mid))
-        cursor.execute("SELECT id FROM batches WHERE medicine_id = ?", (mid,))
-        b = cursor.fetchone()
-        if b:
-            cursor.execute("UPDATE batches SET mfg_date = ?, exp_date = ? WHERE id = ?", (uniform_mfg, uniform_exp, b[0]))
-        else:
-            cursor.execute("INSERT INTO batches (medicine_id, stock, mfg_date, exp_date, batch_code) VALUES (?, ?, ?, ?, ?)", (mid, stk or 0, uniform_mfg, uniform_exp, None))
-    
-    conn.commit()
+    cursor.execute("UPDATE medicines SET discount = ?, mfg_date = ?, exp_date = ?", (uniform_discount, uniform_mfg, uniform_exp))
+    cursor.execute(
+        "UPDATE batches SET mfg_date = ?, exp_date = ? WHERE id IN (SELECT MIN(id) FROM batches GROUP BY medicine_id)",
+        (uniform_mfg, uniform_exp),
+    )
+    cursor.execute('''
+        INSERT INTO batches (medicine_id, stock, mfg_date, exp_date, batch_code)
+        SELECT m.id, COALESCE(m.stock, 0), ?, ?, NULL FROM medicines m
+        WHERE NOT EXISTS (SELECT 1 FROM batches b WHERE b.medicine_id = m.id)
+    ''', (uniform_mfg, uniform_exp))
     cursor.execute("UPDATE batches SET batch_code = COALESCE(batch_code, 'B' || id)")
-    conn.close()
 
+def _migrate_hot_path_indexes(cursor):
+    # The unique medicines(name) index comes from _migrate_base_schema.
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_batches_fefo ON batches (medicine_id, {FEFO_ORDER}, stock, mfg_date, batch_code)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_receipt_items_receipt ON receipt_items (receipt_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sales_medicine_name ON sales (medicine_name, quantity)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sales_timestamp ON sales (timestamp)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_receipts_timestamp ON receipts (timestamp)")
+    cursor.execute("ANALYZE")
+
+MIGRATIONS = [
+    (1, _migrate_base_schema),
+    (2, _migrate_seed_catalog),
+    (3, _migrate_normalize_catalog),
+    (4, _migrate_hot_path_indexes),
+    # Databases migrated while duplicate names blocked the unique index.
+    (5, _ensure_unique_medicine_names),
+]
+
+def _read_schema_version(cursor):
+    try:
+        cursor.execute("SELECT version FROM schema_version WHERE id = 1")
+    except sqlite3.OperationalError:
+        return 0
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+def init_db():
+    # Warm start: a fully migrated database costs a single SELECT.
+    with connection() as conn:
+        if _read_schema_version(conn.cursor()) >= SCHEMA_VERSION:
+            return
+    with connection(immediate=True) as conn:
+        cursor = conn.cursor()
+        cursor.execute("CREATE TABLE IF NOT EXISTS schema_version (id INTEGER PRIMARY KEY CHECK (id = 1), version INTEGER NOT NULL)")
+        # Re-read under the write lock; another worker may have migrated meanwhile.
+        current = _read_schema_version(cursor)
+        for version, migrate in MIGRATIONS:
+            if version > current:
+                migrate(cursor)
+                cursor.execute("INSERT OR REPLACE INTO schema_version (id, version) VALUES (1, ?)", (version,))
+        if current < SCHEMA_VERSION:
+            print(f"Database schema migrated from version {current} to {SCHEMA_VERSION}.")
+            _bump_catalog_version(cursor)
+
+class MedicineCatalog:
+    """In-memory snapshot of the medicines table.
+
+    ``rows`` keeps the SELECT * tuples in table order; ``by_id`` and
+    ``by_name`` index them and ``names`` is the list fed to fuzzy matching.
+    ``version`` changes only when the set of names changes, so consumers that
+    index names can key off it and ignore stock/price patches.
+    """
+
+    def __init__(self, rows, version=0):
+        self.rows = list(rows)
+        self.version = version
+        self.by_id = {r[0]: r for r in self.rows}
+        self.by_name = {}
+        for r in self.rows:
+            # First row wins, like the old linear scans over get_all_medicines().
+            self.by_name.setdefault(r[1], r)
+        self.names = [r[1] for r in self.rows]
+
+    def __len__(self):
+        return len(self.rows)
+
+_catalog = None
+_catalog_db_version = None
+_catalog_checked_at = 0.0
+_catalog_lock = threading.Lock()
+
+def _read_catalog_version(cursor):
+    cursor.execute("SELECT version FROM catalog_meta WHERE id = 1")
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+def _bump_catalog_version(cursor, changed_ids=None):
+    """Record a medicines write in the current transaction.
+
+    The version is bumped once per transaction so other processes notice the
+    change on their next recheck. In this process the cached catalog is
+    patched with the changed rows after commit, or dropped for a full reload
+    when ``changed_ids`` is not given.
+    """
+    pending = _local.catalog_pending
+    if pending is None:
+        cursor.execute("UPDATE catalog_meta SET version = version + 1 WHERE id = 1")
+        pending = {'ids': set(), 'full': False, 'version': _read_catalog_version(cursor)}
+        _local.catalog_pending = pending
+        _after_commit(lambda: _apply_catalog_changes(pending))
+    if changed_ids is None:
+        pending['full'] = True
+    else:
+        pending['ids'].update(changed_ids)
+
+def invalidate_catalog():
+    global _catalog_db_version, _catalog_checked_at
+    with _catalog_lock:
+        _catalog_db_version = None
+        _catalog_checked_at = 0.0
+
+def _apply_catalog_changes(pending):
+    global _catalog, _catalog_db_version
+    ids = pending['ids']
+    with _catalog_lock:
+        cat = _catalog
+        if pending['full'] or len(ids) > CATALOG_PATCH_LIMIT or cat is None or _catalog_db_version != pending['version'] - 1:
+            # Bulk change, or we missed a write from elsewhere: reload lazily.
+            _catalog_db_version = None
+            return
+        placeholders = ",".join("?" * len(ids))
+        with connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"SELECT * FROM medicines WHERE id IN ({placeholders})", list(ids))
+            fresh = {r[0]: r for r in cursor.fetchall()}
+        structural = False
+        for mid in ids:
+            old = cat.by_id.get(mid)
+            new = fresh.get(mid)
+            if old is None or new is None or old[1] != new[1]:
+                structural = True
+                break
+        # Readers hold on to the catalog they got without a lock, so build a
+        # new snapshot and swap it in rather than patching the shared one.
+        # Only a change to the set of names bumps the version.
+        rows = [fresh.get(r[0], r) for r in cat.rows if r[0] not in ids or r[0] in fresh]
+        rows += [r for mid, r in fresh.items() if mid not in cat.by_id]
+        _catalog = MedicineCatalog(rows, cat.version + 1 if structural else cat.version)
+        _catalog_db_version = pending['version']
+
+def get_catalog():
+    """Return the cached MedicineCatalog, loading or refreshing it if needed.
+
+    Only full reloads are recorded in db_call_seconds; the cached return
+    is far too cheap and frequent to share that series.
+    """
+    global _catalog, _catalog_db_version, _catalog_checked_at
+    now = time.monotonic()
+    cat = _catalog
+    if cat is not None and _catalog_db_version is not None and now - _catalog_checked_at < CATALOG_RECHECK_SECONDS:
+        return cat
+    with _catalog_lock:
+        with connection() as conn:
+            cursor = conn.cursor()
+            db_version = _read_catalog_version(cursor)
+            if _catalog is None or _catalog_db_version != db_version:
+                with metrics.DB_SECONDS.time('get_catalog'):
+                    cursor.execute("SELECT * FROM medicines")
+                    rows = cursor.fetchall()
+                    prev = _catalog
+                    version = 0
+                    if prev is not None:
+                        same_names = prev.names == [r[1] for r in rows]
+                        version = prev.version if same_names else prev.version + 1
+                    _catalog = MedicineCatalog(rows, version)
+                _catalog_db_version = db_version
+        _catalog_checked_at = now
+        return _catalog
+
+@metrics.timed(metrics.DB_SECONDS)
 def create_receipt(number=None, customer_name=None, payment_mode=None):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO receipts (number, customer_name, payment_mode, total, printed)
-        VALUES (?, ?, ?, 0.0, 0)
-    ''', (number, customer_name, payment_mode))
-    conn.commit()
-    cursor.execute('SELECT last_insert_rowid()')
-    rid = cursor.fetchone()[0]
-    conn.close()
-    return rid
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO receipts (number, customer_name, payment_mode, total, printed)
+            VALUES (?, ?, ?, 0.0, 0)
+        ''', (number, customer_name, payment_mode))
+        cursor.execute('SELECT last_insert_rowid()')
+        rid = cursor.fetchone()[0]
+        return rid
 
+@metrics.timed(metrics.DB_SECONDS)
 def update_receipt_meta(receipt_id, number=None, customer_name=None, customer_phone=None, payment_mode=None):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute(
-        "UPDATE receipts SET number = ?, customer_name = ?, customer_phone = ?, payment_mode = ? WHERE id = ?",
-        (number, customer_name, customer_phone, payment_mode, receipt_id)
-    )
-    conn.commit()
-    conn.close()
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE receipts SET number = ?, customer_name = ?, customer_phone = ?, payment_mode = ? WHERE id = ?",
+            (number, customer_name, customer_phone, payment_mode, receipt_id)
+        )
 
+@metrics.timed(metrics.DB_SECONDS)
 def add_receipt_item(receipt_id, medicine_id, medicine_name, qty, unit_price, discount):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO receipt_items (receipt_id, medicine_id, medicine_name, qty, unit_price, discount)
-        VALUES (?, ?, ?, ?, ?, ?)
-    ''', (receipt_id, medicine_id, medicine_name, qty, unit_price, discount or 0.0))
-    conn.commit()
-    conn.close()
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO receipt_items (receipt_id, medicine_id, medicine_name, qty, unit_price, discount)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (receipt_id, medicine_id, medicine_name, qty, unit_price, discount or 0.0))
 
+@metrics.timed(metrics.DB_SECONDS)
 def get_receipt_items(receipt_id):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT id, medicine_id, medicine_name, qty, unit_price, discount
-        FROM receipt_items WHERE receipt_id = ?
-    ''', (receipt_id,))
-    rows = cursor.fetchall()
-    conn.close()
-    return rows
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT id, medicine_id, medicine_name, qty, unit_price, discount
+            FROM receipt_items WHERE receipt_id = ?
+        ''', (receipt_id,))
+        rows = cursor.fetchall()
+        return rows
 
+@metrics.timed(metrics.DB_SECONDS)
 def finalize_receipt_and_reduce_stock(receipt_id):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT id, medicine_id, medicine_name, qty, unit_price, discount
-        FROM receipt_items WHERE receipt_id = ?
-    ''', (receipt_id,))
-    items = cursor.fetchall()
-    total = 0.0
-    detailed = []
-    for it in items:
-        _, mid, name, qty, unit_price, discount = it
-        allocations = reduce_stock_fefo(mid, qty)
-        for a in allocations:
-            part_total = unit_price * a['qty'] * (1 - (discount or 0.0)/100.0)
-            total += part_total
-            record_sale_extended(mid, name, a['qty'], part_total, discount or 0.0, a['mfg_date'], a['exp_date'], a.get('batch_id'))
-            detailed.append({
-                'medicine': name,
-                'qty': a['qty'],
-                'unit_price': unit_price,
-                'discount': discount or 0.0,
-                'amount': part_total,
-                'batch_id': a.get('batch_id'),
-                'batch_code': a.get('batch_code'),
-                'mfg_date': a.get('mfg_date'),
-                'exp_date': a.get('exp_date')
-            })
-    cursor.execute('UPDATE receipts SET total = ?, printed = 1 WHERE id = ?', (total, receipt_id))
-    conn.commit()
-    conn.close()
-    return total, detailed
+    with connection(immediate=True) as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT id, medicine_id, medicine_name, qty, unit_price, discount
+            FROM receipt_items WHERE receipt_id = ?
+        ''', (receipt_id,))
+        items = cursor.fetchall()
+        lines = [(mid, name, qty, unit_price, discount or 0.0) for _, mid, name, qty, unit_price, discount in items]
+        per_line = reduce_stock_fefo_bulk(lines)
+        total = 0.0
+        detailed = []
+        for (mid, name, qty, unit_price, discount), allocations in zip(lines, per_line):
+            for a in allocations:
+                part_total = a['amount']
+                total += part_total
+                detailed.append({
+                    'medicine': name,
+                    'qty': a['qty'],
+                    'unit_price': unit_price,
+                    'discount': discount,
+                    'amount': part_total,
+                    'batch_id': a.get('batch_id'),
+                    'batch_code': a.get('batch_code'),
+                    'mfg_date': a.get('mfg_date'),
+                    'exp_date': a.get('exp_date')
+                })
+        cursor.execute('UPDATE receipts SET total = ?, printed = 1 WHERE id = ?', (total, receipt_id))
+        return total, detailed
 
+@metrics.timed(metrics.DB_SECONDS)
 def list_receipts(limit=20):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT id, number, customer_name, customer_phone, payment_mode, total, printed, timestamp
-        FROM receipts ORDER BY timestamp DESC LIMIT ?
-    ''', (limit,))
-    rows = cursor.fetchall()
-    conn.close()
-    return rows
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT id, number, customer_name, customer_phone, payment_mode, total, printed, timestamp
+            FROM receipts ORDER BY timestamp DESC LIMIT ?
+        ''', (limit,))
+        rows = cursor.fetchall()
+        return rows
 
+@metrics.timed(metrics.DB_SECONDS)
 def get_medicine_by_name(name):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    # Simple partial match or exact match. Let's do case insensitive partial.
-    cursor.execute("SELECT * FROM medicines WHERE name LIKE ? COLLATE NOCASE", ('%' + name + '%',))
-    result = cursor.fetchone()
-    conn.close()
-    return result
+    with connection() as conn:
+        cursor = conn.cursor()
+        # Simple partial match or exact match. Let's do case insensitive partial.
+        cursor.execute("SELECT * FROM medicines WHERE name LIKE ? COLLATE NOCASE", ('%' + name + '%',))
+        result = cursor.fetchone()
+        return result
 
+@metrics.timed(metrics.DB_SECONDS)
 def get_medicine_by_id(mid):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM medicines WHERE id = ?", (mid,))
-    result = cursor.fetchone()
-    conn.close()
-    return result
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM medicines WHERE id = ?", (mid,))
+        result = cursor.fetchone()
+        return result
 
+@metrics.timed(metrics.DB_SECONDS)
 def create_medicine(name, manufacturer="Unknown", dosage="", price=10.0, stock=100, discount=10.0, mfg_date=None, exp_date=None):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    if not mfg_date:
-        mfg_date = "2024-01-01"
-    if not exp_date:
-        exp_date = "2026-01-01"
-    cursor.execute(
-        """
-        INSERT INTO medicines (name, manufacturer, dosage, price, stock, discount, mfg_date, exp_date)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """,
-        (name, manufacturer, dosage, price, stock, discount, mfg_date, exp_date),
-    )
-    conn.commit()
-    cursor.execute("SELECT id, stock FROM medicines WHERE name = ?", (name,))
-    mid, stk = cursor.fetchone()
-    cursor.execute(
-        "INSERT INTO batches (medicine_id, stock, mfg_date, exp_date, batch_code) VALUES (?, ?, ?, ?, ?)",
-        (mid, stk, mfg_date, exp_date, None),
-    )
-    conn.commit()
-    cursor.execute("SELECT * FROM medicines WHERE id = ?", (mid,))
-    result = cursor.fetchone()
-    conn.close()
-    return result
+    with connection() as conn:
+        cursor = conn.cursor()
+        if not mfg_date:
+            mfg_date = "2024-01-01"
+        if not exp_date:
+            exp_date = "2026-01-01"
+        cursor.execute(
+            """
+            INSERT INTO medicines (name, manufacturer, dosage, price, stock, discount, mfg_date, exp_date)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (name, manufacturer, dosage, price, stock, discount, mfg_date, exp_date),
+        )
+        cursor.execute("SELECT id, stock FROM medicines WHERE name = ?", (name,))
+        mid, stk = cursor.fetchone()
+        cursor.execute(
+            "INSERT INTO batches (medicine_id, stock, mfg_date, exp_date, batch_code) VALUES (?, ?, ?, ?, ?)",
+            (mid, stk, mfg_date, exp_date, None),
+        )
+        cursor.execute("SELECT * FROM medicines WHERE id = ?", (mid,))
+        result = cursor.fetchone()
+        _bump_catalog_version(cursor, [mid])
+        return result
 
+@metrics.timed(metrics.DB_SECONDS)
 def ensure_medicine(name):
     existing = get_medicine_by_name(name)
     if existing:
         return existing
     return create_medicine(name)
 
+@metrics.timed(metrics.DB_SECONDS)
 def update_stock(medicine_id, quantity_sold):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("UPDATE medicines SET stock = stock - ? WHERE id = ?", (quantity_sold, medicine_id))
-    conn.commit()
-    conn.close()
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("UPDATE medicines SET stock = stock - ? WHERE id = ?", (quantity_sold, medicine_id))
+        _bump_catalog_version(cursor, [medicine_id])
 
+@metrics.timed(metrics.DB_SECONDS)
 def record_sale(medicine_id, medicine_name, quantity, total_price):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO sales (medicine_id, medicine_name, quantity, total_price)
-        VALUES (?, ?, ?, ?)
-    ''', (medicine_id, medicine_name, quantity, total_price))
-    conn.commit()
-    conn.close()
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO sales (medicine_id, medicine_name, quantity, total_price)
+            VALUES (?, ?, ?, ?)
+        ''', (medicine_id, medicine_name, quantity, total_price))
 
+@metrics.timed(metrics.DB_SECONDS)
 def record_sale_extended(medicine_id, medicine_name, quantity, total_price, discount=0.0, mfg_date=None, exp_date=None, batch_id=None):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO sales (medicine_id, medicine_name, quantity, total_price, discount, mfg_date, exp_date, batch_id)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (medicine_id, medicine_name, quantity, total_price, discount, mfg_date, exp_date, batch_id))
-    conn.commit()
-    conn.close()
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO sales (medicine_id, medicine_name, quantity, total_price, discount, mfg_date, exp_date, batch_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (medicine_id, medicine_name, quantity, total_price, discount, mfg_date, exp_date, batch_id))
 
+@metrics.timed(metrics.DB_SECONDS)
 def get_all_medicines():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM medicines")
-    items = cursor.fetchall()
-    conn.close()
-    return items
+    return list(get_catalog().rows)
 
+@metrics.timed(metrics.DB_SECONDS)
 def get_recent_sales(limit=10):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, medicine_name, quantity, total_price, timestamp FROM sales ORDER BY timestamp DESC LIMIT ?", (limit,))
-    items = cursor.fetchall()
-    conn.close()
-    return items
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, medicine_name, quantity, total_price, timestamp FROM sales ORDER BY timestamp DESC LIMIT ?", (limit,))
+        items = cursor.fetchall()
+        return items
 
+@metrics.timed(metrics.DB_SECONDS)
 def ensure_default_batch(medicine_id):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT id FROM batches WHERE medicine_id = ?", (medicine_id,))
-    row = cursor.fetchone()
-    if not row:
-        cursor.execute("SELECT stock FROM medicines WHERE id = ?", (medicine_id,))
-        rs = cursor.fetchone()
-        base_stock = rs[0] if rs else 0
-        if base_stock > 0:
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id FROM batches WHERE medicine_id = ?", (medicine_id,))
+        row = cursor.fetchone()
+        if not row:
+            cursor.execute("SELECT stock FROM medicines WHERE id = ?", (medicine_id,))
+            rs = cursor.fetchone()
+            base_stock = rs[0] if rs else 0
+            if base_stock > 0:
+                today = datetime.date.today()
+                mfg = (today - datetime.timedelta(days=180)).isoformat()
+                exp = (today + datetime.timedelta(days=720)).isoformat()
+                cursor.execute("INSERT INTO batches (medicine_id, stock, mfg_date, exp_date, batch_code) VALUES (?, ?, ?, ?, ?)", (medicine_id, base_stock, mfg, exp, None))
+
+@metrics.timed(metrics.DB_SECONDS)
+def reduce_stock_fefo(medicine_id, quantity):
+    # Take the write lock up front so two counters can't allocate the same batch stock.
+    with connection(immediate=True) as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id FROM medicines WHERE id = ?", (medicine_id,))
+        if not cursor.fetchone():
+            return []
+        ensure_default_batch(medicine_id)
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT id, stock, mfg_date, exp_date, COALESCE(batch_code, 'B' || id) FROM batches WHERE medicine_id = ? ORDER BY {FEFO_ORDER}", (medicine_id,))
+        rows = cursor.fetchall()
+        allocations = []
+        remaining = quantity
+        for b in rows:
+            if remaining <= 0:
+                break
+            bid, bstock, mfg, exp, bcode = b
+            if bstock <= 0:
+                continue
+            take = min(remaining, bstock)
+            cursor.execute("UPDATE batches SET stock = stock - ? WHERE id = ?", (take, bid))
+            allocations.append({'batch_id': bid, 'batch_code': bcode, 'qty': take, 'mfg_date': mfg, 'exp_date': exp})
+            remaining -= take
+        if allocations:
+            total_taken = sum(a['qty'] for a in allocations)
+            cursor.execute("UPDATE medicines SET stock = stock - ? WHERE id = ?", (total_taken, medicine_id))
+            _bump_catalog_version(cursor, [medicine_id])
+        return allocations
+
+@metrics.timed(metrics.DB_SECONDS)
+def reduce_stock_fefo_bulk(lines):
+    """Allocate stock FEFO for many sale lines and record the sales.
+
+    ``lines`` is a list of (medicine_id, medicine_name, qty, unit_price,
+    discount). Batch selection, batch/medicine stock updates and the sales
+    rows are written in one IMMEDIATE transaction with executemany, so a
+    failure leaves stock untouched. Returns one list per line of allocation
+    dicts (as from reduce_stock_fefo) with the sale 'amount' added.
+    """
+    if not lines:
+        return []
+    ids = sorted({line[0] for line in lines if line[0] is not None})
+    with connection(immediate=True) as conn:
+        cursor = conn.cursor()
+
+        def load_batches(mids):
+            placeholders = ",".join("?" * len(mids))
+            cursor.execute(
+                "SELECT id, medicine_id, stock, mfg_date, exp_date, COALESCE(batch_code, 'B' || id) FROM batches "
+                f"WHERE medicine_id IN ({placeholders}) "
+                f"ORDER BY medicine_id, {FEFO_ORDER}",
+                list(mids),
+            )
+            out = {}
+            for bid, mid, bstock, mfg, exp, bcode in cursor.fetchall():
+                out.setdefault(mid, []).append([bid, bstock, mfg, exp, bcode])
+            return out
+
+        placeholders = ",".join("?" * len(ids))
+        cursor.execute(f"SELECT id, stock FROM medicines WHERE id IN ({placeholders})", ids)
+        med_stock = dict(cursor.fetchall())
+        batches = load_batches(list(med_stock)) if med_stock else {}
+        # Same fallback as ensure_default_batch for medicines without batch rows.
+        missing = [mid for mid, stk in med_stock.items() if mid not in batches and (stk or 0) > 0]
+        if missing:
             today = datetime.date.today()
             mfg = (today - datetime.timedelta(days=180)).isoformat()
             exp = (today + datetime.timedelta(days=720)).isoformat()
-            cursor.execute("INSERT INTO batches (medicine_id, stock, mfg_date, exp_date, batch_code) VALUES (?, ?, ?, ?, ?)", (medicine_id, base_stock, mfg, exp, None))
-            conn.commit()
-    conn.close()
+            cursor.executemany(
+                "INSERT INTO batches (medicine_id, stock, mfg_date, exp_date, batch_code) VALUES (?, ?, ?, ?, ?)",
+                [(mid, med_stock[mid], mfg, exp, None) for mid in missing],
+            )
+            batches.update(load_batches(missing))
 
-def reduce_stock_fefo(medicine_id, quantity):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT id FROM medicines WHERE id = ?", (medicine_id,))
-    if not cursor.fetchone():
-        conn.close()
-        return []
-    ensure_default_batch(medicine_id)
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, stock, mfg_date, exp_date, COALESCE(batch_code, 'B' || id) FROM batches WHERE medicine_id = ? ORDER BY CASE WHEN exp_date IS NULL THEN 1 ELSE 0 END, exp_date ASC", (medicine_id,))
-    rows = cursor.fetchall()
-    allocations = []
-    remaining = quantity
-    for b in rows:
-        if remaining <= 0:
-            break
-        bid, bstock, mfg, exp, bcode = b
-        if bstock <= 0:
-            continue
-        take = min(remaining, bstock)
-        cursor.execute("UPDATE batches SET stock = stock - ? WHERE id = ?", (take, bid))
-        allocations.append({'batch_id': bid, 'batch_code': bcode, 'qty': take, 'mfg_date': mfg, 'exp_date': exp})
-        remaining -= take
-    if allocations:
-        total_taken = sum(a['qty'] for a in allocations)
-        cursor.execute("UPDATE medicines SET stock = stock - ? WHERE id = ?", (total_taken, medicine_id))
-    conn.commit()
-    conn.close()
-    return allocations
+        per_line = []
+        batch_taken = {}
+        med_taken = {}
+        sales = []
+        for mid, name, qty, unit_price, discount in lines:
+            discount = discount or 0.0
+            allocations = []
+            remaining = qty
+            for b in batches.get(mid, []):
+                if remaining <= 0:
+                    break
+                bid, bstock, mfg, exp, bcode = b
+                if bstock <= 0:
+                    continue
+                take = min(remaining, bstock)
+                # Later lines for the same medicine see the reduced batch stock.
+                b[1] -= take
+                batch_taken[bid] = batch_taken.get(bid, 0) + take
+                med_taken[mid] = med_taken.get(mid, 0) + take
+                amount = unit_price * take * (1 - discount/100.0)
+                allocations.append({'batch_id': bid, 'batch_code': bcode, 'qty': take, 'mfg_date': mfg, 'exp_date': exp, 'amount': amount})
+                sales.append((mid, name, take, amount, discount, mfg, exp, bid))
+                remaining -= take
+            per_line.append(allocations)
+
+        if sales:
+            cursor.executemany("UPDATE batches SET stock = stock - ? WHERE id = ?", [(q, bid) for bid, q in batch_taken.items()])
+            cursor.executemany("UPDATE medicines SET stock = stock - ? WHERE id = ?", [(q, mid) for mid, q in med_taken.items()])
+            cursor.executemany('''
+                INSERT INTO sales (medicine_id, medicine_name, quantity, total_price, discount, mfg_date, exp_date, batch_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', sales)
+            _bump_catalog_version(cursor, med_taken)
+    return per_line
 
+@metrics.timed(metrics.DB_SECONDS)
 def upsert_medicine(name, manufacturer, dosage, price, stock, discount=0.0, mfg_date=None, exp_date=None):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT id FROM medicines WHERE name = ?", (name,))
-    row = cursor.fetchone()
-    if not mfg_date:
-        mfg_date = "2024-01-01"
-    if not exp_date:
-        exp_date = "2026-01-01"
-    if row:
-        mid = row[0]
-        cursor.execute(
-            "UPDATE medicines SET manufacturer = ?, dosage = ?, price = ?, stock = ?, discount = ?, mfg_date = ?, exp_date = ? WHERE id = ?",
-            (manufacturer, dosage, price, stock, discount, mfg_date, exp_date, mid),
-        )
-    else:
-        cursor.execute(
-            "INSERT INTO medicines (name, manufacturer, dosage, price, stock, discount, mfg_date, exp_date) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-            (name, manufacturer, dosage, price, stock, discount, mfg_date, exp_date),
-        )
+    with connection() as conn:
+        cursor = conn.cursor()
         cursor.execute("SELECT id FROM medicines WHERE name = ?", (name,))
-        mid = cursor.fetchone()[0]
-    cursor.execute("SELECT id FROM batches WHERE medicine_id = ?", (mid,))
-    b = cursor.fetchone()
-    if b:
-        cursor.execute("UPDATE batches SET stock = ?, mfg_date = ?, exp_date = ? WHERE id = ?", (stock, mfg_date, exp_date, b[0]))
-    else:
-        cursor.execute("INSERT INTO batches (medicine_id, stock, mfg_date, exp_date, batch_code) VALUES (?, ?, ?, ?, ?)", (mid, stock, mfg_date, exp_date, None))
-    conn.commit()
-    conn.close()
+        row = cursor.fetchone()
+        if not mfg_date:
+            mfg_date = "2024-01-01"
+        if not exp_date:
+            exp_date = "2026-01-01"
+        if row:
+            mid = row[0]
+            cursor.execute(
+                "UPDATE medicines SET manufacturer = ?, dosage = ?, price = ?, stock = ?, discount = ?, mfg_date = ?, exp_date = ? WHERE id = ?",
+                (manufacturer, dosage, price, stock, discount, mfg_date, exp_date, mid),
+            )
+        else:
+            cursor.execute(
+                "INSERT INTO medicines (name, manufacturer, dosage, price, stock, discount, mfg_date, exp_date) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (name, manufacturer, dosage, price, stock, discount, mfg_date, exp_date),
+            )
+            cursor.execute("SELECT id FROM medicines WHERE name = ?", (name,))
+            mid = cursor.fetchone()[0]
+        cursor.execute("SELECT id FROM batches WHERE medicine_id = ?", (mid,))
+        b = cursor.fetchone()
+        if b:
+            cursor.execute("UPDATE batches SET stock = ?, mfg_date = ?, exp_date = ? WHERE id = ?", (stock, mfg_date, exp_date, b[0]))
+        else:
+            cursor.execute("INSERT INTO batches (medicine_id, stock, mfg_date, exp_date, batch_code) VALUES (?, ?, ?, ?, ?)", (mid, stock, mfg_date, exp_date, None))
+        _bump_catalog_version(cursor, [mid])
 
+@metrics.timed(metrics.DB_SECONDS)
 def delete_medicine(medicine_id=None, name=None):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    mid = None
-    if medicine_id:
-        mid = medicine_id
-    elif name:
-        cursor.execute("SELECT id FROM medicines WHERE name = ?", (name,))
-        row = cursor.fetchone()
-        mid = row[0] if row else None
-    if not mid:
-        conn.close()
-        return False
-    cursor.execute("DELETE FROM batches WHERE medicine_id = ?", (mid,))
-    cursor.execute("DELETE FROM medicines WHERE id = ?", (mid,))
-    conn.commit()
-    conn.close()
-    return True
+    with connection() as conn:
+        cursor = conn.cursor()
+        mid = None
+        if medicine_id:
+            mid = medicine_id
+        elif name:
+            cursor.execute("SELECT id FROM medicines WHERE name = ?", (name,))
+            row = cursor.fetchone()
+            mid = row[0] if row else None
+        if not mid:
+            return False
+        cursor.execute("DELETE FROM batches WHERE medicine_id = ?", (mid,))
+        cursor.execute("DELETE FROM medicines WHERE id = ?", (mid,))
+        _bump_catalog_version(cursor, [mid])
+        return True
 
-def import_csv_text(text):
-    reader = csv.DictReader(text.splitlines())
+IMPORT_CHUNK_ROWS = 500
+IMPORT_READ_BYTES = 64 * 1024
+IMPORT_MAX_ERRORS = 20
+
+def _iter_lines(stream, encoding='utf-8', read_size=IMPORT_READ_BYTES):
+    # Decode an uploaded file incrementally and yield lines with their line
+    # endings, so csv can still parse quoted multi-line fields. Split on
+    # '\n' only: str.splitlines also breaks on form feeds, \x1c-\x1e, \x85
+    # and U+2028/9 inside field values, and would split a '\r\n' that
+    # straddles two reads into two lines.
+    decoder = codecs.getincrementaldecoder(encoding)()
+    pending = ''
+    while True:
+        chunk = stream.read(read_size)
+        if not chunk:
+            break
+        if isinstance(chunk, bytes):
+            chunk = decoder.decode(chunk)
+        # The last piece may be a partial line; keep it for the next read.
+        *lines, pending = (pending + chunk).split('\n')
+        for line in lines:
+            yield line + '\n'
+    pending += decoder.decode(b'', final=True)
+    if pending:
+        yield pending
+
+def _coerce_import_row(row):
+    name = (row.get('name') or row.get('Name') or '').strip()
+    if not name:
+        return None
+    manufacturer = row.get('manufacturer') or row.get('Manufacturer') or 'Unknown'
+    dosage = row.get('dosage') or row.get('Dosage') or ''
+    price = float(row.get('price') or row.get('Price') or 0)
+    stock = int(float(row.get('stock') or row.get('Stock') or 0))
+    discount = float(row.get('discount') or row.get('Discount') or 0.0)
+    mfg_date = row.get('mfg_date') or row.get('MFG') or row.get('manufacture_date') or "2024-01-01"
+    exp_date = row.get('exp_date') or row.get('EXP') or row.get('expiry_date') or "2026-01-01"
+    return (name, manufacturer, dosage, price, stock, discount, mfg_date, exp_date)
+
+def _upsert_medicines_chunk(rows):
+    # rows: name -> (name, manufacturer, dosage, price, stock, discount, mfg, exp)
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.executemany('''
+            INSERT INTO medicines (name, manufacturer, dosage, price, stock, discount, mfg_date, exp_date)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET
+                manufacturer = excluded.manufacturer, dosage = excluded.dosage, price = excluded.price,
+                stock = excluded.stock, discount = excluded.discount,
+                mfg_date = excluded.mfg_date, exp_date = excluded.exp_date
+        ''', list(rows.values()))
+        # Like upsert_medicine: the medicine's first batch mirrors the imported stock and dates.
+        placeholders = ",".join("?" * len(rows))
+        cursor.execute(f'''
+            SELECT m.name, m.id, (SELECT MIN(b.id) FROM batches b WHERE b.medicine_id = m.id)
+            FROM medicines m WHERE m.name IN ({placeholders})
+        ''', list(rows))
+        updates = []
+        inserts = []
+        for name, mid, bid in cursor.fetchall():
+            _, _, _, _, stock, _, mfg_date, exp_date = rows[name]
+            if bid is None:
+                inserts.append((mid, stock, mfg_date, exp_date, None))
+            else:
+                updates.append((stock, mfg_date, exp_date, bid))
+        cursor.executemany("UPDATE batches SET stock = ?, mfg_date = ?, exp_date = ? WHERE id = ?", updates)
+        cursor.executemany("INSERT INTO batches (medicine_id, stock, mfg_date, exp_date, batch_code) VALUES (?, ?, ?, ?, ?)", inserts)
+        _bump_catalog_version(cursor)
+
+def iter_import_csv(stream, chunk_rows=IMPORT_CHUNK_ROWS, encoding='utf-8'):
+    """Import a medicines CSV from a file object, yielding progress.
+
+    Rows are validated and coerced in chunks of ``chunk_rows`` and each chunk
+    is upserted in its own transaction. After every chunk a stats dict is
+    yielded: rows read, rows imported, rows skipped, chunks committed and
+    the first few row errors.
+    """
+    stats = {'rows': 0, 'imported': 0, 'skipped': 0, 'chunks': 0, 'errors': []}
+    reader = csv.DictReader(_iter_lines(stream, encoding))
+    chunk = {}
     for row in reader:
-        name = row.get('name') or row.get('Name')
-        manufacturer = row.get('manufacturer') or row.get('Manufacturer') or 'Unknown'
-        dosage = row.get('dosage') or row.get('Dosage') or ''
-        price = float(row.get('price') or row.get('Price') or 0)
-        stock = int(row.get('stock') or row.get('Stock') or 0)
-        discount = float(row.get('discount') or row.get('Discount') or 0.0)
-        mfg_date = row.get('mfg_date') or row.get('MFG') or row.get('manufacture_date')
-        exp_date = row.get('exp_date') or row.get('EXP') or row.get('expiry_date')
-        if not name:
+        stats['rows'] += 1
+        try:
+            values = _coerce_import_row(row)
+        except (TypeError, ValueError) as e:
+            values = None
+            if len(stats['errors']) < IMPORT_MAX_ERRORS:
+                stats['errors'].append({'line': reader.line_num, 'error': str(e)})
+        if values is None:
+            stats['skipped'] += 1
             continue
-        upsert_medicine(name, manufacturer, dosage, price, stock, discount, mfg_date, exp_date)
+        # Later rows for the same name win, as with sequential upserts.
+        chunk.pop(values[0], None)
+        chunk[values[0]] = values
+        stats['imported'] += 1
+        if len(chunk) >= chunk_rows:
+            _upsert_medicines_chunk(chunk)
+            chunk = {}
+            stats['chunks'] += 1
+            yield dict(stats)
+    if chunk:
+        _upsert_medicines_chunk(chunk)
+        stats['chunks'] += 1
+    yield dict(stats)
 
+@metrics.timed(metrics.DB_SECONDS)
+def import_csv_stream(stream, chunk_rows=IMPORT_CHUNK_ROWS, encoding='utf-8'):
+    stats = None
+    for stats in iter_import_csv(stream, chunk_rows, encoding):
+        pass
+    return stats
+
+def import_csv_text(text):
+    return import_csv_stream(io.StringIO(text))
+
+@metrics.timed(metrics.DB_SECONDS)
 def get_inventory_report():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT name, stock FROM medicines")
-    stock_rows = cursor.fetchall()
-    cursor.execute("SELECT medicine_name, SUM(quantity) FROM sales GROUP BY medicine_name")
-    sold_rows = cursor.fetchall()
-    sold_map = {r[0]: r[1] for r in sold_rows}
-    report = []
-    for name, stock in stock_rows:
-        sold = sold_map.get(name, 0) or 0
-        report.append((name, stock, sold))
-    conn.close()
-    return report
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT name, stock FROM medicines")
+        stock_rows = cursor.fetchall()
+        cursor.execute("SELECT medicine_name, SUM(quantity) FROM sales GROUP BY medicine_name")
+        sold_rows = cursor.fetchall()
+        sold_map = {r[0]: r[1] for r in sold_rows}
+        report = []
+        for name, stock in stock_rows:
+            sold = sold_map.get(name, 0) or 0
+            report.append((name, stock, sold))
+        return report
 
+@metrics.timed(metrics.DB_SECONDS)
 def get_batches_report():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT m.name, b.stock, b.mfg_date, b.exp_date, COALESCE(m.discount, 0.0), b.id
-        FROM batches b
-        JOIN medicines m ON m.id = b.medicine_id
-        ORDER BY m.name ASC, b.exp_date ASC
-    ''')
-    rows = cursor.fetchall()
-    conn.close()
-    return rows
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT m.name, b.stock, b.mfg_date, b.exp_date, COALESCE(m.discount, 0.0), b.id
+            FROM batches b
+            JOIN medicines m ON m.id = b.medicine_id
+            ORDER BY m.name ASC, b.exp_date ASC
+        ''')
+        rows = cursor.fetchall()
+        return rows
+
+# Hot queries and the index each must be served by, checked by check_query_plans.
+QUERY_PLAN_CHECKS = [
+    ("medicine by name", "SELECT id FROM medicines WHERE name = ?", ("x",)),
+    ("FEFO batches", f"SELECT id, stock, mfg_date, exp_date, COALESCE(batch_code, 'B' || id) FROM batches WHERE medicine_id = ? ORDER BY {FEFO_ORDER}", (1,)),
+    ("FEFO batches (bulk)", f"SELECT id, medicine_id, stock, mfg_date, exp_date, COALESCE(batch_code, 'B' || id) FROM batches WHERE medicine_id IN (?, ?) ORDER BY medicine_id, {FEFO_ORDER}", (1, 2)),
+    ("receipt items", "SELECT id, medicine_id, medicine_name, qty, unit_price, discount FROM receipt_items WHERE receipt_id = ?", (1,)),
+    ("sold per medicine", "SELECT medicine_name, SUM(quantity) FROM sales GROUP BY medicine_name", ()),
+    ("recent sales", "SELECT id, medicine_name, quantity, total_price, timestamp FROM sales ORDER BY timestamp DESC LIMIT ?", (10,)),
+    ("recent receipts", "SELECT id, number, customer_name, customer_phone, payment_mode, total, printed, timestamp FROM receipts ORDER BY timestamp DESC LIMIT ?", (20,)),
+]
+
+def check_query_plans(verbose=False):
+    """Run EXPLAIN QUERY PLAN over QUERY_PLAN_CHECKS.
+
+    Returns a list of (label, plan detail) for every step that fell back to a
+    full table scan or a temp B-tree sort; an empty list means all hot
+    queries are index-backed.
+    """
+    problems = []
+    with connection() as conn:
+        cursor = conn.cursor()
+        for label, sql, params in QUERY_PLAN_CHECKS:
+            cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+            for row in cursor.fetchall():
+                detail = row[-1]
+                if verbose:
+                    print(f"{label}: {detail}")
+                if (detail.startswith("SCAN ") and " USING " not in detail) or "TEMP B-TREE" in detail:
+                    problems.append((label, detail))
+    return problems
 
 if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Initialise or inspect the pharmacy database.")
+    parser.add_argument("--check-plans", action="store_true", help="Report hot queries that fall back to table scans.")
+    args = parser.parse_args()
     init_db()
+    if args.check_plans:
+        problems = check_query_plans(verbose=True)
+        for label, detail in problems:
+            print(f"REGRESSION {label}: {detail}")
+        raise SystemExit(1 if problems else 0)
@@ -1,45 +1,282 @@
-from ultralytics import YOLO
+import ast
+import os
 import cv2
+import numpy as np
+import threading
+import time
+from image_cache import PerceptualCache
+import metrics
+
+# "torch": ultralytics/PyTorch. "onnx": ONNX Runtime, exporting the .pt once if
+# needed. "openvino": ultralytics-exported OpenVINO IR run through ultralytics.
+BACKENDS = ('torch', 'onnx', 'openvino')
+
+
+def draw_boxes(frame, boxes, color=(0, 255, 0)):
+    """Copy of ``frame`` with ``(x1, y1, x2, y2, label, confidence)`` boxes drawn."""
+    out = frame.copy()
+    for x1, y1, x2, y2, label, conf in boxes:
+        cv2.rectangle(out, (x1, y1), (x2, y2), color, 2)
+        cv2.putText(out, f"{label} {conf:.2f}", (x1, max(y1 - 6, 12)), cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 1)
+    return out
+
+
+def export_model(model_path, fmt, imgsz=640):
+    """Export a .pt model with ultralytics (once) and return the exported path."""
+    from ultralytics import YOLO
+    stem = os.path.splitext(model_path)[0]
+    target = stem + '.onnx' if fmt == 'onnx' else stem + '_openvino_model'
+    if not os.path.exists(target):
+        print(f"Exporting {model_path} to {fmt}...")
+        target = YOLO(model_path).export(format=fmt, imgsz=imgsz)
+    return str(target)
+
+
+class OnnxYolo:
+    """YOLOv8 detection head run directly with ONNX Runtime.
+
+    Mirrors ultralytics' defaults: 114-grey letterbox, confidence 0.25,
+    class-aware NMS at IoU 0.7, at most 300 boxes.
+    """
+
+    def __init__(self, path, conf=0.25, iou=0.7, max_det=300, threads=0):
+        import onnxruntime as ort
+        opts = ort.SessionOptions()
+        if threads:
+            opts.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(path, sess_options=opts, providers=['CPUExecutionProvider'])
+        inp = self.session.get_inputs()[0]
+        self.input_name = inp.name
+        shape = inp.shape
+        self.imgsz = (shape[2] if isinstance(shape[2], int) else 640, shape[3] if isinstance(shape[3], int) else 640)
+        meta = self.session.get_modelmeta().custom_metadata_map
+        try:
+            self.names = ast.literal_eval(meta.get('names', '{}'))
+        except (ValueError, SyntaxError):
+            self.names = {}
+        self.conf = conf
+        self.iou = iou
+        self.max_det = max_det
+
+    def _letterbox(self, frame):
+        h, w = frame.shape[:2]
+        th, tw = self.imgsz
+        r = min(th / h, tw / w)
+        nh, nw = int(round(h * r)), int(round(w * r))
+        top, left = (th - nh) // 2, (tw - nw) // 2
+        resized = cv2.resize(frame, (nw, nh), interpolation=cv2.INTER_LINEAR) if (nh, nw) != (h, w) else frame
+        padded = cv2.copyMakeBorder(resized, top, th - nh - top, left, tw - nw - left, cv2.BORDER_CONSTANT, value=(114, 114, 114))
+        return padded, r, left, top
+
+    def __call__(self, frame):
+        """Return [(x1, y1, x2, y2, class_id, confidence)] in frame pixels."""
+        padded, r, left, top = self._letterbox(frame)
+        blob = cv2.dnn.blobFromImage(padded, 1.0 / 255.0, swapRB=True)
+        pred = self.session.run(None, {self.input_name: blob})[0][0].T
+        scores = pred[:, 4:]
+        cls = scores.argmax(axis=1)
+        conf = scores[np.arange(len(cls)), cls]
+        keep = conf >= self.conf
+        if not keep.any():
+            return []
+        pred, cls, conf = pred[keep], cls[keep], conf[keep]
+        cx, cy, bw, bh = pred[:, 0], pred[:, 1], pred[:, 2], pred[:, 3]
+        x1 = (cx - bw / 2 - left) / r
+        y1 = (cy - bh / 2 - top) / r
+        wh = np.stack([bw / r, bh / r], axis=1)
+        rects = np.stack([x1, y1, wh[:, 0], wh[:, 1]], axis=1).tolist()
+        idx = cv2.dnn.NMSBoxesBatched(rects, conf.tolist(), cls.tolist(), self.conf, self.iou)
+        idx = np.array(idx).flatten()[:self.max_det]
+        h, w = frame.shape[:2]
+        out = []
+        for i in idx:
+            bx, by, bwid, bhei = rects[i]
+            out.append((
+                int(max(0, min(w, bx))), int(max(0, min(h, by))),
+                int(max(0, min(w, bx + bwid))), int(max(0, min(h, by + bhei))),
+                int(cls[i]), float(conf[i]),
+            ))
+        return out
+
 
 class MedicineDetector:
-    def __init__(self, model_path='yolov8n.pt'):
+    def __init__(self, model_path='yolov8n.pt', cache_size=8, cache_ttl=5.0, backend='torch'):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown detector backend {backend!r}; expected one of {BACKENDS}")
         self.model_path = model_path
+        self.backend = backend
         self.model = None
-        print("MedicineDetector initialized (model not loaded yet)")
+        # Frames are large, so keep only a few recent results.
+        self.cache = PerceptualCache(maxsize=cache_size, ttl=cache_ttl)
+        # cold -> loaded -> warm (dummy inference done), or error.
+        self.status = 'cold'
+        self._load_lock = threading.Lock()
+        # The Ultralytics predictor keeps per-call state and is not thread-safe;
+        # request threads, DetectionWorker and RollingRecognizer share this
+        # detector, so inference runs one frame at a time.
+        self._infer_lock = threading.Lock()
+        print(f"MedicineDetector initialized ({backend} backend, model not loaded yet)")
+
+    def _load(self):
+        path = self.model_path
+        if self.backend == 'onnx':
+            if not path.endswith('.onnx'):
+                path = export_model(path, 'onnx')
+            return OnnxYolo(path)
+        # Imported lazily so the ONNX backend doesn't need the PyTorch stack.
+        from ultralytics import YOLO
+        if self.backend == 'openvino' and path.endswith('.pt'):
+            path = export_model(path, 'openvino')
+        return YOLO(path, task='detect')
 
     def get_model(self):
         if self.model is None:
-            print("Loading YOLO model...")
-            self.model = YOLO(self.model_path)
+            with self._load_lock:
+                if self.model is None:
+                    print(f"Loading YOLO model ({self.backend})...")
+                    self.model = self._load()
+                    self.status = 'loaded'
         return self.model
 
+    def warmup(self, infer=True):
+        """Load the model and, with ``infer``, run one dummy frame through it."""
+        try:
+            self.get_model()
+            if infer:
+                self._boxes(np.zeros((640, 640, 3), dtype=np.uint8))
+                self.status = 'warm'
+        except Exception as e:
+            print(f"Detector warm-up error: {e}")
+            self.status = 'error'
+
     def detect(self, frame):
         """
         Detects objects in the frame.
-        Returns annotated frame and detection data.
+        Returns annotated frame and detection data. Boxes for a visually
+        identical frame are served from the perceptual cache; crops and the
+        annotation are always taken from ``frame`` itself.
         """
+        with metrics.DETECT_SECONDS.time(self.backend):
+            boxes = self.cache.get_or_compute('detect', frame, lambda: self._boxes(frame))
+        detections = []
+        for x1, y1, x2, y2, label, conf in boxes:
+            detections.append({
+                'box': (x1, y1, x2, y2),
+                'label': label,
+                'confidence': conf,
+                'crop': frame[y1:y2, x1:x2]
+            })
+        return draw_boxes(frame, boxes), detections
+
+    def _boxes(self, frame):
+        """``(x1, y1, x2, y2, label, confidence)`` per detection in ``frame``."""
         model = self.get_model()
-        results = model(frame)
+        if self.backend == 'onnx':
+            with self._infer_lock:
+                raw = model(frame)
+            return [(x1, y1, x2, y2, model.names.get(cls, str(cls)), conf) for x1, y1, x2, y2, cls, conf in raw]
 
-        detections = []
+        with self._infer_lock:
+            results = model(frame, verbose=False)
 
+        boxes = []
         for result in results:
-            boxes = result.boxes
-            for box in boxes:
+            for box in result.boxes:
                 x1, y1, x2, y2 = box.xyxy[0]
-                x1, y1, x2, y2 = int(x1), int(y1), int(x2), int(y2)
+                boxes.append((int(x1), int(y1), int(x2), int(y2), model.names[int(box.cls[0])], float(box.conf[0])))
+        return boxes
+
+
+class DetectionWorker:
+    """Runs ``detector.detect`` on the newest grabbed frame at its own pace.
+
+    Results are published as ``(frame_seq, frame_ts, boxes)`` where boxes are
+    ``(x1, y1, x2, y2, label, confidence)``; ``overlay`` draws the latest ones
+    on any frame so the stream never waits for YOLO. Detection pauses when
+    nobody has asked for an overlay for ``idle_after`` seconds. With a
+    frame_source.SceneGate, YOLO only runs once the scene has changed and
+    settled; the previous boxes stay up in between.
+    """
+
+    def __init__(self, detector, grabber, fps=5.0, idle_after=2.0, gate=None):
+        self.detector = detector
+        self.grabber = grabber
+        self.gate = gate
+        self.interval = 1.0 / fps if fps and fps > 0 else 0.0
+        self.idle_after = idle_after
+        self.latest = None
+        self.detect_fps = 0.0
+        self.detect_ms = 0.0
+        self.lag_frames = 0
+        self.lag_ms = 0.0
+        self._demand = 0.0
+        self._wake = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
 
-                conf = float(box.conf[0])
-                cls = int(box.cls[0])
-                label = model.names[cls]
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name='detection-worker', daemon=True)
+                    self._thread.start()
 
-                crop = frame[y1:y2, x1:x2]
+    def _run(self):
+        seq = 0
+        last_done = None
+        while True:
+            if time.time() - self._demand > self.idle_after:
+                self._wake.clear()
+                self._wake.wait()
+                last_done = None
+            item = self.grabber.wait_newer(seq, timeout=1.0)
+            if item is None:
+                continue
+            seq, frame, ts = item
+            if self.gate is not None and not self.gate.check(frame):
+                continue
+            started = time.time()
+            try:
+                _, detections = self.detector.detect(frame)
+            except Exception as e:
+                print(f"Detection worker error: {e}")
+                time.sleep(1.0)
+                continue
+            done = time.time()
+            boxes = [d['box'] + (d['label'], d['confidence']) for d in detections]
+            self.latest = (seq, ts, boxes)
+            self.detect_ms = (done - started) * 1000.0
+            if last_done is not None:
+                rate = 1.0 / max(done - last_done, 1e-6)
+                self.detect_fps = rate if not self.detect_fps else 0.8 * self.detect_fps + 0.2 * rate
+            last_done = done
+            remaining = self.interval - (time.time() - started)
+            if remaining > 0:
+                time.sleep(remaining)
 
-                detections.append({
-                    'box': (x1, y1, x2, y2),
-                    'label': label,
-                    'confidence': conf,
-                    'crop': crop
-                })
+    def overlay(self, item):
+        """Draw the most recent boxes on a copy of the grabbed ``item`` frame."""
+        seq, frame, ts = item
+        self._demand = time.time()
+        self._ensure_thread()
+        self._wake.set()
+        latest = self.latest
+        if latest is None:
+            return frame
+        det_seq, det_ts, boxes = latest
+        self.lag_frames = seq - det_seq
+        self.lag_ms = (ts - det_ts) * 1000.0
+        if not boxes:
+            return frame
+        return draw_boxes(frame, boxes)
 
-        return results[0].plot(), detections
+    def stats(self):
+        return {
+            'running': self._thread is not None and self._thread.is_alive() and time.time() - self._demand <= self.idle_after,
+            'detect_fps': round(self.detect_fps, 2),
+            'detect_ms': round(self.detect_ms, 1),
+            'overlay_lag_frames': self.lag_frames,
+            'overlay_lag_ms': round(self.lag_ms, 1),
+            'last_frame_id': self.latest[0] if self.latest else None,
+            'gate': self.gate.stats() if self.gate is not None else None,
+        }
@@ -1,38 +1,28 @@
 import os
 import csv
+import json
+import hashlib
 import argparse
+import multiprocessing as mp
 from collections import Counter
 
 import cv2
-import numpy as np
-from thefuzz import process, fuzz
 from sklearn.metrics import classification_report, confusion_matrix, ConfusionMatrixDisplay
 import matplotlib.pyplot as plt
 
 from detector import MedicineDetector
-from ocr_engine import OCREngine
+from ocr_engine import OCREngine, PREPROCESS_DEFAULTS
 import database
+from matcher import MedicineMatcher
+from scan_pipeline import clean_segment
 
 
-IGNORED_WORDS = [
-    'tablet', 'capsule', 'mg', 'ml', 'exp', 'mfg', 'batch', 'price', 'rs', 'usp', 'ip', 'bp',
-    'pv', 'ltd', 'pharmaceuticals', 'india', 'store', 'cool', 'dry', 'place', 'dosage',
-    'keep', 'reach', 'children', 'composition', 'marketed', 'manufactured', 'net', 'content',
-    'transaction', 'expedience', 'offeric', 'warning', 'schedule', 'prescription',
-    'incl', 'taxes', 'all', 'b.no', 'date', 'regd', 'trade', 'mark', 'limited', 'pvt',
-    'medication', 'physician', 'directed', 'temperature', 'protect', 'light', 'moisture',
-    'not', 'for', 'use', 'only', 'sale', 'retail', 'wholesale', 'distributor', 'logistics',
-    'caution', 'practitioner', 'registered', 'medical', 'trihydrate', 'zyshield', 'zydus',
-    'german', 'remedies', 'division', 'industrial', 'estate', 'ahmedabad', 'gujarat'
-]
+# Bump when the stored per-image extraction changes shape.
+CACHE_VERSION = 1
 
 
 def normalize_text(s):
-    s = (s or "").lower()
-    for w in IGNORED_WORDS:
-        s = s.replace(w, " ")
-    s = "".join(ch for ch in s if ch.isalnum() or ch.isspace())
-    return " ".join(s.split())
+    return clean_segment(s or "")
 
 
 def load_labels(csv_path):
@@ -48,35 +38,27 @@ def load_labels(csv_path):
     return labels
 
 
-def predict_for_image(detector, ocr_engine, img, med_names):
+def extract_image(detector, ocr_engine, img):
+    """YOLO + OCR for one image: a list of {box, confidence, segments} per detection."""
     annotated, detections = detector.detect(img)
-    candidates = []
+    out = []
     for det in detections:
         crop = det["crop"]
         segs = ocr_engine.extract_segments_robust(crop)
         if not segs:
             segs = ocr_engine.extract_segments_fast(crop)
-        for raw in segs:
+        out.append({"box": [int(v) for v in det["box"]], "confidence": float(det["confidence"]), "segments": list(segs)})
+    return out
+
+
+def predict_from_extraction(extraction, med_matcher, min_score=70):
+    candidates = []
+    for det in extraction:
+        for raw in det["segments"]:
             cleaned = normalize_text(raw)
             if len(cleaned) < 3 or len(cleaned.split()) > 8:
                 continue
-            best, score = process.extractOne(cleaned, med_names, scorer=fuzz.token_set_ratio)
-            final = None
-            if score >= 70:
-                final = best
-            else:
-                words = cleaned.split()
-                best_score = 0
-                best_word = None
-                for w in words:
-                    if len(w) < 4:
-                        continue
-                    m, s = process.extractOne(w, med_names, scorer=fuzz.ratio)
-                    if s > best_score:
-                        best_score = s
-                        best_word = m
-                if best_score >= 85:
-                    final = best_word
+            final = med_matcher.match(cleaned, min_score=min_score)
             if final:
                 candidates.append(final)
     if not candidates:
@@ -85,31 +67,122 @@ def predict_for_image(detector, ocr_engine, img, med_names):
     return counts.most_common(1)[0][0]
 
 
-def evaluate(images_dir, labels_csv, output_dir):
+def predict_for_image(detector, ocr_engine, img, med_matcher):
+    return predict_from_extraction(extract_image(detector, ocr_engine, img), med_matcher)
+
+
+def _cache_path(cache_dir, path, model_path):
+    # Keyed by image content, model and OCR preprocessing, so renamed files
+    # still hit and a new model, preprocess setting or CACHE_VERSION misses.
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    preprocess = json.dumps(PREPROCESS_DEFAULTS, sort_keys=True)
+    h.update(f"|{model_path}|{preprocess}|{CACHE_VERSION}".encode("utf-8"))
+    return os.path.join(cache_dir, h.hexdigest() + ".json")
+
+
+def _load_cached(cache_file):
+    try:
+        with open(cache_file, encoding="utf-8") as f:
+            return json.load(f)["detections"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def _store_cached(cache_file, extraction):
+    # Write-then-rename so an interrupted run never leaves a truncated entry.
+    tmp = f"{cache_file}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"detections": extraction}, f)
+    os.replace(tmp, cache_file)
+
+
+_worker_models = None
+
+
+def _init_worker(model_path):
+    global _worker_models
+    _worker_models = (MedicineDetector(model_path=model_path, cache_size=0), OCREngine(cache_size=0))
+
+
+def _extract_job(job):
+    fn, path, cache_file = job
+    img = cv2.imread(path)
+    if img is None:
+        return fn, None
+    detector, ocr_engine = _worker_models
+    extraction = extract_image(detector, ocr_engine, img)
+    if cache_file:
+        _store_cached(cache_file, extraction)
+    return fn, extraction
+
+
+def extract_dataset(images_dir, labels, cache_dir=None, workers=1, model_path="yolov8n.pt", refresh=False):
+    """Per-image extractions for every labeled image, reusing ``cache_dir`` entries.
+
+    Missing images are skipped. Uncached images run through YOLO + OCR
+    (in ``workers`` processes when > 1), and each finished image is stored
+    at once, so an interrupted run resumes where it stopped.
+    """
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+    extractions = {}
+    jobs = []
+    for fn in labels:
+        path = os.path.join(images_dir, fn)
+        if not os.path.exists(path):
+            continue
+        cache_file = _cache_path(cache_dir, path, model_path) if cache_dir else None
+        cached = None if (refresh or not cache_file) else _load_cached(cache_file)
+        if cached is not None:
+            extractions[fn] = cached
+        else:
+            jobs.append((fn, path, cache_file))
+    print(f"{len(extractions)} images cached, {len(jobs)} to extract")
+    if not jobs:
+        return extractions
+
+    done = 0
+    if workers > 1:
+        ctx = mp.get_context("spawn")
+        with ctx.Pool(workers, initializer=_init_worker, initargs=(model_path,)) as pool:
+            for fn, extraction in pool.imap_unordered(_extract_job, jobs):
+                done += 1
+                if extraction is not None:
+                    extractions[fn] = extraction
+                if done % 25 == 0 or done == len(jobs):
+                    print(f"extracted {done}/{len(jobs)}")
+    else:
+        _init_worker(model_path)
+        for job in jobs:
+            fn, extraction = _extract_job(job)
+            done += 1
+            if extraction is not None:
+                extractions[fn] = extraction
+            if done % 25 == 0 or done == len(jobs):
+                print(f"extracted {done}/{len(jobs)}")
+    return extractions
+
+
+def evaluate(images_dir, labels_csv, output_dir, workers=1, cache_dir=None, min_score=70, model_path="yolov8n.pt", refresh=False):
     os.makedirs(output_dir, exist_ok=True)
     database.init_db()
-    meds = database.get_all_medicines()
-    med_names = [m[1] for m in meds]
+    med_matcher = MedicineMatcher(database.get_catalog().names)
 
     labels = load_labels(labels_csv)
-
-    detector = MedicineDetector()
-    ocr_engine = OCREngine()
+    extractions = extract_dataset(images_dir, labels, cache_dir, workers, model_path, refresh)
 
     y_true = []
     y_pred = []
 
     for fn, true_name in labels.items():
-        path = os.path.join(images_dir, fn)
-        if not os.path.exists(path):
+        if fn not in extractions:
             continue
-        img = cv2.imread(path)
-        if img is None:
-            continue
-        pred = predict_for_image(detector, ocr_engine, img, med_names)
+        pred = predict_from_extraction(extractions[fn], med_matcher, min_score)
         y_true.append(true_name)
         y_pred.append(pred)
-
     if not y_true:
         print("No valid labeled samples found to evaluate.")
         return
@@ -139,10 +212,18 @@ def main():
     parser.add_argument("--images", required=True, help="Folder with test images.")
     parser.add_argument("--labels", required=True, help="CSV with ground truth labels.")
     parser.add_argument("--output", default="evaluation_output", help="Folder to store metrics and plots.")
+    parser.add_argument("--workers", type=int, default=1, help="Processes running YOLO + OCR.")
+    parser.add_argument("--cache-dir", default=None,
+                        help="Per-image detection/OCR cache (default: <output>/cache). Reruns only redo matching.")
+    parser.add_argument("--no-cache", action="store_true", help="Don't read or write the cache.")
+    parser.add_argument("--refresh", action="store_true", help="Re-extract every image and overwrite the cache.")
+    parser.add_argument("--min-score", type=int, default=70, help="Fuzzy match threshold.")
+    parser.add_argument("--model", default="yolov8n.pt", help="YOLO model path.")
     args = parser.parse_args()
-    evaluate(args.images, args.labels, args.output)
+    cache_dir = None if args.no_cache else (args.cache_dir or os.path.join(args.output, "cache"))
+    evaluate(args.images, args.labels, args.output, workers=args.workers, cache_dir=cache_dir,
+             min_score=args.min_score, model_path=args.model, refresh=args.refresh)
 
 
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,309 @@
+import threading
+import time
+import urllib.request
+
+import cv2
+import numpy as np
+
+
+def fetch_snapshot(url, timeout=2):
+    ts = str(int(time.time() * 1000))
+    u = url + ('&' if '?' in url else '?') + 't=' + ts
+    req = urllib.request.Request(u, headers={'User-Agent': 'Mozilla/5.0', 'Cache-Control': 'no-cache'})
+    with urllib.request.urlopen(req, timeout=timeout) as resp:
+        data = resp.read()
+    arr = np.frombuffer(data, dtype=np.uint8)
+    return cv2.imdecode(arr, cv2.IMREAD_COLOR)
+
+
+class FrameGrabber:
+    """Single capture thread that owns the active camera or snapshot URL.
+
+    Each frame read is published as an immutable ``(seq, frame, timestamp)``
+    tuple by swapping one reference, so readers never take a lock and never
+    copy the frame. Every published frame is a fresh array; treat it as
+    read-only and copy before drawing on it.
+    """
+
+    def __init__(self, poll_interval=0.05, retry_interval=0.2):
+        self.poll_interval = poll_interval
+        self.retry_interval = retry_interval
+        self._latest = None
+        self._seq = 0
+        self._capture = None
+        self._poll_url = None
+        # Capture the grabber thread is reading from, outside the lock; a
+        # capture replaced mid-read is released by the grabber afterwards.
+        self._reading = None
+        self._source_lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='frame-grabber', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+        self._thread = None
+        self.set_capture(None)
+
+    def set_capture(self, capture):
+        """Read from ``capture`` (a cv2.VideoCapture or None) from now on.
+
+        The previous capture, if any, is released by the grabber.
+        """
+        with self._source_lock:
+            old = self._capture
+            self._capture = capture
+            self._poll_url = None
+            busy = old is self._reading
+        if old is not None and old is not capture and not busy:
+            self._release(old)
+
+    def set_poll(self, url):
+        """Poll ``url`` for JPEG snapshots instead of reading a capture."""
+        with self._source_lock:
+            old = self._capture
+            self._capture = None
+            self._poll_url = url
+            busy = old is self._reading
+        if old is not None and not busy:
+            self._release(old)
+
+    @staticmethod
+    def _release(capture):
+        try:
+            capture.release()
+        except Exception:
+            pass
+
+    @property
+    def polling(self):
+        return self._poll_url is not None
+
+    def publish(self, frame):
+        with self._cond:
+            self._seq += 1
+            self._latest = (self._seq, frame, time.time())
+            self._cond.notify_all()
+
+    def latest(self):
+        """Return the newest ``(seq, frame, timestamp)`` or None."""
+        return self._latest
+
+    def wait_newer(self, seq, timeout=None):
+        """Block until a frame newer than ``seq`` exists; return it or None."""
+        with self._cond:
+            self._cond.wait_for(lambda: self._latest is not None and self._latest[0] > seq, timeout)
+            item = self._latest
+        if item is None or item[0] <= seq:
+            return None
+        return item
+
+    def _read_once(self):
+        # Only the source is picked under the lock: a stalled camera must not
+        # block set_capture/set_poll/stop for the length of its read.
+        with self._source_lock:
+            capture = self._capture
+            url = self._poll_url
+            self._reading = capture
+        if capture is not None:
+            try:
+                ok, frame = capture.read()
+            finally:
+                with self._source_lock:
+                    self._reading = None
+                    replaced = capture is not self._capture
+            if replaced:
+                self._release(capture)
+                return None
+            return frame if ok else None
+        if url is not None:
+            return fetch_snapshot(url)
+        return None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                frame = self._read_once()
+            except Exception:
+                frame = None
+            if frame is None:
+                self._stop.wait(self.retry_interval)
+                continue
+            self.publish(frame)
+            if self.polling:
+                self._stop.wait(self.poll_interval)
+
+
+class MJPEGBroadcaster:
+    """Encode each grabbed frame once and fan the JPEG out to all viewers.
+
+    One encoder thread follows the grabber while at least one client is
+    subscribed. Subscribers always get the newest encoded frame; a client
+    that falls behind skips frames rather than queueing them.
+    """
+
+    def __init__(self, grabber, quality=80, max_width=0, annotate=None):
+        self.grabber = grabber
+        self.quality = quality
+        self.max_width = max_width
+        # Optional (seq, frame, ts) -> frame hook applied before encoding
+        # (e.g. detection overlay).
+        self.annotate = annotate
+        self._latest = None
+        self._cond = threading.Condition()
+        self._subscribers = 0
+        self._thread = None
+
+    def _encode(self, item):
+        frame = item[1]
+        if self.annotate is not None:
+            frame = self.annotate(item)
+        if self.max_width and frame.shape[1] > self.max_width:
+            h = int(frame.shape[0] * self.max_width / frame.shape[1])
+            frame = cv2.resize(frame, (self.max_width, h), interpolation=cv2.INTER_AREA)
+        ok, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, int(self.quality)])
+        return buffer.tobytes() if ok else None
+
+    def _run(self):
+        seq = 0
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._subscribers > 0)
+            item = self.grabber.wait_newer(seq, timeout=1.0)
+            if item is None:
+                continue
+            seq = item[0]
+            try:
+                data = self._encode(item)
+            except Exception:
+                data = None
+            if data is None:
+                continue
+            with self._cond:
+                self._latest = (seq, data)
+                self._cond.notify_all()
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='mjpeg-encoder', daemon=True)
+            self._thread.start()
+
+    def frames(self):
+        """Yield encoded JPEG bytes for one client, always the newest frame."""
+        with self._cond:
+            self._subscribers += 1
+            self._ensure_thread()
+            self._cond.notify_all()
+        try:
+            seq = 0
+            while True:
+                with self._cond:
+                    self._cond.wait_for(lambda: self._latest is not None and self._latest[0] > seq, 1.0)
+                    item = self._latest
+                if item is None or item[0] <= seq:
+                    continue
+                seq, data = item
+                yield data
+        finally:
+            with self._cond:
+                self._subscribers -= 1
+
+
+class SceneGate:
+    """Cheap scene-change detector that decides when a frame is worth analysing.
+
+    Frames are compared as small, blurred grayscale thumbnails by mean
+    absolute difference (grey levels). ``check`` returns True once the scene
+    differs from the last analysed frame by more than ``change_threshold``
+    and has then settled: ``settle_frames`` consecutive frames moved by less
+    than ``settle_threshold``. A still scene, an empty tray or a hand
+    moving through view all return False.
+    """
+
+    def __init__(self, change_threshold=6.0, settle_threshold=2.0, settle_frames=2, width=64):
+        self.change_threshold = change_threshold
+        self.settle_threshold = settle_threshold
+        self.settle_frames = settle_frames
+        self.width = width
+        # True while the scene has changed but not yet settled, i.e. the
+        # consumer's last result no longer describes what the camera sees.
+        self.pending = False
+        self.frames = 0
+        self.triggered = 0
+        self.skipped_still = 0
+        self.skipped_moving = 0
+        self.last_change = 0.0
+        self.last_motion = 0.0
+        self._reference = None
+        self._previous = None
+        self._still = 0
+        self._lock = threading.Lock()
+
+    def _thumbnail(self, frame):
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if len(frame.shape) == 3 else frame
+        h, w = gray.shape[:2]
+        height = max(1, int(round(h * self.width / float(max(w, 1)))))
+        small = cv2.resize(gray, (self.width, height), interpolation=cv2.INTER_AREA)
+        return cv2.GaussianBlur(small, (3, 3), 0).astype(np.float32)
+
+    @staticmethod
+    def _distance(a, b):
+        if a is None or b is None or a.shape != b.shape:
+            return float('inf')
+        return float(np.mean(np.abs(a - b)))
+
+    def check(self, frame):
+        """True when ``frame`` should be analysed; it becomes the new reference."""
+        thumb = self._thumbnail(frame)
+        with self._lock:
+            self.frames += 1
+            motion = self._distance(thumb, self._previous)
+            change = self._distance(thumb, self._reference)
+            self._previous = thumb
+            self.last_motion = motion if motion != float('inf') else 0.0
+            self.last_change = change if change != float('inf') else 0.0
+            if change <= self.change_threshold:
+                self.pending = False
+                self._still = 0
+                self.skipped_still += 1
+                return False
+            self.pending = True
+            self._still = self._still + 1 if motion <= self.settle_threshold else 0
+            if self._still < self.settle_frames:
+                self.skipped_moving += 1
+                return False
+            self._reference = thumb
+            self._still = 0
+            self.pending = False
+            self.triggered += 1
+            return True
+
+    def reset(self):
+        """Forget the reference so the next settled frame is analysed."""
+        with self._lock:
+            self._reference = None
+
+    def stats(self):
+        skipped = self.skipped_still + self.skipped_moving
+        return {
+            'change_threshold': self.change_threshold,
+            'settle_threshold': self.settle_threshold,
+            'settle_frames': self.settle_frames,
+            'frames': self.frames,
+            'triggered': self.triggered,
+            'skipped_still': self.skipped_still,
+            'skipped_moving': self.skipped_moving,
+            'skip_rate': round(skipped / self.frames, 3) if self.frames else 0.0,
+            'pending': self.pending,
+            'last_change': round(self.last_change, 2),
+            'last_motion': round(self.last_motion, 2),
+        }
@@ -0,0 +1,25 @@
+# gunicorn -c gunicorn.conf.py app:app
+#
+# Loads the app (and the models listed in PRELOAD_MODELS) once in the master so
+# workers share the weights copy-on-write. Warm-up inference, the camera, the
+# capture thread and any INFERENCE_WORKERS processes are started per worker
+# after fork: threads don't survive fork and the OCR/YOLO runtimes' thread
+# pools aren't fork-safe once used.
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+preload_app = True
+
+os.environ.setdefault('PRELOAD_MODE', 'fork')
+os.environ['DEFER_STARTUP'] = '1'
+
+
+def post_fork(server, worker):
+    import app
+    app.start_capture()
+    app.start_inference_pool()
+    if app.PRELOAD_MODE == 'fork':
+        app.warm_models_async()
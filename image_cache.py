@@ -0,0 +1,159 @@
+import threading
+import time
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+MISS = object()
+
+
+def _gray(image_array):
+    if len(image_array.shape) == 3:
+        return cv2.cvtColor(image_array, cv2.COLOR_BGR2GRAY)
+    return image_array
+
+
+def dhash(image_array, hash_size=64, margin=2.0):
+    """Difference hash of an image as an int.
+
+    The grid is ``hash_size`` columns wide and keeps the image's aspect ratio
+    (8 to ``hash_size`` rows), so wide text crops keep some horizontal
+    detail. Neighbouring cells must differ by more than ``margin`` grey
+    levels to set a bit, which keeps flat, noisy regions stable.
+    """
+    gray = _gray(image_array)
+    h, w = gray.shape[:2]
+    rows = int(min(hash_size, max(8, round(hash_size * h / max(w, 1)))))
+    small = cv2.resize(gray, (hash_size + 1, rows), interpolation=cv2.INTER_AREA).astype(np.float32)
+    bits = (small[:, 1:] - small[:, :-1] > margin).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def thumbnail(image_array, scale=4):
+    """Grayscale copy shrunk ``scale`` times, for verifying a cache hit."""
+    gray = _gray(image_array)
+    h, w = gray.shape[:2]
+    return cv2.resize(gray, (max(1, w // scale), max(1, h // scale)), interpolation=cv2.INTER_AREA)
+
+
+class PerceptualCache:
+    """LRU + TTL cache keyed by a perceptual hash of the input image.
+
+    The key is ``(tag, image shape, dHash)``. A hash alone cannot tell
+    strips apart that differ only in a dosage digit (ATORVA 10 and 20 can
+    share a hash), so each entry also keeps a thumbnail (see ``thumbnail``)
+    and a hit is only served when no thumbnail pixel of the new image
+    differs by more than ``tolerance`` grey levels. Averaging a 4x4 block
+    cancels sensor noise, while a changed character or a shifted crop moves
+    some pixels far beyond that. ``max_distance`` > 0 also tries entries of
+    the same shape whose hash differs in at most that many bits; they are
+    verified the same way.
+    """
+
+    def __init__(self, maxsize=256, ttl=30.0, hash_size=64, max_distance=0, tolerance=24):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hash_size = hash_size
+        self.max_distance = max_distance
+        self.tolerance = tolerance
+        self.hits = 0
+        self.misses = 0
+        self.rejected = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, tag, image_array):
+        return (tag, image_array.shape, dhash(image_array, self.hash_size))
+
+    def _near(self, key):
+        tag, shape, h = key
+        best, best_distance = None, self.max_distance + 1
+        for k in self._entries:
+            if k[0] != tag or k[1] != shape:
+                continue
+            distance = (k[2] ^ h).bit_count()
+            if distance < best_distance:
+                best, best_distance = k, distance
+        return best
+
+    def _lookup(self, key, now):
+        if key not in self._entries:
+            if self.max_distance <= 0:
+                return MISS
+            key = self._near(key)
+            if key is None:
+                return MISS
+        entry = self._entries[key]
+        if now - entry[0] > self.ttl:
+            del self._entries[key]
+            self.evictions += 1
+            return MISS
+        self._entries.move_to_end(key)
+        return entry
+
+    def _same_image(self, thumb, image_array):
+        if thumb is None or image_array is None:
+            return True
+        other = thumbnail(image_array)
+        return other.shape == thumb.shape and int(cv2.absdiff(thumb, other).max()) <= self.tolerance
+
+    def get(self, key, image_array=None):
+        """Cached value for ``key`` (from ``key()``) or MISS; counts hits and misses.
+
+        With ``image_array`` the hit is verified against the entry's thumbnail.
+        """
+        with self._lock:
+            entry = self._lookup(key, time.time())
+        if entry is not MISS and not self._same_image(entry[2], image_array):
+            with self._lock:
+                self.rejected += 1
+            entry = MISS
+        with self._lock:
+            if entry is MISS:
+                self.misses += 1
+                return MISS
+            self.hits += 1
+        value = entry[1]
+        return list(value) if isinstance(value, list) else value
+
+    def put(self, key, value, image_array=None):
+        thumb = thumbnail(image_array) if image_array is not None else None
+        with self._lock:
+            self._entries[key] = (time.time(), value, thumb)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_compute(self, tag, image_array, compute):
+        """Return the cached result for ``(tag, image)`` or store ``compute()``.
+
+        Exceptions from ``compute`` propagate and nothing is cached.
+        """
+        if not self.maxsize or image_array is None or getattr(image_array, 'size', 0) == 0:
+            return compute()
+        key = self.key(tag, image_array)
+        value = self.get(key, image_array)
+        if value is not MISS:
+            return value
+        value = compute()
+        self.put(key, value, image_array)
+        return list(value) if isinstance(value, list) else value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'rejected': self.rejected,
+            'evictions': self.evictions,
+            'hit_rate': round(self.hits / total, 3) if total else 0.0,
+        }
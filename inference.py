@@ -0,0 +1,323 @@
+import itertools
+import multiprocessing as mp
+import queue
+import re
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import database
+import matcher
+
+
+class PoolBusy(Exception):
+    """Raised by InferencePool.submit when the job queue is full."""
+
+
+class CatalogAccept:
+    """Picklable multi-angle early-stop predicate: the text names a catalog medicine.
+
+    Evaluated inside the worker against its own catalog cache.
+    """
+
+    def __call__(self, text):
+        cleaned = " ".join(re.sub(r'[^a-z0-9\s\-]', ' ', (text or '').lower()).split())
+        if len(cleaned) < 3:
+            return False
+        return matcher.for_catalog(database.get_catalog()).match(cleaned, word_fallback=False) is not None
+
+
+# OCREngine methods a job may call; each takes one image or a list of crops.
+OCR_METHODS = {
+    'extract_segments', 'extract_segments_fast', 'extract_segments_batch',
+    'extract_segments_multiangle', 'extract_segments_robust', 'extract_segments_regions',
+    'extract_text',
+}
+
+
+def _pack(arrays):
+    arrays = [np.ascontiguousarray(a) for a in arrays]
+    specs = []
+    offset = 0
+    for a in arrays:
+        specs.append((offset, a.shape, a.dtype.str))
+        offset += a.nbytes
+    shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+    for a, (off, shape, dtype) in zip(arrays, specs):
+        np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=off)[...] = a
+    return shm, specs
+
+
+def _attach(name, specs):
+    # Spawned workers share the parent's resource tracker, so attaching here
+    # doesn't take ownership; the parent unlinks the block.
+    shm = shared_memory.SharedMemory(name=name)
+    arrays = [np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=off) for off, shape, dtype in specs]
+    return shm, arrays
+
+
+def _run_job(detector, ocr_engine, op, arrays, kwargs):
+    if op == 'detect':
+        _, detections = detector.detect(arrays[0])
+        return [(d['box'], d['label'], d['confidence']) for d in detections]
+    if op == 'extract_segments_batch':
+        return ocr_engine.extract_segments_batch(arrays, **kwargs)
+    if op in OCR_METHODS:
+        return getattr(ocr_engine, op)(arrays[0], **kwargs)
+    raise ValueError(f"Unknown inference op: {op}")
+
+
+def _worker_main(wid, jobs, results, config):
+    from detector import MedicineDetector
+    from ocr_engine import OCREngine
+    detector = MedicineDetector(
+        model_path=config.get('detector_model', 'yolov8n.pt'),
+        backend=config.get('detector_backend', 'torch'),
+        cache_size=config['detect_cache_size'],
+        cache_ttl=config['detect_cache_ttl'],
+    )
+    ocr_engine = OCREngine(
+        cache_size=config['ocr_cache_size'],
+        cache_ttl=config['ocr_cache_ttl'],
+        preprocess=config.get('ocr_preprocess'),
+    )
+    preload = config.get('preload') or []
+    if 'yolo' in preload:
+        detector.warmup()
+    ocr_models = [m for m in ('easyocr', 'paddle') if m in preload]
+    if ocr_models:
+        ocr_engine.warmup(ocr_models)
+    results.put(('status', wid, {'yolo': detector.status, **ocr_engine.status}))
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        job_id, op, shm_name, specs, kwargs = job
+        results.put(('start', wid, job_id))
+        shm = None
+        try:
+            shm, arrays = _attach(shm_name, specs)
+            out = _run_job(detector, ocr_engine, op, arrays, kwargs)
+            del arrays
+            results.put(('ok', job_id, out))
+        except Exception as e:
+            results.put(('error', job_id, f"{type(e).__name__}: {e}"))
+        finally:
+            if shm is not None:
+                shm.close()
+
+
+class InferencePool:
+    """YOLO/OCR inference in N worker processes fed through shared memory.
+
+    Each worker owns its MedicineDetector and OCREngine. ``submit`` copies
+    the input arrays into one shared-memory block and returns a Future;
+    at most ``max_pending`` jobs may be in flight, beyond which submit
+    raises PoolBusy so the web tier can shed load with a 503.
+    """
+
+    def __init__(self, workers=2, max_pending=None, config=None):
+        self.workers = workers
+        self.max_pending = max_pending or workers * 2
+        self.config = config or {}
+        self._ctx = mp.get_context('spawn')
+        self._jobs = self._ctx.Queue()
+        self._results = self._ctx.Queue()
+        self._procs = []
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._status = {}
+        # Job each worker is running, so a crash can fail that job's Future.
+        self._running = {}
+        self.completed = 0
+        self.rejected = 0
+        self.failed = 0
+        self.started = False
+
+    def start(self):
+        self.started = True
+        for wid in range(self.workers):
+            self._procs.append(self._spawn(wid))
+        threading.Thread(target=self._collect, name='inference-results', daemon=True).start()
+        return self
+
+    def _spawn(self, wid):
+        p = self._ctx.Process(target=_worker_main, args=(wid, self._jobs, self._results, self.config),
+                              name=f'inference-{wid}', daemon=True)
+        p.start()
+        return p
+
+    def _handle(self, kind, key, payload):
+        if kind == 'status':
+            self._status[key] = payload
+            return
+        if kind == 'start':
+            self._running[key] = payload
+            return
+        for wid, job_id in list(self._running.items()):
+            if job_id == key:
+                del self._running[wid]
+        self._finish(key, kind == 'ok', payload)
+
+    def _finish(self, job_id, ok, payload):
+        with self._lock:
+            entry = self._pending.pop(job_id, None)
+        if entry is None:
+            return
+        fut, shm = entry
+        self._release(shm)
+        if ok:
+            self.completed += 1
+            fut.set_result(payload)
+        else:
+            self.failed += 1
+            fut.set_exception(RuntimeError(payload))
+
+    def _collect(self):
+        last_check = time.time()
+        while True:
+            try:
+                self._handle(*self._results.get(timeout=1.0))
+            except queue.Empty:
+                pass
+            if time.time() - last_check >= 1.0:
+                last_check = time.time()
+                dead = [wid for wid, p in enumerate(self._procs) if not p.is_alive()]
+                if not dead:
+                    continue
+                # Take in whatever the dead workers managed to send first.
+                while True:
+                    try:
+                        self._handle(*self._results.get_nowait())
+                    except queue.Empty:
+                        break
+                for wid in dead:
+                    p = self._procs[wid]
+                    print(f"Inference worker {wid} exited ({p.exitcode}); restarting")
+                    self._status.pop(wid, None)
+                    job_id = self._running.pop(wid, None)
+                    if job_id is not None:
+                        self._finish(job_id, False, f"inference worker {wid} exited ({p.exitcode})")
+                    self._procs[wid] = self._spawn(wid)
+
+    def _release(self, shm):
+        try:
+            shm.close()
+            shm.unlink()
+        except Exception:
+            pass
+
+    def submit(self, op, arrays, **kwargs):
+        with self._lock:
+            if len(self._pending) >= self.max_pending:
+                self.rejected += 1
+                raise PoolBusy(f"{len(self._pending)} inference jobs already queued")
+            job_id = next(self._ids)
+            fut = Future()
+            fut.job_id = job_id
+            shm, specs = _pack(arrays)
+            self._pending[job_id] = (fut, shm)
+        self._jobs.put((job_id, op, shm.name, specs, kwargs))
+        return fut
+
+    def call(self, op, arrays, timeout=None, **kwargs):
+        fut = self.submit(op, arrays, **kwargs)
+        try:
+            return fut.result(timeout=timeout)
+        except FutureTimeout:
+            # Drop the job; a late result is ignored by the collector.
+            with self._lock:
+                entry = self._pending.pop(fut.job_id, None)
+            if entry is not None:
+                self._release(entry[1])
+            raise
+
+    def model_status(self):
+        """Least-ready status of each model across the live workers."""
+        order = ['error', 'cold', 'loaded', 'warm']
+        merged = {}
+        for wid in range(self.workers):
+            st = self._status.get(wid)
+            if st is None:
+                return {'yolo': 'cold', 'easyocr': 'cold', 'paddle': 'cold'}
+            for name, value in st.items():
+                cur = merged.get(name)
+                if cur is None or order.index(value) < order.index(cur):
+                    merged[name] = value
+        return merged
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'alive': sum(1 for p in self._procs if p.is_alive()),
+            'pending': len(self._pending),
+            'max_pending': self.max_pending,
+            'completed': self.completed,
+            'failed': self.failed,
+            'rejected': self.rejected,
+        }
+
+
+class RemoteDetector:
+    """MedicineDetector stand-in that runs detection in the pool."""
+
+    def __init__(self, pool, timeout=60):
+        self.pool = pool
+        self.timeout = timeout
+
+    def detect(self, frame):
+        # Only boxes cross the process boundary; crops are views of our frame
+        # and the "annotated" image is the frame itself.
+        boxes = self.pool.call('detect', [frame], timeout=self.timeout)
+        detections = []
+        for (x1, y1, x2, y2), label, conf in boxes:
+            detections.append({'box': (x1, y1, x2, y2), 'label': label, 'confidence': conf, 'crop': frame[y1:y2, x1:x2]})
+        return frame, detections
+
+
+class RemoteOCREngine:
+    """OCREngine stand-in whose extract_* calls run in the pool."""
+
+    def __init__(self, pool, timeout=120):
+        self.pool = pool
+        self.timeout = timeout
+
+    def _call(self, op, image_array, **kwargs):
+        if image_array is None or getattr(image_array, 'size', 0) == 0:
+            return "" if op == 'extract_text' else []
+        if kwargs.get('accept') is not None:
+            # Closures can't cross processes; the worker checks its own catalog.
+            kwargs['accept'] = CatalogAccept()
+        return self.pool.call(op, [image_array], timeout=self.timeout, **kwargs)
+
+    def extract_segments(self, image_array, **kwargs):
+        return self._call('extract_segments', image_array, **kwargs)
+
+    def extract_segments_fast(self, image_array, **kwargs):
+        return self._call('extract_segments_fast', image_array, **kwargs)
+
+    def extract_segments_multiangle(self, image_array, **kwargs):
+        return self._call('extract_segments_multiangle', image_array, **kwargs)
+
+    def extract_segments_robust(self, image_array, **kwargs):
+        return self._call('extract_segments_robust', image_array, **kwargs)
+
+    def extract_segments_regions(self, image_array, **kwargs):
+        return self._call('extract_segments_regions', image_array, **kwargs)
+
+    def extract_text(self, image_array):
+        return self._call('extract_text', image_array)
+
+    def extract_segments_batch(self, crops, **kwargs):
+        valid = [i for i, c in enumerate(crops) if c is not None and getattr(c, 'size', 0) > 0]
+        out = [[] for _ in crops]
+        if not valid:
+            return out
+        res = self.pool.call('extract_segments_batch', [crops[i] for i in valid], timeout=self.timeout, **kwargs)
+        for i, segs in zip(valid, res):
+            out[i] = segs
+        return out
@@ -0,0 +1,92 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+class JobQueueFull(Exception):
+    """Raised by JobQueue.submit when ``max_pending`` jobs are queued or running."""
+
+
+class JobQueue:
+    """Background executor for slow requests, tracked by job id.
+
+    ``submit`` returns at once with an id; the job runs on one of
+    ``workers`` threads and its result (or error message) is kept for
+    ``ttl`` seconds after it finishes. ``wait`` blocks until the job's
+    status changes, which backs both polling and server-sent events.
+    """
+
+    def __init__(self, workers=2, max_pending=8, ttl=300.0, name='job'):
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self._jobs = {}
+        self._cond = threading.Condition()
+        self.submitted = 0
+        self.rejected = 0
+
+    def _expire(self, now):
+        # Called under the lock by every public method, so finished jobs go
+        # even when nothing new is submitted.
+        for job_id in [k for k, j in self._jobs.items() if j['finished'] and now - j['finished'] > self.ttl]:
+            del self._jobs[job_id]
+
+    def active(self):
+        return sum(1 for j in self._jobs.values() if j['status'] in ('queued', 'running'))
+
+    def submit(self, fn, *args, **kwargs):
+        with self._cond:
+            now = time.time()
+            self._expire(now)
+            if self.active() >= self.max_pending:
+                self.rejected += 1
+                raise JobQueueFull(f"{self.max_pending} jobs already in progress")
+            job_id = uuid.uuid4().hex
+            self._jobs[job_id] = {
+                'id': job_id, 'status': 'queued', 'result': None, 'error': None,
+                'created': now, 'started': None, 'finished': None,
+            }
+            self.submitted += 1
+        self._executor.submit(self._run, job_id, fn, args, kwargs)
+        return job_id
+
+    def _update(self, job_id, **fields):
+        with self._cond:
+            self._jobs[job_id].update(fields)
+            self._cond.notify_all()
+
+    def _run(self, job_id, fn, args, kwargs):
+        self._update(job_id, status='running', started=time.time())
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            self._update(job_id, status='error', error=str(e), finished=time.time())
+        else:
+            self._update(job_id, status='done', result=result, finished=time.time())
+
+    def get(self, job_id):
+        """A copy of the job record, or None for an unknown or expired id."""
+        with self._cond:
+            self._expire(time.time())
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def wait(self, job_id, status=None, timeout=None):
+        """Block until the job's status differs from ``status``; return the record."""
+        with self._cond:
+            self._expire(time.time())
+            self._cond.wait_for(lambda: job_id not in self._jobs or self._jobs[job_id]['status'] != status, timeout)
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def stats(self):
+        with self._cond:
+            self._expire(time.time())
+            return {
+                'active': self.active(),
+                'max_pending': self.max_pending,
+                'tracked': len(self._jobs),
+                'submitted': self.submitted,
+                'rejected': self.rejected,
+            }
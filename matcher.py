@@ -0,0 +1,128 @@
+import threading
+from collections import defaultdict
+
+from thefuzz import process, fuzz, utils
+
+
+def _grams(text):
+    # Character trigrams of each token, padded so short tokens like "40" or
+    # "m" still produce a gram and a shared token always means a shared gram.
+    grams = set()
+    for tok in text.split():
+        padded = f" {tok} "
+        if len(padded) <= 3:
+            grams.add(padded)
+            continue
+        for i in range(len(padded) - 2):
+            grams.add(padded[i:i + 3])
+    return grams
+
+
+class MedicineMatcher:
+    """Fuzzy medicine-name lookup over a trigram inverted index.
+
+    Queries are shortlisted by shared trigrams and only the shortlist is
+    scored with thefuzz, so the result is the same as ``process.extractOne``
+    over the whole catalog for any name that makes the shortlist. Catalogs
+    up to ``exhaustive_limit`` names are simply scanned in full.
+    """
+
+    def __init__(self, names, max_candidates=50, max_df=0.05, exhaustive_limit=1000):
+        self.names = list(names)
+        self.max_candidates = max_candidates
+        self.exhaustive_limit = exhaustive_limit
+        self.processed = [utils.full_process(n, force_ascii=True) for n in self.names]
+        self.lengths = [len(p) for p in self.processed]
+        self.gram_counts = []
+        postings = defaultdict(list)
+        for idx, p in enumerate(self.processed):
+            grams = _grams(p)
+            self.gram_counts.append(len(grams))
+            for g in grams:
+                postings[g].append(idx)
+        self.postings = dict(postings)
+        # Grams shared by a large slice of the catalog ("tab", " 50") say
+        # little about which name was read; skip them while shortlisting.
+        self.max_postings = max(1000, int(len(self.names) * max_df))
+
+    def __len__(self):
+        return len(self.names)
+
+    def _shortlist(self, query, min_len=None, max_len=None):
+        grams = _grams(query)
+        counts = defaultdict(int)
+        rare = [g for g in grams if len(self.postings.get(g, ())) <= self.max_postings]
+        for g in (rare or grams):
+            for idx in self.postings.get(g, ()):
+                counts[idx] += 1
+        if min_len is not None or max_len is not None:
+            lo = min_len or 0
+            hi = max_len if max_len is not None else float('inf')
+            counts = {i: c for i, c in counts.items() if lo <= self.lengths[i] <= hi}
+        # Rank by Dice overlap so a short exact name isn't crowded out by
+        # longer names that merely share the same grams.
+        qn = len(grams)
+        gc = self.gram_counts
+        best = sorted(counts.items(), key=lambda kv: (-2.0 * kv[1] / (qn + gc[kv[0]]), kv[0]))[:self.max_candidates]
+        # Score in catalog order so ties resolve the way a full scan would.
+        return [self.names[i] for i in sorted(i for i, _ in best)]
+
+    def extract_one(self, query, scorer=fuzz.token_set_ratio, min_len=None, max_len=None):
+        """Drop-in for ``process.extractOne(query, names, scorer=scorer)``."""
+        if not self.names:
+            return None
+        if len(self.names) <= self.exhaustive_limit:
+            return process.extractOne(query, self.names, scorer=scorer)
+        processed = utils.full_process(query, force_ascii=True)
+        if not processed:
+            return None
+        candidates = self._shortlist(processed, min_len, max_len)
+        if not candidates:
+            return None
+        return process.extractOne(query, candidates, scorer=scorer)
+
+    def match(self, text, min_score=70, word_fallback=True, min_word_len=4, word_score=85):
+        """Return the catalog name for ``text`` or None.
+
+        Tries token_set_ratio on the whole text first, then (optionally) the
+        best fuzz.ratio hit of any single word of at least ``min_word_len``.
+        """
+        best = self.extract_one(text, scorer=fuzz.token_set_ratio)
+        if best and best[1] >= min_score:
+            return best[0]
+        if not word_fallback:
+            return None
+        best_score = 0
+        best_word = None
+        for w in text.split():
+            if len(w) < min_word_len:
+                continue
+            # ratio >= word_score needs the lengths within this band.
+            n = len(utils.full_process(w, force_ascii=True))
+            s = word_score - 0.5
+            band = s / (200.0 - s)
+            res = self.extract_one(w, scorer=fuzz.ratio, min_len=int(n * band), max_len=int(n / band) + 1)
+            if res and res[1] > best_score:
+                best_score = res[1]
+                best_word = res[0]
+        if best_score >= word_score:
+            return best_word
+        return None
+
+
+_cached = None
+_cached_lock = threading.Lock()
+
+
+def for_catalog(catalog):
+    """Return a matcher for ``catalog``, rebuilt only when its names change."""
+    global _cached
+    entry = _cached
+    if entry is not None and entry[0] == catalog.version:
+        return entry[1]
+    with _cached_lock:
+        entry = _cached
+        if entry is None or entry[0] != catalog.version:
+            entry = (catalog.version, MedicineMatcher(catalog.names))
+            _cached = entry
+    return entry[1]
@@ -2,14 +2,56 @@ from paddleocr import PaddleOCR
 import numpy as np
 import cv2
 import logging
+import re
+import threading
+import time
 import easyocr
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from image_cache import PerceptualCache, MISS
+import metrics
 
 logging.getLogger("ppocr").setLevel(logging.ERROR)
 
+# preprocess_image settings; override any of them via OCREngine(preprocess={...}).
+PREPROCESS_DEFAULTS = {
+    # Shrink images whose longest side exceeds this (PaddleOCR detects at 960,
+    # EasyOCR at up to 2560); 0 disables.
+    'max_side': 1600,
+    # Upscale images shorter than this, by at most max_upscale.
+    'upscale_below': 480,
+    'max_upscale': 2.0,
+    'clahe_clip': 2.0,
+    'clahe_tile': 8,
+    # 'auto' skips denoising when the Laplacian variance shows a sharp image
+    # and uses the cheaper median filter otherwise; or force one of
+    # 'median', 'gaussian', 'bilateral', 'none'.
+    'denoise': 'auto',
+    'sharpness_threshold': 150.0,
+}
+
 class OCREngine:
-    def __init__(self):
+    def __init__(self, max_workers=4, cache_size=256, cache_ttl=30.0, preprocess=None):
         self.ocr = None
         self.fast_reader = None
+        self.max_workers = max_workers
+        self.pool = None
+        # Raw recognizer output keyed by a perceptual hash of the input image,
+        # so re-scans of an unchanged strip skip the OCR models entirely.
+        self.cache = PerceptualCache(maxsize=cache_size, ttl=cache_ttl)
+        # Per model: cold -> loaded -> warm (dummy inference done), or error.
+        self.status = {'paddle': 'cold', 'easyocr': 'cold'}
+        self._load_lock = threading.Lock()
+        # Neither the torch-backed EasyOCR Reader nor PaddleOCR is thread-safe;
+        # request threads, the rolling recognizer and the multi-angle pool
+        # share them, so each model runs one call at a time.
+        self._easy_lock = threading.Lock()
+        self._paddle_lock = threading.Lock()
+        self.preprocess = dict(PREPROCESS_DEFAULTS, **(preprocess or {}))
+        # CLAHE objects keep internal buffers, so reuse one per thread.
+        self._local = threading.local()
+        # Per-stage [count, total ms], updated from request and worker threads.
+        self.preprocess_timings = {}
+        self._timings_lock = threading.Lock()
         print("OCREngine initialized (models not loaded yet)")
 
     # ---------------------------
@@ -18,76 +60,475 @@ class OCREngine:
 
     def get_paddle(self):
         if self.ocr is None:
-            print("Loading PaddleOCR model...")
-            self.ocr = PaddleOCR(use_angle_cls=True, lang='en')
+            with self._load_lock:
+                if self.ocr is None:
+                    print("Loading PaddleOCR model...")
+                    self.ocr = PaddleOCR(use_angle_cls=True, lang='en')
+                    self.status['paddle'] = 'loaded'
         return self.ocr
 
     def get_easy(self):
         if self.fast_reader is None:
-            print("Loading EasyOCR model...")
-            self.fast_reader = easyocr.Reader(['en'], gpu=False)
+            with self._load_lock:
+                if self.fast_reader is None:
+                    print("Loading EasyOCR model...")
+                    self.fast_reader = easyocr.Reader(['en'], gpu=False)
+                    self.status['easyocr'] = 'loaded'
         return self.fast_reader
 
+    def warmup(self, models=('easyocr', 'paddle'), infer=True):
+        """Load ``models`` and, with ``infer``, run one dummy read on each so
+        weights, thread pools and buffers are ready before the first scan."""
+        sample = np.full((64, 320, 3), 255, dtype=np.uint8)
+        cv2.putText(sample, "DOLO 650", (10, 45), cv2.FONT_HERSHEY_SIMPLEX, 1.2, (0, 0, 0), 2)
+        for name in models:
+            try:
+                if name == 'paddle':
+                    self.get_paddle()
+                    if infer:
+                        self._paddle_pairs(sample, 0.0)
+                elif name == 'easyocr':
+                    self.get_easy()
+                    if infer:
+                        self._easy_pairs(sample, 0.0)
+                else:
+                    continue
+                if infer:
+                    self.status[name] = 'warm'
+            except Exception as e:
+                print(f"OCR warm-up error ({name}): {e}")
+                self.status[name] = 'error'
+
+    def get_pool(self):
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='ocr')
+        return self.pool
+
     # ---------------------------
     # Image Preprocessing
     # ---------------------------
 
-    def preprocess_image(self, image_array):
+    def _clahe(self):
+        clahe = getattr(self._local, 'clahe', None)
+        if clahe is None:
+            tile = int(self.preprocess['clahe_tile'])
+            clahe = cv2.createCLAHE(clipLimit=self.preprocess['clahe_clip'], tileGridSize=(tile, tile))
+            self._local.clahe = clahe
+        return clahe
+
+    def _record_timings(self, timings):
+        with self._timings_lock:
+            for stage, ms in timings.items():
+                entry = self.preprocess_timings.setdefault(stage, [0, 0.0])
+                entry[0] += 1
+                entry[1] += ms
+
+    def preprocess_report(self):
+        """Call count and mean milliseconds per preprocessing stage."""
+        with self._timings_lock:
+            snapshot = [(stage, n, total) for stage, (n, total) in self.preprocess_timings.items()]
+        return {stage: {'count': n, 'mean_ms': round(total / n, 3)} for stage, n, total in snapshot if n}
+
+    @metrics.timed(metrics.OCR_SECONDS)
+    def preprocess_image(self, image_array, timings=None):
+        """Grayscale, resize, CLAHE and (adaptive) denoise for OCR.
+
+        Per-stage milliseconds are added to ``timings`` when a dict is given
+        and always accumulated into ``preprocess_report()``.
+        """
         if image_array is None:
             return None
+        cfg = self.preprocess
+        stages = {}
+        t = time.perf_counter()
+
+        def mark(stage):
+            nonlocal t
+            now = time.perf_counter()
+            stages[stage] = (now - t) * 1000.0
+            t = now
 
         if len(image_array.shape) == 3:
             gray = cv2.cvtColor(image_array, cv2.COLOR_BGR2GRAY)
         else:
             gray = image_array
+        mark('gray')
 
         h, w = gray.shape[:2]
-        if h < 1000:
-            gray = cv2.resize(gray, (w*2, h*2), interpolation=cv2.INTER_CUBIC)
+        scale = 1.0
+        if cfg['max_side'] and max(h, w) > cfg['max_side']:
+            scale = cfg['max_side'] / float(max(h, w))
+        elif cfg['upscale_below'] and h < cfg['upscale_below']:
+            scale = min(cfg['max_upscale'], cfg['upscale_below'] / float(h))
+        if scale != 1.0:
+            interp = cv2.INTER_AREA if scale < 1.0 else cv2.INTER_LINEAR
+            gray = cv2.resize(gray, (max(1, int(w * scale)), max(1, int(h * scale))), interpolation=interp)
+        mark('resize')
 
-        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
-        contrast = clahe.apply(gray)
+        contrast = self._clahe().apply(gray)
+        mark('clahe')
 
-        denoise = cv2.bilateralFilter(contrast, 9, 75, 75)
+        mode = cfg['denoise']
+        if mode == 'auto':
+            sharpness = cv2.Laplacian(contrast, cv2.CV_64F).var()
+            mode = 'none' if sharpness >= cfg['sharpness_threshold'] else 'median'
+            mark('sharpness')
+        if mode == 'median':
+            denoise = cv2.medianBlur(contrast, 3)
+        elif mode == 'gaussian':
+            denoise = cv2.GaussianBlur(contrast, (3, 3), 0)
+        elif mode == 'bilateral':
+            denoise = cv2.bilateralFilter(contrast, 9, 75, 75)
+        else:
+            denoise = contrast
+        mark('denoise')
+
+        self._record_timings(stages)
+        if timings is not None:
+            timings.update(stages)
         return denoise
 
     # ---------------------------
     # OCR Methods
     # ---------------------------
 
-    def extract_segments(self, image_array, conf_thresh=0.5):
-        try:
-            paddle = self.get_paddle()
+    def _paddle_pairs(self, image_array, conf_thresh):
+        paddle = self.get_paddle()
+        with self._paddle_lock:
             result = paddle.ocr(image_array)
 
-            segments = []
-            if result and result[0]:
-                for line in result[0]:
-                    text = line[1][0]
-                    confidence = line[1][1]
-                    if confidence >= conf_thresh:
-                        segments.append(text)
-            return segments
+        segments = []
+        if result and result[0]:
+            for line in result[0]:
+                text = line[1][0]
+                confidence = line[1][1]
+                if confidence >= conf_thresh:
+                    segments.append((text, float(confidence)))
+        return segments
+
+    def _easy_pairs(self, image_array, conf_thresh):
+        easy = self.get_easy()
+        with self._easy_lock:
+            results = easy.readtext(image_array, detail=1)
+        return [(r[1], float(r[2])) for r in results if r[2] >= conf_thresh]
+
+    def _read_paddle(self, image_array, conf_thresh=0.5):
+        try:
+            return self.cache.get_or_compute(('paddle', conf_thresh), image_array, lambda: self._paddle_pairs(image_array, conf_thresh))
         except Exception as e:
             print(f"OCR Error: {e}")
             return []
 
+    def _read_easy(self, image_array, conf_thresh=0.5):
+        try:
+            return self.cache.get_or_compute(('easy', conf_thresh), image_array, lambda: self._easy_pairs(image_array, conf_thresh))
+        except Exception as e:
+            print(f"OCR Error: {e}")
+            return []
+
+    @metrics.timed(metrics.OCR_SECONDS)
+    def extract_segments(self, image_array, conf_thresh=0.5):
+        return [t for t, _ in self._read_paddle(image_array, conf_thresh)]
+
+    @metrics.timed(metrics.OCR_SECONDS)
     def extract_segments_fast(self, image_array, conf_thresh=0.5):
+        return [t for t, _ in self._read_easy(image_array, conf_thresh)]
+
+    def _letterbox(self, image_array, width, height):
+        h, w = image_array.shape[:2]
+        scale = min(width / w, height / h)
+        nw, nh = max(1, int(round(w * scale))), max(1, int(round(h * scale)))
+        resized = cv2.resize(image_array, (nw, nh), interpolation=cv2.INTER_AREA if scale < 1 else cv2.INTER_CUBIC)
+        if resized.ndim == 2:
+            resized = cv2.cvtColor(resized, cv2.COLOR_GRAY2BGR)
+        # Replicate the border so padding doesn't create fake text edges.
+        return cv2.copyMakeBorder(resized, 0, height - nh, 0, width - nw, cv2.BORDER_REPLICATE)
+
+    @metrics.timed(metrics.OCR_SECONDS)
+    def extract_segments_batch(self, crops, conf_thresh=0.5, max_side=640, batch_size=16):
+        """EasyOCR over many crops at once; returns one text list per crop.
+
+        Crops are grouped by orientation, letterboxed to a shared size and
+        sent through ``readtext_batched`` so detection and recognition run as
+        a few batched forward passes instead of one pass per crop. Empty or
+        invalid crops get an empty list. Cached crops skip the batch.
+        """
+        out = [[] for _ in crops]
+        keys = {}
+        groups = {}
+        for i, crop in enumerate(crops):
+            if crop is None or getattr(crop, 'size', 0) == 0 or min(crop.shape[:2]) < 4:
+                continue
+            if self.cache.maxsize:
+                keys[i] = self.cache.key(('easy', conf_thresh), crop)
+                pairs = self.cache.get(keys[i], crop)
+                if pairs is not MISS:
+                    out[i] = [t for t, _ in pairs]
+                    continue
+            h, w = crop.shape[:2]
+            groups.setdefault(w >= h, []).append(i)
+        if not groups:
+            return out
         try:
             easy = self.get_easy()
-            results = easy.readtext(image_array, detail=1)
-
-            texts = []
-            for r in results:
-                t = r[1]
-                c = r[2]
-                if c >= conf_thresh:
-                    texts.append(t)
-            return texts
         except Exception as e:
             print(f"OCR Error: {e}")
+            return out
+        for idxs in groups.values():
+            if len(idxs) == 1:
+                out[idxs[0]] = self.extract_segments_fast(crops[idxs[0]], conf_thresh)
+                continue
+            width = max(crops[i].shape[1] for i in idxs)
+            height = max(crops[i].shape[0] for i in idxs)
+            scale = min(1.0, max_side / max(width, height))
+            width, height = max(32, int(width * scale)), max(32, int(height * scale))
+            padded = [self._letterbox(crops[i], width, height) for i in idxs]
+            try:
+                with self._easy_lock:
+                    results = easy.readtext_batched(padded, n_width=width, n_height=height, batch_size=batch_size, detail=1)
+            except Exception as e:
+                print(f"Batched OCR Error: {e}")
+                for i in idxs:
+                    out[i] = self.extract_segments_fast(crops[i], conf_thresh)
+                continue
+            for i, res in zip(idxs, results):
+                pairs = [(r[1], float(r[2])) for r in res if r[2] >= conf_thresh]
+                if i in keys:
+                    self.cache.put(keys[i], pairs, crops[i])
+                out[i] = [t for t, _ in pairs]
+        return out
+
+    # ---------------------------
+    # Text-region proposals
+    # ---------------------------
+
+    def propose_text_regions(self, image_array, max_side=960, max_regions=24, pad=4):
+        """Likely text-line boxes ``(x1, y1, x2, y2)`` in ``image_array``, largest first.
+
+        Printed text is dense in strong edges: the morphological gradient is
+        Otsu-thresholded, closed horizontally so the characters of a line
+        merge, and line-shaped blobs with enough edge pixels are kept. Runs
+        on a copy shrunk to ``max_side``, so it costs a few ms at any size.
+        """
+        gray = cv2.cvtColor(image_array, cv2.COLOR_BGR2GRAY) if len(image_array.shape) == 3 else image_array
+        h, w = gray.shape[:2]
+        scale = min(1.0, max_side / float(max(h, w)))
+        if scale < 1.0:
+            gray = cv2.resize(gray, (max(1, int(w * scale)), max(1, int(h * scale))), interpolation=cv2.INTER_AREA)
+        sh, sw = gray.shape[:2]
+        grad = cv2.morphologyEx(gray, cv2.MORPH_GRADIENT, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3)))
+        _, bw = cv2.threshold(grad, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+        link = max(3, sw // 80)
+        closed = cv2.morphologyEx(bw, cv2.MORPH_CLOSE, cv2.getStructuringElement(cv2.MORPH_RECT, (link, 1)))
+        contours, _ = cv2.findContours(closed, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        boxes = []
+        for c in contours:
+            x, y, bw_, bh = cv2.boundingRect(c)
+            if bh < 8 or bh > sh * 0.25 or bw_ < bh * 1.2:
+                continue
+            # Text lines are roughly a third edge pixels; blobs of texture or
+            # a single long edge are much sparser.
+            fill = cv2.countNonZero(bw[y:y + bh, x:x + bw_]) / float(bw_ * bh)
+            if fill < 0.2:
+                continue
+            boxes.append((bw_ * bh, x, y, bw_, bh))
+        boxes.sort(reverse=True)
+        regions = []
+        for _, x, y, bw_, bh in boxes[:max_regions]:
+            x1 = max(0, int(x / scale) - pad)
+            y1 = max(0, int(y / scale) - pad)
+            x2 = min(w, int((x + bw_) / scale) + pad)
+            y2 = min(h, int((y + bh) / scale) + pad)
+            regions.append((x1, y1, x2, y2))
+        return regions
+
+    @metrics.timed(metrics.OCR_SECONDS)
+    def extract_segments_regions(self, image_array, conf_thresh=0.5, skip_boxes=None, max_regions=24):
+        """EasyOCR recognition on proposed text regions only; no full-frame detection.
+
+        Regions that mostly overlap ``skip_boxes`` (e.g. strips already
+        matched) are skipped, as are regions whose crop is in the result
+        cache. Returns None when no region is proposed, so callers can
+        fall back to full-frame OCR.
+        """
+        if image_array is None or getattr(image_array, 'size', 0) == 0:
             return []
+        regions = self.propose_text_regions(image_array, max_regions=max_regions)
+        if not regions:
+            return None
+        skip_boxes = skip_boxes or []
 
+        def covered(r):
+            area = float((r[2] - r[0]) * (r[3] - r[1])) or 1.0
+            for b in skip_boxes:
+                iw = min(r[2], b[2]) - max(r[0], b[0])
+                ih = min(r[3], b[3]) - max(r[1], b[1])
+                if iw > 0 and ih > 0 and iw * ih / area > 0.5:
+                    return True
+            return False
+
+        out = {}
+        todo = []
+        for i, (x1, y1, x2, y2) in enumerate(regions):
+            if covered((x1, y1, x2, y2)):
+                continue
+            crop = image_array[y1:y2, x1:x2]
+            key = self.cache.key(('easy-region', conf_thresh), crop) if self.cache.maxsize else None
+            pairs = self.cache.get(key, crop) if key is not None else MISS
+            if pairs is not MISS:
+                out[i] = pairs
+            else:
+                todo.append((i, key, crop))
+        if todo:
+            try:
+                easy = self.get_easy()
+            except Exception as e:
+                print(f"OCR Error: {e}")
+                easy = None
+            for i, key, crop in todo:
+                if easy is None:
+                    out[i] = []
+                    continue
+                # One recognize() call per region: a batched call sorts and may
+                # drop boxes, so its results can't be tied back to regions.
+                try:
+                    with self._easy_lock:
+                        results = easy.recognize(crop, detail=1)
+                except Exception as e:
+                    print(f"OCR Error: {e}")
+                    out[i] = []
+                    continue
+                pairs = [(text, float(conf)) for _, text, conf in results if text and conf >= conf_thresh]
+                if key is not None:
+                    self.cache.put(key, pairs, crop)
+                out[i] = pairs
+        # Reading order: top to bottom, then left to right.
+        order = sorted(out, key=lambda i: (regions[i][1], regions[i][0]))
+        return [t for i in order for t, _ in out[i]]
+
+    # ---------------------------
+    # Multi-angle / robust OCR
+    # ---------------------------
+
+    def estimate_skew(self, image_array, min_angle=1.0):
+        """Rotation (degrees, within +/-45) that levels the text, or 0.0 if negligible."""
+        if len(image_array.shape) == 3:
+            gray = cv2.cvtColor(image_array, cv2.COLOR_BGR2GRAY)
+        else:
+            gray = image_array
+        _, bw = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+        coords = cv2.findNonZero(bw)
+        if coords is None or len(coords) < 50:
+            return 0.0
+        (_, _), (w, h), angle = cv2.minAreaRect(coords)
+        # Angle of the rect's long side, folded into (-45, 45]; the range
+        # minAreaRect reports differs between OpenCV versions.
+        if w < h:
+            angle += 90.0
+        while angle > 45.0:
+            angle -= 90.0
+        while angle <= -45.0:
+            angle += 90.0
+        return angle if abs(angle) >= min_angle else 0.0
+
+    def _rotate(self, image_array, angle):
+        if angle == 90:
+            return cv2.rotate(image_array, cv2.ROTATE_90_CLOCKWISE)
+        if angle == 180:
+            return cv2.rotate(image_array, cv2.ROTATE_180)
+        if angle == 270:
+            return cv2.rotate(image_array, cv2.ROTATE_90_COUNTERCLOCKWISE)
+        h, w = image_array.shape[:2]
+        m = cv2.getRotationMatrix2D((w / 2.0, h / 2.0), angle, 1.0)
+        cos, sin = abs(m[0, 0]), abs(m[0, 1])
+        nw, nh = int(h * sin + w * cos), int(h * cos + w * sin)
+        m[0, 2] += nw / 2.0 - w / 2.0
+        m[1, 2] += nh / 2.0 - h / 2.0
+        return cv2.warpAffine(image_array, m, (nw, nh), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+
+    def _merge_segments(self, groups):
+        # Keep the first spelling of each text and its best confidence.
+        merged = {}
+        for pairs in groups:
+            for text, conf in pairs:
+                key = re.sub(r'[^a-z0-9]', '', text.lower())
+                if not key:
+                    continue
+                if key not in merged:
+                    merged[key] = [text, conf]
+                elif conf > merged[key][1]:
+                    merged[key][1] = conf
+        return [(t, c) for t, c in merged.values()]
+
+    @metrics.timed(metrics.OCR_SECONDS)
+    def extract_segments_multiangle(self, image_array, conf_thresh=0.5, accept=None, stop_conf=0.8, with_conf=False):
+        """EasyOCR over 0/90/180/270 degrees plus a deskewed copy.
+
+        Rotations are prepared on the engine's thread pool; the EasyOCR reads
+        themselves take turns on the shared Reader. As soon as one rotation
+        yields a segment with confidence >= ``stop_conf`` for which
+        ``accept(text)`` is true (e.g. it matches the catalog; any text if
+        ``accept`` is None) the remaining rotations are dropped. Returns the
+        merged, de-duplicated segments, as (text, confidence) pairs when
+        ``with_conf`` is set.
+        """
+        if image_array is None or getattr(image_array, 'size', 0) == 0:
+            return []
+        angles = [0, 90, 270, 180]
+        skew = self.estimate_skew(image_array)
+        if skew:
+            angles.insert(1, skew)
+        pool = self.get_pool()
+        stopped = threading.Event()
+
+        def read(angle):
+            rotated = self._rotate(image_array, angle) if angle else image_array
+            # Skip the read if another rotation was accepted meanwhile.
+            return [] if stopped.is_set() else self._read_easy(rotated, conf_thresh)
+
+        futures = {pool.submit(read, a): a for a in angles}
+        results = {}
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            stop = False
+            for f in done:
+                try:
+                    pairs = f.result()
+                except Exception as e:
+                    print(f"OCR Error: {e}")
+                    pairs = []
+                results[futures[f]] = pairs
+                if any(c >= stop_conf and (accept is None or accept(t)) for t, c in pairs):
+                    stop = True
+            if stop:
+                stopped.set()
+                for f in pending:
+                    f.cancel()
+                break
+        merged = self._merge_segments(results[a] for a in angles if a in results)
+        if with_conf:
+            return merged
+        return [t for t, _ in merged]
+
+    @metrics.timed(metrics.OCR_SECONDS)
+    def extract_segments_robust(self, image_array, conf_thresh=0.5, accept=None, with_conf=False):
+        """PaddleOCR (with its angle classifier), then contrast-enhanced, then multi-angle EasyOCR."""
+        if image_array is None:
+            return []
+        pairs = self._read_paddle(image_array, conf_thresh)
+        if not pairs:
+            pre = self.preprocess_image(image_array)
+            if pre is not None:
+                pairs = self._read_paddle(cv2.cvtColor(pre, cv2.COLOR_GRAY2BGR), conf_thresh)
+        if not pairs:
+            return self.extract_segments_multiangle(image_array, conf_thresh, accept=accept, with_conf=with_conf)
+        merged = self._merge_segments([pairs])
+        if with_conf:
+            return merged
+        return [t for t, _ in merged]
+
+    @metrics.timed(metrics.OCR_SECONDS)
     def extract_text_robust(self, image_array):
         if image_array is None:
             return ""
@@ -97,3 +538,6 @@ class OCREngine:
             segments = self.extract_segments_fast(image_array)
 
         return " ".join(segments).strip()
+
+    # Full-text fallback used by the scan endpoints.
+    extract_text = extract_text_robust
@@ -0,0 +1,283 @@
+import itertools
+import threading
+import time
+from collections import deque
+
+import database
+import matcher
+from scan_pipeline import clean_segment
+
+
+def iou(a, b):
+    ix1, iy1 = max(a[0], b[0]), max(a[1], b[1])
+    ix2, iy2 = min(a[2], b[2]), min(a[3], b[3])
+    inter = max(0, ix2 - ix1) * max(0, iy2 - iy1)
+    if inter == 0:
+        return 0.0
+    area_a = (a[2] - a[0]) * (a[3] - a[1])
+    area_b = (b[2] - b[0]) * (b[3] - b[1])
+    return inter / float(area_a + area_b - inter)
+
+
+class Track:
+    """One strip followed across frames, with its OCR name votes.
+
+    The box moves with a smoothed constant-velocity model so a strip slid
+    across the tray still overlaps its predicted position on the next frame.
+    """
+
+    def __init__(self, track_id, box, frame_idx, window):
+        self.id = track_id
+        self.box = tuple(float(v) for v in box)
+        self.velocity = (0.0, 0.0, 0.0, 0.0)
+        self.first_seen = frame_idx
+        self.last_seen = frame_idx
+        self.last_ocr = None
+        # (frame index, medicine name or None, weight) per OCR reading.
+        self.observations = deque(maxlen=window)
+
+    def predict(self, frame_idx):
+        dt = frame_idx - self.last_seen
+        return tuple(b + v * dt for b, v in zip(self.box, self.velocity))
+
+    def correct(self, box, frame_idx, alpha=0.5):
+        dt = max(frame_idx - self.last_seen, 1)
+        if frame_idx > self.first_seen:
+            step = tuple((n - o) / dt for n, o in zip(box, self.box))
+            self.velocity = tuple(alpha * s + (1 - alpha) * v for s, v in zip(step, self.velocity))
+        self.box = tuple(float(v) for v in box)
+        self.last_seen = frame_idx
+
+    def votes(self):
+        tally = {}
+        for _, name, weight in self.observations:
+            if name:
+                tally[name] = tally.get(name, 0.0) + weight
+        return tally
+
+    def identity(self):
+        """``(name, score, share, frames)`` of the leading vote, or None."""
+        tally = self.votes()
+        if not tally:
+            return None
+        name, score = max(tally.items(), key=lambda kv: kv[1])
+        frames = sum(1 for _, n, _ in self.observations if n == name)
+        return name, score, score / sum(tally.values()), frames
+
+
+class RollingRecognizer:
+    """Detects the newest frames in the background, tracks strips and fuses OCR votes.
+
+    Each processed frame's YOLO boxes are matched to existing tracks by IoU
+    with the tracks' predicted boxes. A crop is OCR'd only while its track's
+    identity is unconfirmed, and re-checked every ``reverify_every``
+    frames after that. A steady scene therefore costs detection only, and the
+    recognized medicine stays attached to the track. Each track keeps its
+    last ``window`` readings, weighted by detection confidence, so a blurry
+    or glare-hit frame is outvoted by its neighbours and ``result()`` has a
+    stable answer before anyone presses scan. Tracks unseen for
+    ``max_missed`` frames are dropped.
+
+    With a frame_source.SceneGate only frames where the scene changed and
+    settled are analysed; while the scene is unchanged the last result stays
+    current, and while it is still moving ``result()`` reports nothing.
+    """
+
+    def __init__(self, detector, ocr_engine, grabber, window=8, fps=3.0, iou_threshold=0.3,
+                 min_frames=2, min_share=0.5, reverify_every=15, max_missed=3, gate=None):
+        self.detector = detector
+        self.ocr_engine = ocr_engine
+        self.grabber = grabber
+        self.gate = gate
+        self.window = window
+        self.interval = 1.0 / fps if fps and fps > 0 else 0.0
+        self.iou_threshold = iou_threshold
+        # A track is confirmed once its best name won at least min_frames
+        # readings and holds min_share of its vote weight.
+        self.min_frames = min_frames
+        self.min_share = min_share
+        self.reverify_every = reverify_every
+        self.max_missed = max_missed
+        self.tracks = []
+        self.frames_done = 0
+        self.crops_ocrd = 0
+        self.crops_skipped = 0
+        self.last_seq = None
+        self.last_ts = None
+        self.frame_ms = 0.0
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='rolling-recognizer', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive() and not self._stop.is_set()
+
+    def confirmed(self, track):
+        ident = track.identity()
+        return ident is not None and ident[3] >= self.min_frames and ident[2] >= self.min_share
+
+    def associate(self, detections):
+        """Match one frame's detections to tracks; returns the track per detection."""
+        with self._lock:
+            self.frames_done += 1
+            frame_idx = self.frames_done
+            predicted = [t.predict(frame_idx) for t in self.tracks]
+            pairs = []
+            for di, det in enumerate(detections):
+                for ti, box in enumerate(predicted):
+                    overlap = iou(det['box'], box)
+                    if overlap >= self.iou_threshold:
+                        pairs.append((overlap, di, ti))
+            pairs.sort(reverse=True)
+            used_det, used_track = set(), set()
+            assigned = [None] * len(detections)
+            for _, di, ti in pairs:
+                if di in used_det or ti in used_track:
+                    continue
+                used_det.add(di)
+                used_track.add(ti)
+                assigned[di] = self.tracks[ti]
+            for di, det in enumerate(detections):
+                track = assigned[di]
+                if track is None:
+                    track = Track(next(self._ids), det['box'], frame_idx, self.window)
+                    self.tracks.append(track)
+                    assigned[di] = track
+                else:
+                    track.correct(det['box'], frame_idx)
+            self.tracks = [t for t in self.tracks if frame_idx - t.last_seen <= self.max_missed]
+            return assigned
+
+    def _reading(self, track):
+        # Unconfirmed tracks are read every frame until they have a full
+        # window of readings; unreadable strips then back off like confirmed ones.
+        return not self.confirmed(track) and len(track.observations) < self.window
+
+    def needs_ocr(self, track):
+        if self._reading(track):
+            return True
+        return self.frames_done - (track.last_ocr or 0) >= self.reverify_every
+
+    def observe(self, track, name, weight):
+        """Record an OCR reading (a catalog name or None) for ``track``."""
+        with self._lock:
+            track.last_ocr = track.last_seen
+            track.observations.append((track.last_seen, name, float(weight)))
+
+    def _read_names(self, crops):
+        catalog = database.get_catalog()
+        med_matcher = matcher.for_catalog(catalog)
+        crop_segments = self.ocr_engine.extract_segments_batch(crops)
+        names = []
+        for segments in crop_segments:
+            name = None
+            for text in segments:
+                cleaned = clean_segment(text)
+                if len(cleaned) < 3 or len(cleaned.split()) > 8:
+                    continue
+                name = med_matcher.match(cleaned, word_fallback=False)
+                if name:
+                    break
+            names.append(name)
+        return names
+
+    def process(self, detections):
+        """Track one frame's detections and OCR only the crops that need it."""
+        tracks = self.associate(detections)
+        todo = [i for i, t in enumerate(tracks) if self.needs_ocr(t)]
+        self.crops_skipped += len(tracks) - len(todo)
+        if not todo:
+            return tracks
+        names = self._read_names([detections[i]['crop'] for i in todo])
+        self.crops_ocrd += len(todo)
+        for i, name in zip(todo, names):
+            self.observe(tracks[i], name, detections[i]['confidence'])
+        return tracks
+
+    def _run(self):
+        seq = 0
+        while not self._stop.is_set():
+            item = self.grabber.wait_newer(seq, timeout=1.0)
+            if item is None:
+                continue
+            seq, frame, ts = item
+            if self.gate is not None and not self.gate.check(frame):
+                # Keep reading a still scene only while some strip is unconfirmed.
+                if self.gate.pending or not any(self._reading(t) for t in self.tracks):
+                    if not self.gate.pending:
+                        # Same scene as the last analysed frame: its result still holds.
+                        self.last_seq = seq
+                        self.last_ts = ts
+                    continue
+            started = time.time()
+            try:
+                _, detections = self.detector.detect(frame)
+                self.process(detections)
+            except Exception as e:
+                print(f"Rolling recognizer error: {e}")
+                self._stop.wait(1.0)
+                continue
+            self.last_seq = seq
+            self.last_ts = ts
+            self.frame_ms = (time.time() - started) * 1000.0
+            remaining = self.interval - (time.time() - started)
+            if remaining > 0:
+                self._stop.wait(remaining)
+
+    def result(self, max_age=None):
+        """Confirmed tracks currently in view.
+
+        Returns a list of ``{'track', 'medicine', 'score', 'share', 'frames',
+        'box'}``, or None when nothing was processed within ``max_age``
+        seconds (the caller should then fall back to a one-shot scan).
+        """
+        if self.last_ts is None or (max_age is not None and time.time() - self.last_ts > max_age):
+            return None
+        if self.gate is not None and self.gate.pending:
+            return None
+        # Ungated, tolerate one missed detection (not a strip that left the
+        # tray); gated, each analysed frame is a settled scene, so trust it.
+        grace = 0 if self.gate is not None else 1
+        out = []
+        with self._lock:
+            for track in self.tracks:
+                if self.frames_done - track.last_seen > grace or not self.confirmed(track):
+                    continue
+                name, score, share, frames = track.identity()
+                out.append({
+                    'track': track.id,
+                    'medicine': name,
+                    'score': round(score, 3),
+                    'share': round(share, 3),
+                    'frames': frames,
+                    'box': tuple(int(v) for v in track.box),
+                })
+        return out
+
+    def stats(self):
+        total = self.crops_ocrd + self.crops_skipped
+        return {
+            'running': self.running,
+            'window': self.window,
+            'frames_processed': self.frames_done,
+            'last_frame_id': self.last_seq,
+            'frame_ms': round(self.frame_ms, 1),
+            'age_s': round(time.time() - self.last_ts, 2) if self.last_ts else None,
+            'tracks': len(self.tracks),
+            'crops_ocrd': self.crops_ocrd,
+            'crops_skipped': self.crops_skipped,
+            'ocr_skip_rate': round(self.crops_skipped / total, 3) if total else 0.0,
+            'gate': self.gate.stats() if self.gate is not None else None,
+        }
@@ -0,0 +1,219 @@
+import re
+import time
+from contextlib import contextmanager
+
+import database
+import matcher
+import metrics
+
+
+IGNORED_WORDS = [
+    'tablet', 'capsule', 'mg', 'ml', 'exp', 'mfg', 'batch', 'price', 'rs', 'usp', 'ip', 'bp',
+    'pv', 'ltd', 'pharmaceuticals', 'india', 'store', 'cool', 'dry', 'place', 'dosage',
+    'keep', 'reach', 'children', 'composition', 'marketed', 'manufactured', 'net', 'content',
+    'transaction', 'expedience', 'offeric', 'warning', 'schedule', 'prescription',
+    'incl', 'taxes', 'all', 'b.no', 'date', 'regd', 'trade', 'mark', 'limited', 'pvt',
+    'medication', 'physician', 'directed', 'temperature', 'protect', 'light', 'moisture',
+    'not', 'for', 'use', 'only', 'sale', 'retail', 'wholesale', 'distributor', 'logistics',
+    'caution', 'practitioner', 'registered', 'medical', 'trihydrate', 'zyshield', 'zydus',
+    'german', 'remedies', 'division', 'industrial', 'estate', 'ahmedabad', 'gujarat'
+]
+
+# Stages reported in ``timings`` by scan_frame, in pipeline order.
+STAGES = ('detect', 'ocr', 'match', 'db')
+# scan_frame modes; anything else runs (and is labelled) as 'accurate'.
+MODES = ('fast', 'accurate')
+
+
+class StageTimer:
+    """Accumulates wall-clock milliseconds per pipeline stage into a dict."""
+
+    def __init__(self, timings=None):
+        self.timings = timings if timings is not None else {}
+
+    @contextmanager
+    def stage(self, name):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + (time.perf_counter() - t) * 1000.0
+
+
+def normalize_mode(mode):
+    mode = str(mode or '').strip().lower()
+    return mode if mode in MODES else 'accurate'
+
+
+def _record(timer, mode, timings):
+    for stage, ms in timer.timings.items():
+        metrics.SCAN_STAGE_SECONDS.observe(ms / 1000.0, mode, stage)
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + ms
+
+
+def clean_segment(text):
+    cleaned_text = text.lower()
+    for word in IGNORED_WORDS:
+        cleaned_text = cleaned_text.replace(word, ' ')
+    cleaned_text = ''.join(e for e in cleaned_text if e.isalnum() or e.isspace())
+    return " ".join(cleaned_text.split())
+
+
+def _match_segments(segments, catalog, med_matcher, aggregated, results, word_fallback=True, max_words=None):
+    # Once a segment matches, later unmatched segments of the same group
+    # count towards that medicine too.
+    matched_med = None
+    for detected_text in segments:
+        cleaned_text = clean_segment(detected_text)
+        if len(cleaned_text) < 3:
+            continue
+        if max_words is not None and len(cleaned_text.split()) > max_words:
+            continue
+        final_match = med_matcher.match(cleaned_text, word_fallback=word_fallback)
+        if final_match:
+            matched_med = catalog.by_name.get(final_match, matched_med)
+        if not matched_med:
+            created = database.ensure_medicine(cleaned_text.title())
+            if created:
+                matched_med = created
+        if matched_med:
+            med_id = matched_med[0]
+            name = matched_med[1]
+            price = matched_med[4]
+            stock = matched_med[5]
+            if stock > 0:
+                entry = aggregated.get(name)
+                if not entry:
+                    aggregated[name] = {'id': med_id, 'price': price, 'count': 1, 'stock': stock}
+                else:
+                    entry['count'] += 1
+            else:
+                results.append({'status': 'error', 'medicine': name, 'message': 'Out of stock', 'debug_text': detected_text})
+
+
+def catalog_accept(med_matcher):
+    """Early-stop predicate for multi-angle OCR: the text names a known medicine."""
+    def accept(text):
+        cleaned = " ".join(re.sub(r'[^a-z0-9\s\-]', ' ', (text or '').lower()).split())
+        return len(cleaned) >= 3 and med_matcher.match(cleaned, word_fallback=False) is not None
+    return accept
+
+
+def _bill(catalog, aggregated, results, preview):
+    if preview:
+        preview_items = []
+        for name, entry in aggregated.items():
+            preview_items.append({'id': entry['id'], 'medicine': name, 'price': entry['price'], 'available': entry['stock'], 'suggested_qty': entry['count']})
+        return {'preview': True, 'matches': preview_items}
+    lines = []
+    for name, entry in aggregated.items():
+        med_row = catalog.by_id.get(entry['id']) or database.get_medicine_by_id(entry['id'])
+        discount = float(med_row[6] if med_row and len(med_row) > 6 else 0.0)
+        lines.append((entry['id'], name, entry['count'], entry['price'], discount))
+    per_line = database.reduce_stock_fefo_bulk(lines)
+    for (_, name, qty, unit_price, _), allocations in zip(lines, per_line):
+        total = sum(a['amount'] for a in allocations)
+        results.append({'status': 'success', 'medicine': name, 'qty': qty, 'price': unit_price, 'total': total, 'message': 'Added to bill'})
+    return {'results': results}
+
+
+def scan_frame(frame, detector, ocr_engine, mode='accurate', preview=False, timings=None):
+    """Run the /scan pipeline on one frame and return the JSON payload.
+
+    ``mode='fast'`` OCRs the whole frame; otherwise YOLO crops are OCR'd in
+    one batch with multi-angle and whole-frame fallbacks. Unless ``preview``
+    is set, matched medicines are billed (stock is reduced FEFO). Per-stage
+    milliseconds (see STAGES) are added to ``timings`` when given and
+    recorded in the scan_stage_seconds metric.
+    """
+    mode = normalize_mode(mode)
+    timer = StageTimer()
+    try:
+        return _scan_frame(frame, detector, ocr_engine, mode, preview, timer)
+    finally:
+        _record(timer, mode, timings)
+
+
+def _scan_frame(frame, detector, ocr_engine, mode, preview, timer):
+    results = []
+    aggregated = {}
+    with timer.stage('match'):
+        catalog = database.get_catalog()
+        med_matcher = matcher.for_catalog(catalog)
+
+    if mode == 'fast':
+        with timer.stage('ocr'):
+            segments = ocr_engine.extract_segments_fast(frame)
+        with timer.stage('match'):
+            _match_segments(segments, catalog, med_matcher, aggregated, results, word_fallback=False)
+        if not aggregated and not results:
+            return {'status': 'warning', 'message': 'No text detected'}
+        with timer.stage('db'):
+            return _bill(catalog, aggregated, results, preview)
+
+    with timer.stage('detect'):
+        _, detections = detector.detect(frame)
+
+    # One batched EasyOCR pass over every crop; multi-angle only for crops it missed.
+    with timer.stage('ocr'):
+        crop_segments = ocr_engine.extract_segments_batch([det['crop'] for det in detections])
+    for det, segments in zip(detections, crop_segments):
+        if not segments:
+            with timer.stage('ocr'):
+                segments = ocr_engine.extract_segments_multiangle(det['crop'], accept=catalog_accept(med_matcher))
+        with timer.stage('match'):
+            _match_segments(segments, catalog, med_matcher, aggregated, results, max_words=8)
+
+    if not aggregated and not results:
+        with timer.stage('ocr'):
+            # Recognise proposed text lines only; whole-frame OCR when that finds
+            # nothing. No strip matched to get here, so no region is skipped.
+            segments = ocr_engine.extract_segments_regions(frame)
+            if not segments:
+                segments = ocr_engine.extract_segments_fast(frame)
+            if not segments:
+                segments = ocr_engine.extract_segments_multiangle(frame, accept=catalog_accept(med_matcher))
+            if not segments:
+                full_text = ocr_engine.extract_text(frame)
+                if full_text and len(full_text.strip()) > 0:
+                    segments = [full_text]
+        if not segments:
+            return {'status': 'warning', 'message': 'No text detected'}
+        with timer.stage('match'):
+            catalog = database.get_catalog()
+            med_matcher = matcher.for_catalog(catalog)
+            _match_segments(segments, catalog, med_matcher, aggregated, results, max_words=12)
+        if not aggregated and not results:
+            return {'status': 'warning', 'message': 'Medicine name not recognized from text.'}
+    with timer.stage('db'):
+        return _bill(catalog, aggregated, results, preview)
+
+
+def scan_fused(recognitions, preview=False, timings=None):
+    """Bill (or preview) RollingRecognizer results: one unit per tracked strip."""
+    timer = StageTimer()
+    try:
+        with timer.stage('db'):
+            catalog = database.get_catalog()
+            results = []
+            aggregated = {}
+            for rec in recognitions:
+                row = catalog.by_name.get(rec['medicine'])
+                if not row:
+                    continue
+                if row[5] > 0:
+                    entry = aggregated.get(row[1])
+                    if not entry:
+                        aggregated[row[1]] = {'id': row[0], 'price': row[4], 'count': 1, 'stock': row[5]}
+                    else:
+                        entry['count'] += 1
+                else:
+                    results.append({'status': 'error', 'medicine': row[1], 'message': 'Out of stock'})
+            if not aggregated and not results:
+                return {'status': 'warning', 'message': 'Medicine name not recognized from text.'}
+            payload = _bill(catalog, aggregated, results, preview)
+        payload['source'] = 'rolling'
+        return payload
+    finally:
+        _record(timer, 'rolling', timings)